@@ -2,6 +2,7 @@ __author__ = 'Kyle Benson (kebenson@uci.edu)'
 """Somewhat generic and helpful algorithms that other networkx users
 might benefit from."""
 
+import heapq
 import networkx as nx
 import logging
 log = logging.getLogger(__name__)
@@ -86,6 +87,10 @@ def node_split_in_out(G, nbunch=None, in_place=False, rename_func=None):
     return g2
 
 
+# For k at most this many paths, get_redundant_paths() uses successive shortest paths rather than capacity scaling
+SUCCESSIVE_SHORTEST_PATHS_MAX_K = 16
+
+
 def get_redundant_paths(G, source, target, k=2, weight='weight'):
     """Gets k (possibly shortest) redundant paths with minimal component overlap.
     Current version based on Zheng et al 2010 paper entitled
@@ -94,6 +99,46 @@ def get_redundant_paths(G, source, target, k=2, weight='weight'):
     handle one flow at regular cost but any others have greatly increased cost.
     This implementation assumes we only care about min-sum costs of edges then nodes
     for the constraints.
+
+    All of the implementations below solve the same min-cost flow problem, so we just
+    dispatch to the fastest one for this k: Suurballe's algorithm for k=2, successive
+    shortest paths for other small k, and general min-cost flow otherwise."""
+
+    if k == 2:
+        return suurballe_redundant_paths(G, source, target, weight=weight)
+    elif k <= SUCCESSIVE_SHORTEST_PATHS_MAX_K:
+        if source == target:
+            raise ValueError("source and target cannot be the same!")
+        flow_net = RedundantPathsFlowNetwork(G, source, k, weight=weight, warm_start=False)
+        return flow_net.get_redundant_paths(target)
+    else:
+        return min_cost_flow_redundant_paths(G, source, target, k, weight=weight)
+
+
+def get_redundant_path_penalties(G, k, weight='weight'):
+    """Returns the penalties (m1, m2) used for discouraging the selection of a node or link (respectively) more
+    than once when finding k redundant paths.  See get_redundant_paths()."""
+
+    # NOTE: we need max_weight > 1 so we just fudge it here.  The
+    # original paper said to modify all weights, but we don't.
+    max_weight = max(G[u][v].get(weight, 1) for u,v in G.edges())
+    if max_weight <= 1:
+        max_weight += 1 - max_weight + 0.001
+    # m2 discourages selecting a link multiple times, so ensure we'll
+    # select k other longest paths before selecting this link again
+    # ENHANCE: could this actually be k-2 and V-2?  says 'larger than
+    # total cost of any k s-t loop-free paths', which might mean we don't
+    # need max_weight > 1 either if we aren't squaring m2
+    m2 = k * G.number_of_nodes() * max_weight
+    # m1 discourages selecting a node multiple times, so we ensure we'd
+    # select every other node k times before this one again
+    m1 = m2 * k * G.number_of_nodes() * 1.001
+    return m1, m2
+
+
+def min_cost_flow_redundant_paths(G, source, target, k=2, weight='weight'):
+    """Implementation of get_redundant_paths() that solves the min-cost flow problem in general using networkx's
+    capacity scaling algorithm on a transformed copy of G.
     WARNING: nodes are expected to be strings since we split them up and relabel them in a temp graph!"""
 
     # 3-step algorithm: build transformed graph(s), find min-cost flow, compute paths
@@ -113,20 +158,7 @@ def get_redundant_paths(G, source, target, k=2, weight='weight'):
     # an edge more than once.
 
     # Choose m1 and m2, which form the aforementioned penalties
-    # NOTE: we need max_weight > 1 so we just fudge it here.  The
-    # original paper said to modify all weights, but we don't.
-    max_weight = max(G[u][v].get(weight, 1) for u,v in G.edges())
-    if max_weight <= 1:
-        max_weight += 1 - max_weight + 0.001
-    # m2 discourages selecting a link multiple times, so ensure we'll
-    # select k other longest paths before selecting this link again
-    # ENHANCE: could this actually be k-2 and V-2?  says 'larger than
-    # total cost of any k s-t loop-free paths', which might mean we don't
-    # need max_weight > 1 either if we aren't squaring m2
-    m2 = k * G.number_of_nodes() * max_weight
-    # m1 discourages selecting a node multiple times, so we ensure we'd
-    # select every other node k times before this one again
-    m1 = m2 * k * G.number_of_nodes() * 1.001
+    m1, m2 = get_redundant_path_penalties(G, k, weight)
 
     # Each edge needs capacity and weight, which is different depending on the end-points:
     # u-v' link gets += M2 and v-v' link gets = M1
@@ -179,7 +211,458 @@ def get_redundant_paths(G, source, target, k=2, weight='weight'):
     return paths
 
 
-def get_multi_source_disjoint_paths(G, sources, target, weight='weight'):
+class RedundantPathsFlowNetwork(object):
+    """The transformed flow network used by get_redundant_paths() for finding k redundant paths from a single source
+    to possibly many targets.  It's built once per (G, source, k) and then each call to get_redundant_paths(target)
+    only changes the demands (i.e. which node is the sink) rather than rebuilding the whole node-split multigraph.
+
+    The network is stored in flat lists indexed by integer IDs rather than as a networkx graph: original node i is
+    split into an 'in' node i (all incoming edges) and an 'out' node i + n (all outgoing edges) with the v-v' links
+    between them.  The source isn't split (its 'in' and 'out' nodes are the same) since no path should pass through
+    it.  The target is split too, but since the flow terminates at its 'in' node that makes no difference.  Each arc
+    e is stored along with its residual reverse arc e ^ 1.
+
+    We solve the min-cost flow via successive shortest paths with reduced costs (Dijkstra w/ node potentials).
+    Because all arc costs are non-negative, the shortest path distances from the source in the initial network are
+    valid potentials for every target: we compute them once and they warm-start each target's solve (its first path
+    comes directly from this shortest path tree so only the remaining k-1 paths require running Dijkstra)."""
+
+    def __init__(self, G, source, k=2, weight='weight', warm_start=True):
+        """
+        :type G: nx.Graph
+        :param source: source node in G that all paths start from
+        :param k: number of redundant paths to find to each target
+        :param weight: string specifying edge (and possibly node) lengths
+        :param warm_start: if True, compute the shortest path tree from source up front so it can be shared between
+         targets; set it to False if you'll only request paths to one target since that first Dijkstra run can then
+         stop early once it reaches the target
+        """
+        if source not in G:
+            raise nx.NetworkXError("source %s not in graph!" % source)
+
+        self.source = source
+        self.k = k
+
+        self.nodes = list(G.nodes())
+        self.node_ids = {n: i for i, n in enumerate(self.nodes)}
+        n = len(self.nodes)
+        self._nnodes = n
+        src_id = self.node_ids[source]
+        self._src_id = src_id
+
+        # Arcs are stored as parallel lists: arc e goes from _tail[e] to _head[e]
+        self._head = []
+        self._tail = []
+        self._capacity = []
+        self._cost = []
+        self._adj = [[] for i in range(2 * n)]
+
+        m1, m2 = get_redundant_path_penalties(G, k, weight)
+
+        def out_id(i):
+            return i if i == src_id else i + n
+
+        # v-v' links: NOTE: we need non-zero weight on these links or the flow
+        # algorithm would needlessly assign flow to them
+        for i, v in enumerate(self.nodes):
+            if i != src_id:
+                self._add_arc(i, i + n, 1, G.node[v].get(weight, 0.00000001))
+                self._add_arc(i, i + n, k - 1, m1)
+
+        # u'-v links: each direction of an undirected edge gets its own pair of arcs
+        edges = G.edges(data=True)
+        if not G.is_directed():
+            edges = ((a, b, d) for u, v, d in edges for a, b in ((u, v), (v, u)))
+        for u, v, d in edges:
+            if u == v:
+                continue
+            u_id = out_id(self.node_ids[u])
+            v_id = self.node_ids[v]
+            w = d.get(weight, 1)
+            self._add_arc(u_id, v_id, 1, w)
+            self._add_arc(u_id, v_id, k - 1, w + m2)
+
+        # Now compute the warm-start potentials shared by all targets
+        self._base_dist = self._base_pred = None
+        if warm_start:
+            self._base_dist, self._base_pred = self._dijkstra(self._capacity, [0] * (2 * n))
+
+    def _add_arc(self, u, v, capacity, cost):
+        e = len(self._head)
+        self._tail.extend((u, v))
+        self._head.extend((v, u))
+        self._capacity.extend((capacity, 0))
+        self._cost.extend((cost, -cost))
+        self._adj[u].append(e)
+        self._adj[v].append(e + 1)
+
+    def _dijkstra(self, residual, potential, target=None):
+        """Shortest paths from the source over arcs with residual capacity using the reduced costs given by
+        potential.  Stops early once target is reached (if specified).
+        :return: (dist, pred) where dist is a dict of finalized distances and pred maps nodes to their incoming arc
+        """
+        head = self._head
+        cost = self._cost
+        adj = self._adj
+        dist = {}
+        pred = {}
+        seen = {self._src_id: 0}
+        heap = [(0, self._src_id)]
+        while heap:
+            d, u = heapq.heappop(heap)
+            if u in dist:
+                continue
+            dist[u] = d
+            if u == target:
+                break
+            pu = potential[u]
+            for e in adj[u]:
+                if residual[e] <= 0:
+                    continue
+                v = head[e]
+                if v in dist:
+                    continue
+                # NOTE: clamp tiny negative reduced costs caused by floating point error
+                vd = d + max(cost[e] + pu - potential[v], 0)
+                if v not in seen or vd < seen[v]:
+                    seen[v] = vd
+                    pred[v] = e
+                    heapq.heappush(heap, (vd, v))
+        return dist, pred
+
+    def get_redundant_paths(self, target):
+        """Gets k redundant paths from the source to target with minimal component overlap: see get_redundant_paths()
+        for a description of the algorithm.
+        :raises nx.NetworkXUnfeasible: if no path exists to target
+        """
+        if target == self.source:
+            raise ValueError("source and target cannot be the same!")
+        try:
+            t = self.node_ids[target]
+        except KeyError:
+            raise nx.NetworkXError("target %s not in graph!" % target)
+
+        residual = list(self._capacity)
+        if self._base_dist is not None:
+            if t not in self._base_dist:
+                raise nx.NetworkXUnfeasible("no path from %s to %s" % (self.source, target))
+            potential = [self._base_dist.get(v, 0) for v in range(2 * self._nnodes)]
+            pred = self._base_pred
+        else:
+            potential = [0] * (2 * self._nnodes)
+        inf = float('inf')
+
+        # Each augmentation sends one unit of flow along a shortest path in the residual network
+        for i in range(self.k):
+            if i > 0 or self._base_dist is None:
+                dist, pred = self._dijkstra(residual, potential, t)
+                if t not in dist:
+                    raise nx.NetworkXUnfeasible("no path from %s to %s" % (self.source, target))
+                # Keep the reduced costs non-negative even though we stopped Dijkstra early
+                dt = dist[t]
+                for v in range(len(potential)):
+                    potential[v] += min(dist.get(v, inf), dt)
+
+            v = t
+            while v != self._src_id:
+                e = pred[v]
+                residual[e] -= 1
+                residual[e ^ 1] += 1
+                v = self._tail[e]
+
+        return self._decompose_paths(residual, t)
+
+    def _decompose_paths(self, residual, t):
+        """Gathers the k paths from the flow in the residual network by repeatedly taking the shortest path over arcs
+        with positive flow, preferring cheaper (primary) arcs, and removing that path's flow."""
+        flow = {}
+        for e in range(0, len(self._head), 2):
+            f = self._capacity[e] - residual[e]
+            if f > 0:
+                flow[e] = f
+
+        n = self._nnodes
+        paths = []
+        for i in range(self.k):
+            dist = {}
+            pred = {}
+            heap = [(0, self._src_id, None)]
+            while heap:
+                d, u, e = heapq.heappop(heap)
+                if u in dist:
+                    continue
+                dist[u] = d
+                pred[u] = e
+                if u == t:
+                    break
+                for e in self._adj[u]:
+                    if flow.get(e, 0) > 0 and self._head[e] not in dist:
+                        heapq.heappush(heap, (d + self._cost[e], self._head[e], e))
+
+            p = []
+            v = t
+            while v != self._src_id:
+                e = pred[v]
+                flow[e] -= 1
+                if v < n:
+                    p.append(self.nodes[v])
+                v = self._tail[e]
+            p.append(self.source)
+            p.reverse()
+            paths.append(p)
+
+        # sanity check
+        if __debug__:
+            if any(f > 0 for f in flow.values()):
+                log.debug("flow network still has flow left after gathering paths from %s to %s!" % (self.source, self.nodes[t]))
+
+        return paths
+
+
+def suurballe_redundant_paths(G, source, target, weight='weight'):
+    """Implementation of get_redundant_paths() specialized for k=2 using Suurballe's algorithm (in the form
+    described by Bhandari): one Dijkstra run for the shortest path, then another over the residual network with
+    costs reduced by the first run's distances, after which any links traversed in opposite directions cancel out.
+
+    Rather than building the transformed flow network, we traverse it implicitly: each node v is split into
+    states (v, IN) and (v, OUT) and the m1/m2 penalized 'bar' arcs are just alternatives to the primary arcs.
+    Hence the two paths are maximally disjoint just as with the general algorithm."""
+
+    if source == target:
+        raise ValueError("source and target cannot be the same!")
+    if source not in G or target not in G:
+        raise nx.NetworkXError("source %s or target %s not in graph!" % (source, target))
+
+    m1, m2 = get_redundant_path_penalties(G, 2, weight)
+    IN, OUT = 0, 1
+    src_state = (source, OUT)
+    dst_state = (target, IN)
+
+    # flow contains each arc, identified by ('node', v, is_bar) or ('edge', u, v, is_bar), currently in use
+    flow = set()
+    node_weights = {v: d.get(weight, 0.00000001) for v, d in G.nodes(data=True)}
+
+    # NOTE: a bar arc is only ever worth considering if its primary arc is already in use
+    def arcs_from(state):
+        """Generates the residual arcs (next_state, arc, delta, cost) leaving state."""
+        v, side = state
+        if side == OUT:
+            for x, d in G.adj[v].items() if not G.is_directed() else G.succ[v].items():
+                if x == source or x == v:
+                    continue
+                w = d.get(weight, 1)
+                arc = ('edge', v, x, False)
+                if arc not in flow:
+                    yield (x, IN), arc, 1, w
+                else:
+                    arc = ('edge', v, x, True)
+                    if arc not in flow:
+                        yield (x, IN), arc, 1, w + m2
+            if v != source:
+                for is_bar, cost in ((False, node_weights[v]), (True, m1)):
+                    arc = ('node', v, is_bar)
+                    if arc in flow:
+                        yield (v, IN), arc, -1, -cost
+        else:
+            arc = ('node', v, False)
+            if arc not in flow:
+                yield (v, OUT), arc, 1, node_weights[v]
+            else:
+                arc = ('node', v, True)
+                if arc not in flow:
+                    yield (v, OUT), arc, 1, m1
+            for u, d in G.adj[v].items() if not G.is_directed() else G.pred[v].items():
+                w = d.get(weight, 1)
+                for is_bar, cost in ((False, w), (True, w + m2)):
+                    arc = ('edge', u, v, is_bar)
+                    if arc in flow:
+                        yield (u, OUT), arc, -1, -cost
+
+    def dijkstra(potential):
+        dist = {}
+        pred = {}
+        seen = {src_state: 0}
+        heap = [(0, src_state)]
+        while heap:
+            d, u = heapq.heappop(heap)
+            if u in dist:
+                continue
+            dist[u] = d
+            if u == dst_state:
+                break
+            pu = potential(u)
+            for v, arc, delta, cost in arcs_from(u):
+                if v in dist:
+                    continue
+                # NOTE: clamp tiny negative reduced costs caused by floating point error
+                vd = d + max(cost + pu - potential(v), 0)
+                if v not in seen or vd < seen[v]:
+                    seen[v] = vd
+                    pred[v] = (u, arc, delta)
+                    heapq.heappush(heap, (vd, v))
+        if dst_state not in dist:
+            raise nx.NetworkXUnfeasible("no path from %s to %s" % (source, target))
+        return dist, pred
+
+    def augment(pred):
+        v = dst_state
+        while v != src_state:
+            u, arc, delta = pred[v]
+            if delta > 0:
+                flow.add(arc)
+            else:
+                flow.remove(arc)
+            v = u
+
+    # First the shortest path, then the second path via reduced costs.
+    # NOTE: we stopped the first Dijkstra early so nodes it never finalized get the target's distance
+    first_dist, pred = dijkstra(lambda state: 0)
+    augment(pred)
+    dt = first_dist[dst_state]
+    _, pred = dijkstra(lambda state: min(first_dist.get(state, dt), dt))
+    augment(pred)
+
+    # Finally, gather the two paths from the remaining flow, preferring the primary (cheaper) arcs
+    out_arcs = {}
+    for arc in flow:
+        if arc[0] == 'edge':
+            out_arcs.setdefault((arc[1], OUT), []).append(((arc[2], IN), arc))
+        else:
+            out_arcs.setdefault((arc[1], IN), []).append(((arc[1], OUT), arc))
+    for arcs in out_arcs.values():
+        arcs.sort(key=lambda a: a[1][-1])
+
+    paths = []
+    for i in range(2):
+        p = [source]
+        state = src_state
+        while state != dst_state:
+            state, arc = out_arcs[state].pop(0)
+            if state[1] == IN:
+                p.append(state[0])
+        paths.append(p)
+    return paths
+
+
+def get_redundant_paths_from_source(G, source, targets, k=2, weight='weight'):
+    """Gets k (possibly shortest) redundant paths with minimal component overlap from source to each of the targets.
+    This is the same as calling get_redundant_paths() for each target, but much faster as the transformed flow network
+    is only built once (see RedundantPathsFlowNetwork).
+    :returns: dict mapping each target to its list of k paths
+    """
+    flow_net = RedundantPathsFlowNetwork(G, source, k, weight=weight)
+    return {t: flow_net.get_redundant_paths(t) for t in targets}
+
+
+def get_multi_source_disjoint_paths(G, sources, target, weight='weight', algorithm='flow'):
+    """Gets len(sources) (possibly shortest) maximally-disjoint paths (minimal component overlap) from
+    multiple sources to one target destination.
+
+    :type G: nx.Graph
+    :type sources: list|tuple|set
+    :param target: target destination node in G
+    :param weight: string specifying path length
+    :param algorithm: 'flow' (default) for min_cost_flow_multi_source_disjoint_paths() or 'greedy' for
+     greedy_multi_source_disjoint_paths(), which scales to hundreds or thousands of sources but may choose
+     different routes
+    :raises nx.NetworkxError: if something goes wrong
+    """
+    if algorithm == 'greedy':
+        return greedy_multi_source_disjoint_paths(G, sources, target, weight=weight)
+    elif algorithm == 'flow':
+        return min_cost_flow_multi_source_disjoint_paths(G, sources, target, weight=weight)
+    else:
+        raise ValueError("unknown multi-source disjoint paths algorithm %s" % algorithm)
+
+
+def greedy_multi_source_disjoint_paths(G, sources, target, weight='weight'):
+    """Gets len(sources) (possibly shortest) maximally-disjoint paths (minimal component overlap) from
+    multiple sources to one target destination by greedily choosing each source's path in turn.
+
+    We track how many of the paths chosen so far use each link and node (i.e. a residual capacity graph where each
+    component has capacity 1) and choose each path with a single early-terminating Dijkstra run (outward from the
+    target) in which every re-use of a link costs m2 and of a node costs m1.  As in get_redundant_paths(), m2 is
+    larger than the length of any loop-free path and m1 larger than re-using every link, but here the penalties
+    don't depend on the number of sources: a component used i times just costs i times as much to use again.
+    Hence the run time is linear in the number of sources and, unlike the min-cost flow version, every source
+    gets a proper path.  Sources are handled in increasing order of their shortest path distance to the target.
+    A source listed more than once is routed only once and its path is returned for each of its entries.
+
+    :type G: nx.Graph
+    :type sources: list|tuple|set
+    :param target: target destination node in G
+    :param weight: string specifying path length
+    :raises nx.NetworkXNoPath: if some source can't reach the target
+    """
+
+    if target not in G:
+        raise nx.NetworkXError("target %s not in graph!" % target)
+
+    # the penalties for a single re-use: see get_redundant_path_penalties()
+    m1, m2 = get_redundant_path_penalties(G, 1, weight)
+
+    # Search outward from the target along the reverse direction of the links
+    if G.is_directed():
+        neighbors = G.pred
+        distances = nx.single_source_dijkstra_path_length(G.reverse(copy=False), target, weight=weight)
+    else:
+        neighbors = G.adj
+        distances = nx.single_source_dijkstra_path_length(G, target, weight=weight)
+    node_weights = {v: d.get(weight, 0.00000001) for v, d in G.nodes(data=True)}
+    node_uses = {}
+
+    unique_sources = []
+    for src in sources:
+        if src == target:
+            raise ValueError("source and target cannot be the same!")
+        if src not in distances:
+            raise nx.NetworkXNoPath("no path from %s to target %s" % (src, target))
+        if src not in node_uses:
+            unique_sources.append(src)
+            node_uses[src] = 0
+
+    link_uses = {}
+    paths = {}
+    for src in sorted(unique_sources, key=lambda n: distances[n]):
+        dist = {}
+        pred = {}
+        seen = {target: 0}
+        heap = [(0, target)]
+        while heap:
+            d, u = heapq.heappop(heap)
+            if u in dist:
+                continue
+            dist[u] = d
+            if u == src:
+                break
+            for v, edge in neighbors[u].items():
+                if v in dist:
+                    continue
+                # NOTE: the link goes v->u since we're searching backwards
+                vd = d + edge.get(weight, 1) + m2 * link_uses.get((v, u), 0)
+                if v != src:
+                    vd += node_weights[v] + m1 * node_uses.get(v, 0)
+                if v not in seen or vd < seen[v]:
+                    seen[v] = vd
+                    pred[v] = u
+                    heapq.heappush(heap, (vd, v))
+
+        path = [src]
+        while path[-1] != target:
+            path.append(pred[path[-1]])
+        paths[src] = path
+
+        for u, v in get_edges_for_path(path):
+            link_uses[(u, v)] = link_uses.get((u, v), 0) + 1
+            if not G.is_directed():
+                link_uses[(v, u)] = link_uses[(u, v)]
+        for v in path[1:-1]:
+            node_uses[v] = node_uses.get(v, 0) + 1
+
+    return [paths[src] for src in sources]
+
+
+def min_cost_flow_multi_source_disjoint_paths(G, sources, target, weight='weight'):
     """Gets len(sources) (possibly shortest) maximally-disjoint paths (minimal component overlap) from
     multiple sources to one target destination.  This just calls get_redundant_paths() with a modified graph
     in which a new 'virtual node' is added with edges to each source.  Because the paths are maximally-disjoint and
@@ -193,6 +676,9 @@ def get_multi_source_disjoint_paths(G, sources, target, weight='weight'):
     option for it anyway...  Could enhance this by actually doing the shortest path (from true source) on the the
     flow graph to get a cheaper path?
 
+    NOTE: since k=len(sources), the penalties (and flow problem) grow with the number of sources so this can be
+    very slow for many sources.
+
     :type G: nx.Graph
     :type sources: list|tuple|set
     :param target: target destination node in G
@@ -238,6 +724,118 @@ def get_multi_source_disjoint_paths(G, sources, target, weight='weight'):
     return final_paths
 
 
+CONTRACTED_PATH_ATTRIBUTE = '_contracted_path'
+
+
+def reduce_graph(G, terminals, weights=('weight',)):
+    """Returns a smaller copy of the undirected graph G for computing trees/paths that connect the given terminals:
+    1) non-terminal leaves (e.g. hosts hanging off of switches) are repeatedly removed since no tree or simple path
+       between terminals would ever use them, which also removes any terminal-free subtrees (e.g. buildings);
+    2) chains of degree-2 non-terminal nodes are contracted into a single super-edge whose weights (for each
+       attribute in weights) are the sums of the chain's weights.  We skip contracting a node if its neighbors
+       are already adjacent since a simple graph can't keep both of these alternative routes.
+    Each super-edge stores the original path (node list) it replaced in its CONTRACTED_PATH_ATTRIBUTE so
+    that expand_reduced_graph() can map results back onto G.
+
+    :type G: nx.Graph
+    :param terminals: nodes that must be kept (e.g. source and destinations)
+    :param weights: edge attributes to sum along contracted chains (missing ones count as 1 as in networkx)
+    :rtype: nx.Graph
+    """
+    terminals = set(terminals)
+    R = nx.Graph(G)
+
+    # 1) fold non-terminal leaves, which may create new leaves to fold
+    leaves = [n for n in R.nodes() if R.degree(n) <= 1 and n not in terminals]
+    while leaves:
+        n = leaves.pop()
+        if n not in R:
+            continue
+        neighbors = list(R.neighbors(n))
+        R.remove_node(n)
+        leaves.extend(v for v in neighbors if R.degree(v) <= 1 and v not in terminals)
+
+    # 2) contract degree-2 chains
+    def oriented_path(u, v):
+        p = R[u][v].get(CONTRACTED_PATH_ATTRIBUTE, [u, v])
+        return p if p[0] == u else list(reversed(p))
+
+    for n in list(R.nodes()):
+        if n in terminals or R.degree(n) != 2:
+            continue
+        a, b = R.neighbors(n)
+        if R.has_edge(a, b):
+            continue
+        attrs = {w: R[a][n].get(w, 1) + R[n][b].get(w, 1) for w in weights}
+        attrs[CONTRACTED_PATH_ATTRIBUTE] = oriented_path(a, n) + oriented_path(n, b)[1:]
+        R.remove_node(n)
+        R.add_edge(a, b, **attrs)
+
+    return R
+
+
+def expand_reduced_graph(G, reduced, reduced_subgraph):
+    """Maps a subgraph (e.g. a multicast tree) of reduced, as returned by reduce_graph(G, ...), back onto G
+    by replacing any super-edges with the original edges they contracted.
+    :type G: nx.Graph
+    :type reduced: nx.Graph
+    :type reduced_subgraph: nx.Graph
+    :return: the corresponding subgraph of G (sharing G's attributes)
+    """
+    edges = []
+    for u, v in reduced_subgraph.edges():
+        path = reduced[u][v].get(CONTRACTED_PATH_ATTRIBUTE)
+        if path is None:
+            edges.append((u, v))
+        else:
+            edges.extend(get_edges_for_path(path))
+
+    if not edges:
+        return G.subgraph(reduced_subgraph.nodes())
+    return G.edge_subgraph(edges)
+
+
+def get_pendant_forest(G):
+    """Splits the undirected graph G into its core (the nodes that lie on a cycle or on a path between two cycles,
+    e.g. core/building routers with redundant uplinks) and the trees hanging off of it (e.g. each building's
+    floor/rack switches and hosts).  Since any tree/path reaching a node in such a pendant tree must follow its
+    unique route to the core, this lets us compute trees on just the (small) core and compose them with these routes.
+
+    :type G: nx.Graph
+    :return: (parents, anchors) where parents maps each non-core node to its neighbor towards the core
+     and anchors maps each non-core node to the core node its pendant tree hangs off of
+    :rtype: (dict, dict)
+    """
+    degrees = dict(G.degree())
+    remaining = len(degrees)
+    parents = dict()
+    leaves = [n for n, d in degrees.items() if d == 1]
+    while leaves:
+        n = leaves.pop()
+        # a tree would otherwise get peeled away entirely: keep its last node as the core
+        if remaining <= 1:
+            break
+        remaining -= 1
+        degrees[n] = 0
+        for v in G.neighbors(n):
+            if degrees[v] > 0:
+                parents[n] = v
+                degrees[v] -= 1
+                if degrees[v] == 1:
+                    leaves.append(v)
+
+    anchors = dict()
+    for n in parents:
+        chain = []
+        while n in parents and n not in anchors:
+            chain.append(n)
+            n = parents[n]
+        anchor = anchors.get(n, n)
+        for c in chain:
+            anchors[c] = anchor
+    return parents, anchors
+
+
 def path_exists(G, p):
     """
     Returns true if p is a valid path in G (all edges exist).  Uses the networkx.is_simple_path(G, path) function so it
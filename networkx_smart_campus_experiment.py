@@ -11,6 +11,7 @@ import networkx as nx
 
 from smart_campus_experiment import SmartCampusExperiment, random, DISTANCE_METRIC
 from ride.ride_d import RideD
+from redundant_multicast_algorithms import ilp_overlap_lower_bound
 from topology_manager.networkx_sdn_topology import NetworkxSdnTopology
 
 COST_METRIC = 'weight'  # for links only
@@ -22,11 +23,39 @@ class NetworkxSmartCampusExperiment(SmartCampusExperiment):
     def __init__(self, *args, **kwargs):
         """
         :param float error_rate: error rate for PUBLICATIONS ONLY!
+        :param overlap_lower_bound: if True, records the lower bound on the trees' overlap (see
+         redundant_multicast_algorithms.ilp_overlap_lower_bound()) for each run
+        :param lower_bound_cache_dir: directory in which these lower bounds are cached so that the other treatments
+         with the same topology, server, subscribers, and # trees needn't recompute them
+        :param multi_source_paths_algorithm: algorithm for the publishers' 'disjoint' reroute_policy paths: 'flow' or
+         'greedy' (see NetworkTopology.get_multi_source_disjoint_paths())
         :param args:
         :param kwargs:
         """
         super(NetworkxSmartCampusExperiment, self).__init__(*args, **kwargs)
         self.results['params']['experiment_type'] = 'networkx'
+        self.overlap_lower_bound = kwargs.get('overlap_lower_bound', False)
+        self.lower_bound_cache_dir = kwargs.get('lower_bound_cache_dir', 'results/lower_bounds')
+        # MDMTs cached on disk can be re-used by other runs/treatments with the same topology, server, and subscribers
+        self.mdmt_cache_dir = kwargs.get('mdmt_cache_dir', None)
+        self.mdmt_cache_size = kwargs.get('mdmt_cache_size', 0)
+        self.multi_source_paths_algorithm = kwargs.get('multi_source_paths_algorithm', 'flow')
+        self.results['params']['multi_source_paths_algorithm'] = self.multi_source_paths_algorithm
+
+    @classmethod
+    def get_arg_parser(cls, *args, **kwargs):
+        arg_parser = super(NetworkxSmartCampusExperiment, cls).get_arg_parser(*args, **kwargs)
+        arg_parser.add_argument('--overlap-lower-bound', action='store_true', dest='overlap_lower_bound',
+                                help='''record a lower bound on the multicast trees' overlap computed from the relaxed
+                                ILP formulation (default=%(default)s)''')
+        arg_parser.add_argument('--lower-bound-cache-dir', default='results/lower_bounds', dest='lower_bound_cache_dir',
+                                help='''directory in which to cache the overlap lower bounds for re-use by other
+                                treatments (default=%(default)s)''')
+        arg_parser.add_argument('--multi-source-paths-algorithm', default='flow', choices=('flow', 'greedy'),
+                                dest='multi_source_paths_algorithm',
+                                help='''algorithm for computing the publishers' maximally-disjoint paths under the
+                                'disjoint' reroute policy: 'greedy' scales to many more publishers (default=%(default)s)''')
+        return arg_parser
 
     def setup_topology(self):
         # only need to set this up once
@@ -71,7 +100,8 @@ class NetworkxSmartCampusExperiment(SmartCampusExperiment):
         # We need to specify dummy addresses that won't actually be used for anything.
         addresses = ["10.0.0.%d" % d for d in range(self.ntrees)]
         rided = RideD(self.topo, self.server, addresses, self.ntrees, construction_algorithm=self.tree_construction_algorithm[0],
-                      const_args=self.tree_construction_algorithm[1:])
+                      const_args=self.tree_construction_algorithm[1:], mdmt_cache_size=self.mdmt_cache_size,
+                      mdmt_cache_dir=self.mdmt_cache_dir)
         # HACK: since we never made an actual API for the controller, we just do this manually...
         for s in subscribers:
             rided.add_subscriber(s, PUBLICATION_TOPIC)
@@ -89,7 +119,8 @@ class NetworkxSmartCampusExperiment(SmartCampusExperiment):
         else:
             if self.reroute_policy != 'disjoint':
                 log.error("unknown reroute_policy '%s'; defaulting to 'disjoint'...")
-            pub_routes = {p[0]: p for p in self.topo.get_multi_source_disjoint_paths(self.publishers, self.server, weight=DISTANCE_METRIC)}
+            pub_routes = {p[0]: p for p in self.topo.get_multi_source_disjoint_paths(self.publishers, self.server, weight=DISTANCE_METRIC,
+                                                                                     algorithm=self.multi_source_paths_algorithm)}
             assert list(sorted(pub_routes.keys())) == list(sorted(self.publishers)), "not all hosts accounted for in disjoint paths: %s" % pub_routes.values()
 
         for pub in self.publishers:
@@ -167,10 +198,11 @@ class NetworkxSmartCampusExperiment(SmartCampusExperiment):
         overlap = [len(t1.intersection(t2)) for t1 in tree_edges for t2 in tree_edges]
         result['overlap'] = sum(overlap)
 
-        # TODO: try to get this working on topos > 20?
-        # the ILP will need some work if we're going to get even the relaxed version running on large topologies
-        # overlap_lower_bound = ilp_redundant_multicast(self.topo.topo, server, subscribers, len(trees), get_lower_bound=True)
-        # result['overlap_lower_bound'] = overlap_lower_bound
+        # NOTE: the overlap above counts each pair of trees both ways and each tree with itself, which is exactly
+        # the objective the lower bound is for
+        if self.overlap_lower_bound:
+            result['overlap_lower_bound'] = ilp_overlap_lower_bound(self.topo.topo, self.server, subscribers,
+                                                                    len(trees), cache_dir=self.lower_bound_cache_dir)
 
         # Record the average size of the trees
         costs = [sum(e[2].get(COST_METRIC, 1) for e in t.edges(data=True)) for t in trees]
@@ -1,6 +1,10 @@
 __author__ = 'kyle'
 
+import os
+import json
+import hashlib
 import itertools
+from array import array
 import networkx as nx
 import logging as log
 
@@ -10,6 +14,13 @@ try:
 except ImportError:
     pass
 
+# Process pools are only used to optionally parallelize red-blue construction, so we don't force
+# the concurrent.futures backport (the 'futures' package on Python 2) as a dependency either...
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+    ProcessPoolExecutor = None
+
 
 class SkeletonList(object):
     """A skeleton list is used to color the edges of a graph either
@@ -457,6 +468,155 @@ class SkeletonList(object):
         print [tuple(t.nodes() if isinstance(t, nx.Graph) else t.graph.nodes()) for t in self._list]
 
 
+# Helper functions for running the red-blue construction in a process pool.
+# Rather than pickling whole networkx graphs (with all of their nested attribute dicts) to send them to
+# the worker processes, we send a compact serialized graph: the node list followed by flat arrays of
+# the edges' end-points (indices into the node list) and their weights.  Workers then respond with
+# arrays of edge indices into this same serialization, which the parent uses to subgraph its own copy
+# of the graph so that all the original attributes are maintained.
+
+# the workers store each edge's index in the serialization as this attribute
+SERIALIZED_EDGE_INDEX_ATTRIBUTE = '_serialized_edge_index'
+
+
+def serialize_graph(graph, weight='weight'):
+    """
+    Serializes the given directed graph into a compact format for sending to a worker process.
+    :type graph: nx.DiGraph
+    :param weight: edge attribute to include as the edges' weights (default of 1 if it's missing)
+    :return: 2-tuple of (serialized_graph, edges) where edges is the list of graph's edges in the
+     same order as they were serialized
+    """
+    nodes = list(graph.nodes())
+    node_indices = {n: i for i, n in enumerate(nodes)}
+    edges = []
+    endpoints = array('l')
+    weights = array('d')
+    for u, v, w in graph.edges(data=weight, default=1):
+        edges.append((u, v))
+        endpoints.append(node_indices[u])
+        endpoints.append(node_indices[v])
+        weights.append(w)
+    return (nodes, endpoints, weights), edges
+
+
+def deserialize_graph(serialized_graph):
+    """
+    Rebuilds a DiGraph from the output of serialize_graph().  Each edge has a 'weight' attribute and
+    its index within the serialization stored as SERIALIZED_EDGE_INDEX_ATTRIBUTE.
+    :rtype: nx.DiGraph
+    """
+    nodes, endpoints, weights = serialized_graph
+    graph = nx.DiGraph()
+    graph.add_nodes_from(nodes)
+    graph.add_edges_from((nodes[endpoints[2*i]], nodes[endpoints[2*i + 1]],
+                          {'weight': w, SERIALIZED_EDGE_INDEX_ATTRIBUTE: i}) for i, w in enumerate(weights))
+    return graph
+
+
+def _get_serialized_edge_indices(graph):
+    return array('l', (i for u, v, i in graph.edges(data=SERIALIZED_EDGE_INDEX_ATTRIBUTE)))
+
+
+def red_blue_edge_indices(serialized_graph, root):
+    """
+    Worker function that builds a SkeletonList over the serialized graph.
+    :return: 2-tuple of arrays containing the serialized edge indices of the red and blue DAGs respectively
+    """
+    # we own this freshly-built graph so no need for SkeletonList to copy it again
+    sl = SkeletonList(deserialize_graph(serialized_graph), root, copy_graph=False)
+    return _get_serialized_edge_indices(sl.get_red_graph()), _get_serialized_edge_indices(sl.get_blue_graph())
+
+
+def steiner_tree_edge_indices(serialized_graph, terminals, root):
+    """
+    Worker function that extracts a steiner tree rooted at root from the serialized DAG.
+    :return: array containing the serialized edge indices of the tree
+    """
+    from networkx.algorithms.approximation import steiner_tree
+    tree = steiner_tree(deserialize_graph(serialized_graph), terminals, root=root, weight='weight')
+    return _get_serialized_edge_indices(tree)
+
+
+def red_blue_split(graphs, root, executor=None):
+    """
+    Splits each of the given graphs into its red and blue DAGs using a SkeletonList rooted at root.
+    :param graphs: list of graphs (directed or not) to split
+    :param executor: optional concurrent.futures Executor used for building the SkeletonLists in parallel
+    :return: list of the resulting DAGs ordered as [red_0, blue_0, red_1, blue_1, ...]
+    """
+    results = []
+    if executor is None:
+        for g in graphs:
+            sl = SkeletonList(g, root)
+            results.append(sl.get_red_graph())
+            results.append(sl.get_blue_graph())
+        return results
+
+    # Submit all the jobs first so they run concurrently, then gather them in order
+    jobs = []
+    for g in graphs:
+        dag = g if g.is_directed() else g.to_directed()
+        serialized, edges = serialize_graph(dag)
+        jobs.append((dag, edges, executor.submit(red_blue_edge_indices, serialized, root)))
+
+    for dag, edges, future in jobs:
+        red, blue = future.result()
+        results.append(dag.edge_subgraph([edges[i] for i in red]))
+        results.append(dag.edge_subgraph([edges[i] for i in blue]))
+    return results
+
+
+def red_blue_partition(graph, root, k, executor=None):
+    """
+    Partitions graph into k maximally disjoint DAGs rooted at root by recursively red-blue splitting.
+    Rather than doubling all the DAGs each round (and throwing away any extras for k not a power of 2),
+    each round only splits the largest (by number of edges) DAGs needed to reach k.  Hence, for k a
+    power of 2 this is exactly the same as the recursive doubling procedure.
+    :param executor: optional concurrent.futures Executor used for building the SkeletonLists in parallel
+    :return: list of k DAGs
+    """
+    results = [graph]
+    while len(results) < k:
+        # Split the largest ones first since they have the most redundancy left to exploit.
+        # NOTE: we keep the resulting DAGs in the same position as their parent so that the
+        # ordering is deterministic and matches the old doubling procedure.
+        nsplits = min(k - len(results), len(results))
+        by_size = sorted(range(len(results)), key=lambda i: results[i].number_of_edges(), reverse=True)
+        to_split = sorted(by_size[:nsplits])
+        split = red_blue_split([results[i] for i in to_split], root, executor=executor)
+
+        new_results = []
+        split_idx = 0
+        for i, g in enumerate(results):
+            if split_idx < len(to_split) and to_split[split_idx] == i:
+                new_results.extend(split[2*split_idx:2*split_idx + 2])
+                split_idx += 1
+            else:
+                new_results.append(g)
+        results = new_results
+
+    return results
+
+
+def dag_steiner_trees(dags, terminals, root, weight='weight', executor=None):
+    """
+    Extracts a steiner tree rooted at root and reaching all the terminals from each of the given DAGs.
+    :param executor: optional concurrent.futures Executor used for building the trees in parallel
+    :return: list of undirected trees in the same order as dags
+    """
+    if executor is None:
+        from networkx.algorithms.approximation import steiner_tree
+        return [steiner_tree(t, terminals, root=root, weight=weight).to_undirected() for t in dags]
+
+    jobs = []
+    for dag in dags:
+        serialized, edges = serialize_graph(dag, weight=weight)
+        jobs.append((dag, edges, executor.submit(steiner_tree_edge_indices, serialized, terminals, root)))
+
+    return [dag.edge_subgraph([edges[i] for i in future.result()]).to_undirected() for dag, edges, future in jobs]
+
+
 
 
 def ilp_redundant_multicast(topology, source, destinations, k=2, get_lower_bound=False):
@@ -593,6 +753,262 @@ def ilp_redundant_multicast(topology, source, destinations, k=2, get_lower_bound
         return final_trees
 
 
+def get_overlap_cost(trees):
+    """Returns the objective value of the ILP formulations for the given trees: the sum over all links of
+    the square of the # trees sharing it, i.e. their total size plus twice their pair-wise overlap."""
+    uses = dict()
+    for t in trees:
+        for u, v in t.edges():
+            e = frozenset((u, v))
+            uses[e] = uses.get(e, 0) + 1
+    return sum(c * c for c in uses.values())
+
+
+def build_redundant_multicast_ilp(topology, source, destinations, k=2, weight='weight', npaths=None,
+                                  multicommodity=False, relaxed=False, initial_trees=None):
+    """Builds a sparser version of the ILP formulation in ilp_redundant_multicast() with the same objective
+    (see get_overlap_cost()), which we can make smaller in two ways:
+    1) pruning: only links on one of the npaths shortest paths from the source to some destination (or on one of
+       the initial_trees) are candidates for the trees, which means the solution may not be optimal anymore;
+    2) single-commodity flow: rather than a unit of flow per (destination, tree), which gives
+       O(E*D*k) variables, each tree routes a single flow of |D| units from the source with each destination
+       consuming one unit.  This gives only O(E*k) variables but a much weaker LP relaxation, so consider
+       multicommodity=True when computing lower bounds.
+    Note that we also only count pair-wise overlap with a variable per (link, tree pair) that isn't bounded above by
+    the link selection variables since minimizing the objective already pushes these to 0.
+
+    :param npaths: # shortest paths per destination defining the candidate links (default=all links)
+    :param multicommodity: if True, uses a flow per (destination, tree) as ilp_redundant_multicast() does
+    :param relaxed: if True, the link selection variables are continuous (i.e. the LP relaxation)
+    :param initial_trees: if specified, these trees (e.g. from the red-blue algorithm) are used as the
+     variables' initial values so that solvers supporting warm starts can begin with them as the incumbent
+    :return: the problem, the links (as node tuples), and a list with a dict per tree mapping the index of each
+     candidate link to its selection variable
+    :rtype: (pulp.LpProblem, list, list[dict])
+    """
+
+    var_type = pulp.LpContinuous if relaxed else pulp.LpBinary
+    destinations = list(set(d for d in destinations if d != source))
+    ndests = len(destinations)
+
+    edges = list(topology.edges())
+    edge_ids = {frozenset(e): i for i, e in enumerate(edges)}
+    node_ids = {n: i for i, n in enumerate(topology.nodes())}
+
+    def path_edge_ids(p):
+        return (edge_ids[frozenset(e)] for e in zip(p, p[1:]))
+
+    # Prune the candidate links for reaching each destination
+    initial_edge_ids = set(edge_ids[frozenset(e)] for t in (initial_trees or []) for e in t.edges())
+    candidates = dict()
+    for d in destinations:
+        if npaths is None:
+            candidates[d] = set(range(len(edges)))
+            continue
+        cands = candidates[d] = set()
+        for p in itertools.islice(nx.shortest_simple_paths(topology, source, d, weight=weight), npaths):
+            cands.update(path_edge_ids(p))
+        cands.update(initial_edge_ids)
+    all_candidates = sorted(set().union(*candidates.values())) if candidates else []
+
+    problem = pulp.LpProblem("Sparse Redundant Multicast Topology", pulp.LpMinimize)
+
+    # NOTE: we name the variables by index rather than node names so that we needn't worry about what
+    # characters pulp/the solver allow in their names
+    edge_selection = [{i: pulp.LpVariable("Edge_%d_T%d" % (i, t), 0, 1, var_type) for i in all_candidates}
+                      for t in range(k)]
+    overlap = dict()
+    for i in all_candidates:
+        for t1 in range(k):
+            for t2 in range(t1):
+                overlap[i, t1, t2] = pulp.LpVariable("Overlap_%d_T%d_T%d" % (i, t1, t2), 0, 1, pulp.LpContinuous)
+                problem += overlap[i, t1, t2] >= edge_selection[t1][i] + edge_selection[t2][i] - 1,\
+                    "OverlapRequirement_%d_T%d_T%d" % (i, t1, t2)
+
+    # OBJECTIVE FUNCTION: same as in ilp_redundant_multicast()
+    problem += pulp.lpSum(x for xs in edge_selection for x in xs.values()) + 2 * pulp.lpSum(overlap.values()),\
+        "Pair-wise overlap among trees"
+
+    # Each flow is over directed arcs: (i, 0) is from edges[i][0] to edges[i][1] and (i, 1) is the reverse
+    def add_flow_constraints(name, arcs, capacity, demands):
+        balance = dict()
+        for (i, direction), var in arcs.items():
+            u, v = edges[i] if direction == 0 else reversed(edges[i])
+            balance.setdefault(u, []).append(-var)
+            balance.setdefault(v, []).append(var)
+        for n, flows in balance.items():
+            problem.addConstraint(pulp.lpSum(flows) == demands.get(n, 0), "FlowBalance_%s_%d" % (name, node_ids[n]))
+        for i, x in capacity:
+            problem.addConstraint(arcs[i, 0] + arcs[i, 1] <= x, "FlowCapacity_%s_%d" % (name, i))
+
+    flows = []
+    for t in range(k):
+        if multicommodity:
+            for j, d in enumerate(destinations):
+                arcs = {(i, direction): pulp.LpVariable("Flow_%d_%d_D%d_T%d" % (i, direction, j, t), 0, 1)
+                        for i in candidates[d] for direction in (0, 1)}
+                demands = {source: -1, d: 1}
+                add_flow_constraints("D%d_T%d" % (j, t), arcs,
+                                     ((i, edge_selection[t][i]) for i in candidates[d]), demands)
+                flows.append((t, d, arcs))
+        else:
+            arcs = {(i, direction): pulp.LpVariable("Flow_%d_%d_T%d" % (i, direction, t), 0, ndests)
+                    for i in all_candidates for direction in (0, 1)}
+            demands = {d: 1 for d in destinations}
+            demands[source] = -ndests
+            add_flow_constraints("T%d" % t, arcs, ((i, ndests * edge_selection[t][i]) for i in all_candidates),
+                                 demands)
+            flows.append((t, None, arcs))
+
+    # Warm start: set the initial values from the given trees (all others default to 0)
+    if initial_trees:
+        initial_values = {var: 0 for var in problem.variables()}
+        for t, tree in enumerate(initial_trees[:k]):
+            for u, v in tree.edges():
+                initial_values[edge_selection[t][edge_ids[frozenset((u, v))]]] = 1
+        for (i, t1, t2), var in overlap.items():
+            initial_values[var] = max(0, initial_values[edge_selection[t1][i]] +
+                                      initial_values[edge_selection[t2][i]] - 1)
+
+        for t, d, arcs in flows:
+            if t >= len(initial_trees):
+                continue
+            targets = set(destinations) if d is None else {d}
+            # the flow along each arc is the # (relevant) destinations below it in the tree
+            below = dict()
+            for u, v in reversed(list(nx.bfs_edges(initial_trees[t], source))):
+                below[v] = below.get(v, 0) + (1 if v in targets else 0)
+                below[u] = below.get(u, 0) + below[v]
+                i = edge_ids[frozenset((u, v))]
+                if (i, 0) in arcs:
+                    initial_values[arcs[i, 0 if edges[i][0] == u else 1]] = below[v]
+
+        try:
+            for var, value in initial_values.items():
+                var.setInitialValue(value)
+        except NotImplementedError:
+            log.debug("this version of pulp doesn't support setting initial values so not warm-starting the ILP")
+
+    return problem, edges, edge_selection
+
+
+def get_ilp_solver(time_limit=None, mip_gap=None, relaxed=False, warm_start=False):
+    """Returns pulp's default (CBC) solver configured with the given time limit (in seconds) and relative MIP gap.
+    Supports both the newer (2.x) and older pulp solver APIs, though only the former supports warm starts."""
+    try:
+        return pulp.PULP_CBC_CMD(mip=not relaxed, msg=0, timeLimit=time_limit, gapRel=mip_gap, warmStart=warm_start)
+    except TypeError:
+        if warm_start:
+            log.warning("this version of pulp doesn't support warm-starting the solver: ignoring the initial trees")
+        return pulp.PULP_CBC_CMD(mip=not relaxed, msg=0, maxSeconds=time_limit, fracGap=mip_gap)
+
+
+def sparse_ilp_redundant_multicast(topology, source, destinations, k=2, weight='weight', npaths=3,
+                                   time_limit=None, mip_gap=None, initial_trees=None):
+    """Uses the sparse ILP formulation (see build_redundant_multicast_ilp()) with a single-commodity flow per tree
+    over the links pruned to those along each destination's npaths shortest paths to create k redundant multicast
+    trees from the source to all the destinations on the given topology.  Unlike ilp_redundant_multicast(),
+    this is usable (with a time limit) on topologies with hundreds of nodes.
+    :param npaths: # shortest paths per destination defining the candidate links (None for all links)
+    :param time_limit: max # seconds to run the solver for, after which it returns its best solution found so far
+    :param mip_gap: relative gap between the best solution and bound at which the solver may stop
+    :param initial_trees: k trees (e.g. from red-blue) used to warm-start the solver; they're also returned if
+     the solver doesn't find better ones e.g. due to the time limit
+    :return: list of k trees that are subgraphs of topology
+    """
+
+    problem, edges, edge_selection = build_redundant_multicast_ilp(topology, source, destinations, k, weight=weight,
+                                                                   npaths=npaths, initial_trees=initial_trees)
+    log.info("#Variables: %d" % len(problem.variables()))
+    log.info("#Constraints: %d" % len(problem.constraints))
+
+    problem.solve(get_ilp_solver(time_limit, mip_gap, warm_start=bool(initial_trees)))
+    log.info("Status: %s" % pulp.LpStatus[problem.status])
+
+    # Extract the trees: we take the BFS tree of each one's selected links and trim off any non-destination
+    # leaves in case the solver's solution contains unnecessary links
+    final_trees = []
+    for xs in edge_selection:
+        selected = topology.edge_subgraph(edges[i] for i, x in xs.items() if x.value() is not None and x.value() > 0.5)
+        if source not in selected or not all(d in selected and nx.has_path(selected, source, d)
+                                             for d in destinations if d != source):
+            final_trees = None
+            break
+        tree = nx.Graph(nx.bfs_tree(selected, source))
+        leaves = [n for n in tree.nodes() if tree.degree(n) == 1 and n != source and n not in destinations]
+        while leaves:
+            n = leaves.pop()
+            neighbors = list(tree.neighbors(n))
+            tree.remove_node(n)
+            leaves.extend(v for v in neighbors if tree.degree(v) == 1 and v != source and v not in destinations)
+        final_trees.append(topology.edge_subgraph(tree.edges()))
+
+    if initial_trees and (final_trees is None or get_overlap_cost(final_trees) > get_overlap_cost(initial_trees)):
+        log.info("ILP solver didn't improve on the initial trees (status=%s): returning those instead" %
+                 pulp.LpStatus[problem.status])
+        return list(initial_trees)
+    if final_trees is None:
+        raise nx.NetworkXError("ILP solver found no solution (status=%s)" % pulp.LpStatus[problem.status])
+
+    log.info("Cost: %d" % get_overlap_cost(final_trees))
+    return final_trees
+
+
+# bump this when changing the formulation so that previously-cached lower bounds aren't re-used
+OVERLAP_LOWER_BOUND_VERSION = 1
+
+
+def ilp_overlap_lower_bound(topology, source, destinations, k=2, cache_dir=None):
+    """Computes a lower bound on the objective (see get_overlap_cost()) of any k multicast trees from the source
+    to all the destinations by solving the LP relaxation of the (unpruned) multi-commodity ILP formulation (see
+    build_redundant_multicast_ilp()) with CBC's LP solver.  This is much faster than
+    ilp_redundant_multicast(get_lower_bound=True) as the formulation is sparser, but it still takes a while on
+    large topologies, so the bounds can be cached on disk for re-use by all experiment treatments that share the
+    same topology, source, destinations, and k.  Since the bound doesn't depend on link weights, neither does
+    the cache key.
+    :param cache_dir: if specified, the bound is stored in (and loaded from) a file in this directory
+    :rtype: float
+    """
+
+    destinations = sorted(set(d for d in destinations if d != source))
+
+    filename = None
+    if cache_dir is not None:
+        h = hashlib.sha1()
+        h.update(repr((OVERLAP_LOWER_BOUND_VERSION, source, destinations, k)))
+        for e in sorted(tuple(sorted(e)) for e in topology.edges()):
+            h.update(repr(e))
+        filename = os.path.join(cache_dir, "overlap_lower_bound_%s.json" % h.hexdigest())
+        if os.path.exists(filename):
+            try:
+                with open(filename) as f:
+                    bound = json.load(f)['lower_bound']
+                log.debug("using cached overlap lower bound from %s" % filename)
+                return bound
+            except (IOError, ValueError, KeyError) as e:
+                log.warning("failed to read cached overlap lower bound from %s: %s" % (filename, e))
+
+    problem, edges, edge_selection = build_redundant_multicast_ilp(topology, source, destinations, k,
+                                                                   multicommodity=True, relaxed=True)
+    log.info("solving overlap lower bound LP with %d variables and %d constraints" %
+             (len(problem.variables()), len(problem.constraints)))
+    problem.solve(get_ilp_solver(relaxed=True))
+    if problem.status != pulp.LpStatusOptimal:
+        raise nx.NetworkXError("failed to solve overlap lower bound LP (status=%s)" % pulp.LpStatus[problem.status])
+    bound = pulp.value(problem.objective)
+
+    if filename is not None:
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            with open(filename, 'w') as f:
+                json.dump({'lower_bound': bound, 'source': source, 'destinations': destinations, 'k': k}, f)
+        except IOError as e:
+            log.warning("failed to cache overlap lower bound in %s: %s" % (filename, e))
+
+    return bound
+
+
 # tests
 if __name__ == '__main__':
     log.basicConfig(format='%(levelname)s:%(message)s', level=log.DEBUG)
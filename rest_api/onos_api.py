@@ -29,7 +29,7 @@ Command descriptions:
     intents [app_id intent_id]
     post_intent <json_intent>
     apps
-    statistics (not yet implemented)
+    statistics [device_id]
 """
 
 
@@ -215,11 +215,15 @@ class OnosRestApi(BaseRestApi):
         path = self.base_path + '/applications'
         return self.get(path)
 
-    def get_statistics(self):
-        """Get port statistics of all devices."""
-        # TODO: support rest of ONOS REST API for statistics (need to feed args to this function)
+    def get_statistics(self, device_id=None):
+        """Get port statistics of all devices or just the specified one.
+        :return: list of {'device': device_id, 'ports': [{'port': port_num, 'packetsSent': ..., ...}, ...]}
+        """
+        # TODO: support rest of ONOS REST API for statistics e.g. flow tables, delta port stats
         path = self.base_path + '/statistics/ports'
-        return self.get(path)
+        if device_id is not None:
+            path += '/%s' % device_id
+        return self.get(path)['statistics']
 
     # ENHANCE: could add flow objectives, meters, component configuration
 
@@ -255,7 +259,7 @@ class OnosRestApi(BaseRestApi):
         elif cmd == 'apps':
             return self.get_apps()
         elif cmd == 'statistics':
-            return self.get_statistics()
+            return self.get_statistics(*other_args)
         else:
             print usage_desc
             exit(0)
@@ -3,6 +3,8 @@
 DEFAULT_TREE_CONSTRUCTION_ALGORITHM = ('red-blue',)
 DEFAULT_TREE_CHOOSING_HEURISTIC = 'importance'
 DEFAULT_REROUTE_POLICY = 'disjoint'
+# How RideC assigns publishers to DataPaths: 'priority' (lowest ID) or 'balanced' (weighted consistent hashing)
+DEFAULT_DATA_PATH_ASSIGNMENT_POLICY = 'priority'
 
 # BUGFIX: when doing redirection to edge server, the static path to cloud server takes precedence.
 # Cause: for multiple flow rules matching a packet, OVS uses the first one added!
@@ -2,9 +2,15 @@ import json
 import socket
 import time
 import logging
+from collections import OrderedDict
 
 import math
 
+from ride.probe_format import monotonic_ns, pack_probe, unpack_probe, is_binary_probe, PROBE_VERSION, \
+    VERSION_UNSUPPORTED, PROBE_FORMATS, BINARY_PROBE_FORMAT, JSON_PROBE_FORMAT
+from ride.probe_estimators import build_estimator, LOSS_ESTIMATORS, RTT_ESTIMATORS
+from ride.probe_telemetry import ProbeTelemetry, ESTIMATION_PHASE, MONITORING_PHASE, RECOVERY_PHASE
+
 log = logging.getLogger(__name__)
 # ENHANCE: get the logger in __init__ so that we can optionally send it to a file instead?
 
@@ -14,6 +20,10 @@ DATA_PATH_DOWN = 0
 def data_path_status_code_to_str(code):
     return 'UP' if code == DATA_PATH_UP else 'DOWN'
 
+# link loss rates are capped at this when adapting the detection window size as a (near) 100% loss rate would make it
+# infinite (or undefined)
+MAX_LINK_LOSS = 0.99
+
 
 class DataPathMonitor(object):
     """
@@ -118,6 +128,51 @@ class ProbingDataPathMonitor(DataPathMonitor):
             raise socket.error("received probe response from unexpected address %s" % addr)
 
 
+class ProbeSequenceWindow(object):
+    """
+    Tracks the probes currently in flight (i.e. sent but neither responded to nor timed out) by sequence # along with
+    each one's own deadline so that we can attribute responses to the right probe and only deem a probe lost once its
+    deadline passes.  Since probes are sent in sequence # order with the same timeout, the deadlines are in the same
+    order and the window slides forward as the oldest probes are responded to or expire.
+    """
+
+    def __init__(self):
+        self._deadlines = OrderedDict()
+
+    def add(self, seq, deadline):
+        self._deadlines[seq] = deadline
+
+    def on_response(self, seq):
+        """Removes the probe from the window, returning True if it was in flight (i.e. not late or a duplicate)."""
+        return self._deadlines.pop(seq, None) is not None
+
+    def expire(self, now):
+        """Removes and returns (in order) the sequence #s of the probes whose deadline passed."""
+        expired = []
+        for seq, deadline in self._deadlines.items():
+            if deadline > now:
+                break
+            expired.append(seq)
+        for seq in expired:
+            del self._deadlines[seq]
+        return expired
+
+    def next_deadline(self):
+        """Returns the earliest deadline of the probes in flight or None if there aren't any."""
+        for deadline in self._deadlines.itervalues():
+            return deadline
+        return None
+
+    def clear(self):
+        self._deadlines.clear()
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def __contains__(self, seq):
+        return seq in self._deadlines
+
+
 class RideCDataPathMonitor(ProbingDataPathMonitor):
     """
     RideC uses an adaptive probing mechanism to monitor a DataPath.  It tunes the frequency of its probing interval
@@ -129,12 +184,21 @@ class RideCDataPathMonitor(ProbingDataPathMonitor):
     # non-zero default to avoid math errors esp. due to link loss rate of 0
     DEFAULT_DETECTION_WINDOW_SIZE = 3
 
-    def __init__(self, max_detection_time=3000, max_false_positive=0.01, init_window=50, alpha=0.8, **kwargs):
+    def __init__(self, max_detection_time=3000, max_false_positive=0.01, init_window=50, alpha=0.8, pipeline_depth=1,
+                 probe_format=BINARY_PROBE_FORMAT, loss_estimator=None, rtt_estimator=None, **kwargs):
         """
         :param max_detection_time: maximum time (in ms) it will take to detect a failure/congestion event
         :param max_false_positive: in (exclusive) range (0, 1.0) to determine false positive rate
         :param init_window: number of probes required when first starting up to determine the DataPath's normal status
         :param alpha: exponential weighting factor used in calculating average RTT
+        :param pipeline_depth: max # probes in flight at once while monitoring (see do_pipelined_probing_round());
+        the default of 1 only sends the next probe after the previous one was responded to or timed out
+        :param probe_format: send probes in the compact binary format (default; see ride.probe_format) or as JSON;
+        we fall back to an older version (or JSON) if the echo server tells us it doesn't support ours
+        :param loss_estimator: estimates the link loss rate used to size the detection window: the name of one of
+        ride.probe_estimators.LOSS_ESTIMATORS or a LossEstimator; the default of None uses the loss over our lifetime
+        :param rtt_estimator: estimates the RTT and probe timeout: the name of one of RTT_ESTIMATORS or an
+        RttEstimator; the default of None uses an EWMA (with alpha) and timeout of twice the RTT
         :param kwargs: passed to super(...)
         """
         super(RideCDataPathMonitor, self).__init__(**kwargs)
@@ -144,6 +208,13 @@ class RideCDataPathMonitor(ProbingDataPathMonitor):
         self.max_false_positive = max_false_positive
         self.init_window = init_window
         self._alpha = alpha
+        self.pipeline_depth = pipeline_depth
+        if probe_format not in PROBE_FORMATS:
+            raise ValueError("unrecognized probe_format %s: must be one of %s" % (probe_format, PROBE_FORMATS))
+        self.probe_format = probe_format
+        self._probe_version = PROBE_VERSION
+        self.loss_estimator = build_estimator(loss_estimator, LOSS_ESTIMATORS)
+        self.rtt_estimator = build_estimator(rtt_estimator, RTT_ESTIMATORS)
 
         if max_false_positive <= 0:
             raise ValueError("cannot specify a max_false_positive rate <= 0!! Requested: %f" % max_false_positive)
@@ -164,6 +235,15 @@ class RideCDataPathMonitor(ProbingDataPathMonitor):
         self._total_sent = 0
         self._total_received = 0
 
+        # probes in flight when pipelining
+        self._probe_window = ProbeSequenceWindow()
+
+        # time (time.time()) until which passive evidence shows the DataPath is healthy (see suppress_probing())
+        self._probing_suppressed_until = 0
+
+        # metrics about our probing (see get_telemetry_snapshot())
+        self.telemetry = ProbeTelemetry()
+
         # Should exit when this is True
         self._running = False
 
@@ -208,6 +288,60 @@ class RideCDataPathMonitor(ProbingDataPathMonitor):
         #     log.warning("socket error: %s")
         return delay
 
+    def do_pipelined_probing_round(self, count=False):
+        """
+        Like do_probing_round(), but allows up to pipeline_depth probes to be in flight at once: sends a probe (if
+        the window of probes in flight isn't full) and then handles responses until it's time to send the next probe
+        (i.e. after the sending interval).  Responses are attributed to their own probe (even if a later one was
+        sent since) and a probe only counts as lost once its own deadline (i.e. sent time + timeout) passes, so a
+        timeout no longer delays sending the next probe and detection time is bounded by the interval.
+        While probing is suppressed (see suppress_probing()), no probe is sent and the round lasts until the
+        suppression ends (or is cancelled by resume_probing()), though we keep handling the responses in flight.
+        :param count: whether to increment the internal counters for total sent/rcvd
+        :return: list of the results of the probes that completed during this round in the order they completed:
+        the delay (in ms) for each one responded to or False for each one that timed out
+        """
+        start = now = time.time()
+        interval = self._sending_interval / 1000.0
+        if self.get_time_until_next_probe(0) > interval:
+            log.debug("DP %s: not sending probe as probing is suppressed" % self.data_path_id)
+        elif len(self._probe_window) < self.pipeline_depth:
+            seq = self.send_probe(count=count)
+            self._probe_window.add(seq, now + self._timeout / 1000.0)
+        else:
+            log.debug("DP %s: not sending probe as %d are already in flight" % (self.data_path_id, len(self._probe_window)))
+
+        results = []
+        while True:
+            for seq in self._probe_window.expire(now):
+                log.info("DP %s: Timeout Probe (seq:%d)" % (self.data_path_id, seq))
+                results.append(False)
+
+            # NOTE: re-checked every time so that suppress_probing()/resume_probing() take effect during the round
+            next_send_time = now + self.get_time_until_next_probe((now - start) * 1000)
+            if now >= next_send_time:
+                return results
+            # wake up at least every interval to notice a resume_probing() while suppressed
+            next_deadline = self._probe_window.next_deadline()
+            if next_deadline is None or next_deadline > min(next_send_time, now + interval):
+                next_deadline = min(next_send_time, now + interval)
+
+            try:
+                self._probing_socket.settimeout(max(next_deadline - now, 0.0001))
+                recv_data_str = self.recv_response()
+                # only count responses we attribute to probes in flight: late ones were already counted as lost
+                delay, resp_seq = self.on_response_received(recv_data_str, count=False)
+                if self._probe_window.on_response(resp_seq):
+                    log.debug("DP %s: Received Probe Response (seq:%d) delay = %dms" % (self.data_path_id, resp_seq, delay))
+                    if count:
+                        self._total_received += 1
+                    results.append(delay)
+                else:
+                    log.debug("DP %s: skipping late/duplicate probe response with seq #%d" % (self.data_path_id, resp_seq))
+            except socket.timeout:
+                pass
+            now = time.time()
+
     def send_probe(self, count=False):
         """
         Send the probe to the echo server with the current time and sequence # in it.  Note that this defers to the
@@ -217,10 +351,13 @@ class RideCDataPathMonitor(ProbingDataPathMonitor):
         """
         seq = self._seq
         self.set_probe_timeout(self._timeout)
-        current_time_millis = int(time.time() * 1000)
-        data = dict(seq=seq, time_sent=current_time_millis)
+        if self.probe_format == BINARY_PROBE_FORMAT:
+            data = pack_probe(seq, monotonic_ns(), version=self._probe_version)
+        else:
+            current_time_millis = int(time.time() * 1000)
+            data = json.dumps(dict(seq=seq, time_sent=current_time_millis))
 
-        self._do_send(json.dumps(data))
+        self._do_send(data)
         log.debug("DP %s: Sent Probe (seq:%d)" % (self.data_path_id, seq))
 
         if count:
@@ -237,6 +374,16 @@ class RideCDataPathMonitor(ProbingDataPathMonitor):
         :param count: if True, increment the number of received responses
         :return: 2-tuple: (round-trip-time (in ms), probe sequence number)
         """
+        if is_binary_probe(recv_data_str):
+            receive_time_ns = monotonic_ns()
+            if count:
+                self._total_received += 1
+            version, probe_type, receive_seq, sent_time_ns = unpack_probe(recv_data_str)
+            if probe_type == VERSION_UNSUPPORTED:
+                self._on_probe_version_unsupported(version)
+            return (receive_time_ns - sent_time_ns) / 1000000.0, receive_seq
+
+        # JSON probe
         receive_time_millis = int(time.time() * 1000)
         if count:
             self._total_received += 1
@@ -247,6 +394,16 @@ class RideCDataPathMonitor(ProbingDataPathMonitor):
 
         return delay, receive_seq
 
+    def _on_probe_version_unsupported(self, server_version):
+        """The echo server doesn't support our binary probe version so we fall back to the one it does (or JSON)."""
+        if server_version >= 1:
+            log.warning("DP %s: echo server doesn't support probe version %d; falling back to version %d" %
+                        (self.data_path_id, self._probe_version, server_version))
+            self._probe_version = server_version
+        else:
+            log.warning("DP %s: echo server doesn't support binary probes; falling back to JSON" % self.data_path_id)
+            self.probe_format = JSON_PROBE_FORMAT
+
     #### These functions handle adjusting the internal state
 
     def set_detection_window_size(self, max_false_positive_rate=None, link_loss=None):
@@ -260,6 +417,10 @@ class RideCDataPathMonitor(ProbingDataPathMonitor):
             max_false_positive_rate = self.max_false_positive
         if link_loss is None:
             link_loss = self._link_loss
+        if link_loss > MAX_LINK_LOSS:
+            log.warning("DP %s: link_loss of %f is too high to base the detection window on: using %f instead" %
+                        (self.data_path_id, link_loss, MAX_LINK_LOSS))
+            link_loss = MAX_LINK_LOSS
 
         try:
             self._detection_window_size = math.ceil(math.log(max_false_positive_rate, link_loss))
@@ -277,10 +438,9 @@ class RideCDataPathMonitor(ProbingDataPathMonitor):
         """
         Adapts the detector's parameters according to the RideC resource-conserving adaptive probing algorithm.
         """
-        # TODO: should probably do a weighted average of link loss rather than this calculation over the whole lifetime
-        self._link_loss = 1.0 - float(self._total_received) / self._total_sent
+        self._link_loss = self.get_link_loss()
         self.set_detection_window_size()
-        self._timeout = self._rtt_a * 2
+        self._timeout = self.get_probe_timeout()
         self._sending_interval = self.max_detection_time / self._detection_window_size
 
     def check_data_path_status(self, successive_fails):
@@ -312,6 +472,9 @@ class RideCDataPathMonitor(ProbingDataPathMonitor):
         """
 
         if alpha is None:
+            if self.rtt_estimator is not None:
+                self._rtt_a = self.rtt_estimator.update(delay)
+                return self._rtt_a
             alpha = self._alpha
 
         if self._rtt_a is None:
@@ -321,6 +484,29 @@ class RideCDataPathMonitor(ProbingDataPathMonitor):
 
         return self._rtt_a
 
+    def on_probe_result(self, delay):
+        """
+        Updates the link loss and RTT estimates with the outcome of a (counted) probe.
+        :param delay: the probe's RTT (in ms) or False if it timed out
+        """
+        self.telemetry.record_probe(delay)
+        if self.loss_estimator is not None:
+            self.loss_estimator.update(delay is False)
+        if delay is not False:
+            self.estimate_rtt(delay)
+
+    def get_link_loss(self):
+        """Returns the estimated link loss rate: by default over all the probes we've sent."""
+        if self.loss_estimator is not None:
+            return self.loss_estimator.loss_rate
+        return 1.0 - float(self._total_received) / self._total_sent
+
+    def get_probe_timeout(self):
+        """Returns how long (in ms) to wait for a probe's response: by default twice the estimated RTT."""
+        if self.rtt_estimator is not None:
+            return self.rtt_estimator.timeout
+        return 2 * self._rtt_a
+
     #### These functions represent operation in the DataPathMonitor's various states.
 
     def link_characteristic_estimation_phase(self, nprobes=None):
@@ -331,20 +517,25 @@ class RideCDataPathMonitor(ProbingDataPathMonitor):
         :return:
         """
         log.debug("DP %s: Entering initial link characteristic estimation phase..." % self.data_path_id)
+        self.telemetry.enter_phase(ESTIMATION_PHASE)
 
         if nprobes is None:
             nprobes = self.init_window
 
         for i in range(nprobes):
             delay = self.do_probing_round(count=True)
-            # just ignore timeouts...
-            if delay is not False:
-                self.estimate_rtt(delay)
+            # timeouts only count towards the link loss...
+            self.on_probe_result(delay)
             # TODO: sleep for some time between probes???
 
+        self.finish_estimation_phase()
+
+    def finish_estimation_phase(self):
+        """Sets the algorithm parameters according to the DataPath characteristics estimated by the initial probes."""
         log.debug("Initial phase finished!")
-        self._link_loss = 1.0 - float(self._total_received) / self._total_sent
-        self._timeout = 2 * self._rtt_a
+        self.telemetry.enter_phase(MONITORING_PHASE)
+        self._link_loss = self.get_link_loss()
+        self._timeout = self.get_probe_timeout()
         self.set_detection_window_size()
         self._sending_interval = self.max_detection_time / self._detection_window_size
         log.info("DP %s links status: link_loss:%f, rtt_a:%dms, Nb:%d, interval:%fms" % (self.data_path_id,
@@ -359,17 +550,7 @@ class RideCDataPathMonitor(ProbingDataPathMonitor):
         :param nsuccesses: defaults to DEFAULT_DETECTION_WINDOW_SIZE
         :return:
         """
-        log.info("Entering DataPath Recovery Detection phase...")
-
-        if nsuccesses is None:
-            nsuccesses = self.DEFAULT_DETECTION_WINDOW_SIZE
-
-        # we aim for detecting a recovery (assuming 0 loss rate) within our specified detection time by doing:
-        # ENHANCE: instead of waiting for successive responses, perhaps track the recent loss rate and wait for it to
-        # exceed some threshold?
-        # TODO: perhaps we should actually account for the expected RTT here?  or maybe use our calculated detection
-        # window size instead of a default value?
-        self._timeout = self.max_detection_time / float(nsuccesses)
+        nsuccesses = self.enter_recovery_phase(nsuccesses)
 
         successive_count = 0
         while self.is_data_path_down:
@@ -405,6 +586,26 @@ class RideCDataPathMonitor(ProbingDataPathMonitor):
                 self.adapt_probing_parameters()
                 return
 
+    def enter_recovery_phase(self, nsuccesses=None):
+        """
+        Sets the probing parameters for the DataPath Recovery Detection phase.
+        :param nsuccesses: # successive responses required to deem the DataPath recovered;
+        defaults to DEFAULT_DETECTION_WINDOW_SIZE
+        :return: nsuccesses
+        """
+        log.info("Entering DataPath Recovery Detection phase...")
+
+        if nsuccesses is None:
+            nsuccesses = self.DEFAULT_DETECTION_WINDOW_SIZE
+
+        # we aim for detecting a recovery (assuming 0 loss rate) within our specified detection time by doing:
+        # ENHANCE: instead of waiting for successive responses, perhaps track the recent loss rate and wait for it to
+        # exceed some threshold?
+        # TODO: perhaps we should actually account for the expected RTT here?  or maybe use our calculated detection
+        # window size instead of a default value?
+        self._timeout = self.max_detection_time / float(nsuccesses)
+        return nsuccesses
+
     def run(self):
         """
         The main loop of the RideC DataPath monitoring algorithm: determines the initial DataPath characteristics and
@@ -419,14 +620,29 @@ class RideCDataPathMonitor(ProbingDataPathMonitor):
         successive_fails = 0
 
         while self._running:
-            if not self.is_data_path_down:
+            if not self.is_data_path_down and self.pipeline_depth > 1:
+                for delay in self.do_pipelined_probing_round(count=True):
+                    self.on_probe_result(delay)
+                    if delay is False:
+                        successive_fails += 1
+                    else:
+                        successive_fails = 0
+
+                    if self.check_data_path_status(successive_fails) == DATA_PATH_DOWN:
+                        # the recovery detection phase goes back to one probe at a time
+                        self._probe_window.clear()
+                        self.update_link_status(DATA_PATH_DOWN)
+                        break
+                    else:
+                        self.adapt_probing_parameters()
+            elif not self.is_data_path_down:
                 delay = self.do_probing_round(count=True)
+                self.on_probe_result(delay)
                 if delay is False:
                     successive_fails += 1
                     delay = self._timeout
                 else:
                     successive_fails = 0
-                    self.estimate_rtt(delay)
 
                 state = self.check_data_path_status(successive_fails)
                 if state == DATA_PATH_DOWN:
@@ -445,11 +661,52 @@ class RideCDataPathMonitor(ProbingDataPathMonitor):
         we last sent a probe.  This is to account for the fact that receiving a response incurs some delay.
         :param time_since_last_probe: in ms; if unspecified or None, simply sleep for the sending_interval
         """
+        time_until_next_probe = self.get_time_until_next_probe(time_since_last_probe)
+        if time_until_next_probe > 0:
+            time.sleep(time_until_next_probe)
+
+    def get_time_until_next_probe(self, time_since_last_probe=None):
+        """
+        Returns the time (in seconds; may be <= 0) until we should send the next probe: see wait_for_next_probe()
+        :param time_since_last_probe: in ms; if unspecified or None, simply the sending_interval
+        """
         time_until_next_probe = self._sending_interval / 1000.0
         if time_since_last_probe is not None:
             time_until_next_probe -= time_since_last_probe / 1000.0
-        if time_until_next_probe > 0:
-            time.sleep(time_until_next_probe)
+        if not self.is_data_path_down:
+            time_until_next_probe = max(time_until_next_probe, self._probing_suppressed_until - time.time())
+        return time_until_next_probe
+
+    def update_link_status(self, status):
+        self.telemetry.on_status_change(status)
+        # the recovery detection phase always follows a failure
+        self.telemetry.enter_phase(MONITORING_PHASE if status == DATA_PATH_UP else RECOVERY_PHASE)
+        super(RideCDataPathMonitor, self).update_link_status(status)
+
+    def get_telemetry_snapshot(self):
+        """
+        Returns our probing metrics (see ride.probe_telemetry.ProbeTelemetry.snapshot()) along with the current status
+        and adaptive probing parameters.  Safe to call from other threads.
+        """
+        snapshot = self.telemetry.snapshot()
+        snapshot.update(status=self._link_status, link_loss=self._link_loss, rtt_estimate=self._rtt_a,
+                        detection_window_size=self._detection_window_size, sending_interval=self._sending_interval,
+                        timeout=self._timeout)
+        return snapshot
+
+    def suppress_probing(self, duration):
+        """
+        Tells us that passive evidence (e.g. traffic progress seen by a PortStatsDataPathMonitor) shows the DataPath
+        is healthy so that we can hold off on sending our next probe while it's UP.
+        :param duration: how long (in seconds) from now the evidence is valid for
+        """
+        self._probing_suppressed_until = max(self._probing_suppressed_until, time.time() + duration)
+
+    def resume_probing(self):
+        """Cancels any suppress_probing() e.g. because passive evidence now suggests the DataPath may be DOWN.
+        NOTE: a probing thread already sleeping in wait_for_next_probe() only resumes after that sleep, whereas a
+        pipelined one resumes within a sending interval (see do_pipelined_probing_round())."""
+        self._probing_suppressed_until = 0
 
     def finish(self):
         log.info("closing DataPathMonitor...")
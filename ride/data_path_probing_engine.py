@@ -0,0 +1,319 @@
+import heapq
+import os
+import select
+import socket
+import time
+from threading import RLock
+import logging
+
+from ride.data_path_monitor import DATA_PATH_DOWN, DATA_PATH_UP
+from ride.probe_telemetry import ESTIMATION_PHASE, MONITORING_PHASE, RECOVERY_PHASE
+
+log = logging.getLogger(__name__)
+
+
+class DataPathProbingEngine(object):
+    """
+    Drives the probing of many RideCDataPathMonitors from a single thread rather than each monitor blocking its own
+    thread in run() with one outstanding probe.  The engine multiplexes the monitors' sockets with epoll (falling back
+    to select where unavailable) and keeps a timer (either the outstanding probe's timeout or when to send the next
+    probe) for each DataPath in a heap.
+
+    Each DataPath goes through the same phases (link characteristic estimation, monitoring, and recovery detection)
+    as in RideCDataPathMonitor.run(), which are implemented here as a state machine driven by probe responses/timeouts
+    rather than blocking loops.  The monitors still do all the actual algorithm calculations (RTT estimation, adapting
+    the probing interval/timeout/detection window, checking status) and call their status_change_callback, which
+    therefore happens from the engine's thread.
+
+    NOTE: one difference from the blocking version is that a probe's timeout is measured from when we sent it rather
+    than restarting whenever we receive a stale response to a previous probe.
+    ENHANCE: support pipelined probing (see RideCDataPathMonitor.do_pipelined_probing_round()); currently the engine
+    keeps only one probe in flight per DataPath so it rejects monitors with a pipeline_depth > 1.
+    """
+
+    # phases each DataPath goes through (see RideCDataPathMonitor.run())
+    ESTIMATION = ESTIMATION_PHASE
+    MONITORING = MONITORING_PHASE
+    RECOVERY = RECOVERY_PHASE
+
+    class _PathState(object):
+        """Probing state for a single DataPath."""
+
+        __slots__ = ('monitor', 'fd', 'phase', 'outstanding_seq', 'timer_token', 'probes_left', 'successive_fails',
+                     'successive_successes', 'nsuccesses')
+
+        def __init__(self, monitor):
+            self.monitor = monitor
+            self.fd = monitor._probing_socket.fileno()
+            self.phase = DataPathProbingEngine.ESTIMATION
+            self.outstanding_seq = None
+            # only the most recently scheduled timer is valid: others in the heap are ignored
+            self.timer_token = None
+            self.probes_left = monitor.init_window
+            self.successive_fails = 0
+            self.successive_successes = 0
+            self.nsuccesses = None
+
+        @property
+        def count(self):
+            # probes sent during recovery aren't counted (see RideCDataPathMonitor.data_path_recovery_detection())
+            return self.phase != DataPathProbingEngine.RECOVERY
+
+    def __init__(self, monitors=()):
+        """
+        :param monitors: the RideCDataPathMonitors to drive; more can be added later with add_monitor()
+        """
+        super(DataPathProbingEngine, self).__init__()
+
+        self._paths = dict()  # socket fileno --> _PathState
+        self._timers = []  # heap of (time, token, _PathState)
+        self._next_token = 0
+        # NOTE: reentrant since the monitors' callbacks (called while holding it) may e.g. add monitors
+        self._lock = RLock()
+        self._running = False
+
+        if hasattr(select, 'epoll'):
+            self._poller = select.epoll()
+        else:
+            self._poller = None
+
+        # Self-pipe so that adding monitors or finishing wakes up the event loop
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        self._register(self._wakeup_read)
+
+        for m in monitors:
+            self.add_monitor(m)
+
+    def add_monitor(self, monitor):
+        """
+        Starts probing the DataPath of the given monitor (beginning with its link characteristic estimation phase).
+        Can be called from other threads while the engine is running.
+        :type monitor: ride.data_path_monitor.RideCDataPathMonitor
+        :raises ValueError: if the monitor is configured for pipelined probing (pipeline_depth > 1), which we don't
+         support so it would silently behave differently than when running itself
+        """
+        if monitor.pipeline_depth > 1:
+            raise ValueError("DataPathProbingEngine doesn't support pipelined probing: monitor for DataPath %s has"
+                             " pipeline_depth=%d" % (monitor.data_path_id, monitor.pipeline_depth))
+        state = self._PathState(monitor)
+        with self._lock:
+            self._paths[state.fd] = state
+            self._register(state.fd)
+            self._schedule(state, 0)
+        self._wakeup()
+        return state
+
+    def remove_monitor(self, monitor):
+        """Stops probing the DataPath of the given monitor (without closing it)."""
+        with self._lock:
+            for fd, state in self._paths.items():
+                if state.monitor is monitor:
+                    self.__remove_path(fd)
+
+    def __remove_path(self, fd):
+        state = self._paths.pop(fd, None)
+        if state is not None:
+            state.timer_token = None
+            self._unregister(fd)
+
+    @property
+    def monitors(self):
+        return [s.monitor for s in self._paths.values()]
+
+    ####  event loop
+
+    def run(self):
+        """Runs the event loop until finish() is called."""
+        log.info("starting probing engine for %d DataPaths" % len(self._paths))
+        self._running = True
+        while self._running:
+            with self._lock:
+                timeout = self._fire_timers()
+            for fd in self._poll(timeout):
+                if not self._running:
+                    break
+                if fd == self._wakeup_read:
+                    os.read(self._wakeup_read, 4096)
+                    continue
+                with self._lock:
+                    state = self._paths.get(fd)
+                    if state is not None:
+                        self._do_safely(state, self._on_readable, state)
+
+        if self._poller is not None:
+            self._poller.close()
+        wakeup_fds = self._wakeup_read, self._wakeup_write
+        self._wakeup_write = None
+        for fd in wakeup_fds:
+            os.close(fd)
+
+    def finish(self, close_monitors=True):
+        """Stops the event loop and optionally closes all of the monitors."""
+        log.info("closing DataPathProbingEngine...")
+        self._running = False
+        self._wakeup()
+        if close_monitors:
+            with self._lock:
+                for fd, state in self._paths.items():
+                    self.__remove_path(fd)
+                    state.monitor.finish()
+
+    def _fire_timers(self):
+        """Handles all expired timers and returns the time (in seconds) until the next one (None if no timers)."""
+        while self._timers:
+            when, token, state = self._timers[0]
+            if token != state.timer_token:
+                heapq.heappop(self._timers)
+                continue
+            now = time.time()
+            if when > now:
+                return when - now
+            heapq.heappop(self._timers)
+            state.timer_token = None
+            if state.outstanding_seq is not None:
+                self._do_safely(state, self._on_probe_result, state, False)
+            else:
+                self._do_safely(state, self._send_probe, state)
+        return None
+
+    def _do_safely(self, state, func, *args):
+        """Calls func, removing the DataPath if this raises an error so that one failed DataPath can't stop the
+        engine from monitoring the others."""
+        try:
+            func(*args)
+        except (socket.error, ValueError, TypeError, ZeroDivisionError) as e:
+            log.error("DP %s: stopping its monitoring due to error: %s" % (state.monitor.data_path_id, e))
+            self.__remove_path(state.fd)
+
+    def _schedule(self, state, delay):
+        """Schedules the DataPath's (only) timer to fire after delay seconds, cancelling any previous one."""
+        self._next_token += 1
+        state.timer_token = self._next_token
+        heapq.heappush(self._timers, (time.time() + max(delay, 0), state.timer_token, state))
+
+    def _wakeup(self):
+        if self._wakeup_write is None:
+            return
+        try:
+            os.write(self._wakeup_write, 'x')
+        except OSError:
+            pass
+
+    #### polling (epoll where available, otherwise select)
+
+    def _register(self, fd):
+        if self._poller is not None:
+            self._poller.register(fd, select.EPOLLIN)
+
+    def _unregister(self, fd):
+        if self._poller is not None:
+            try:
+                self._poller.unregister(fd)
+            except (IOError, ValueError):
+                # already closed
+                pass
+
+    def _poll(self, timeout):
+        """Waits up to timeout seconds (forever if None) and returns the readable file descriptors."""
+        try:
+            if self._poller is not None:
+                return [fd for fd, event in self._poller.poll(-1 if timeout is None else timeout)]
+            with self._lock:
+                fds = [self._wakeup_read] + list(self._paths.keys())
+            return select.select(fds, [], [], timeout)[0]
+        except (IOError, select.error) as e:
+            # e.g. interrupted system call or a monitor's socket being closed from another thread
+            log.debug("probing engine poll interrupted: %s" % e)
+            return []
+
+    #### the per-DataPath state machine (see RideCDataPathMonitor.run())
+
+    def _send_probe(self, state):
+        monitor = state.monitor
+        if state.phase == self.ESTIMATION and state.probes_left == monitor.init_window:
+            log.info("starting monitoring on DataPath %s (remote host=%s)" % (monitor.data_path_id, monitor.echo_server))
+            monitor._running = True
+            log.debug("DP %s: Entering initial link characteristic estimation phase..." % monitor.data_path_id)
+            monitor.telemetry.enter_phase(ESTIMATION_PHASE)
+
+        state.outstanding_seq = monitor.send_probe(count=state.count)
+        self._schedule(state, monitor._timeout / 1000.0)
+
+    def _on_readable(self, state):
+        monitor = state.monitor
+        resp, addr = monitor._probing_socket.recvfrom(monitor.buffer_size)
+        if addr != monitor.echo_server:
+            log.warning("DP %s: received probe response from unexpected address %s" % (monitor.data_path_id, addr))
+            return
+
+        delay, resp_seq = monitor.on_response_received(resp, count=state.count)
+        if resp_seq != state.outstanding_seq:
+            log.debug("DP %s: skipping old probe with seq #%d, expecting #%s" % (monitor.data_path_id, resp_seq,
+                                                                               state.outstanding_seq))
+            return
+        log.debug("DP %s: Received Probe Response (seq:%d) delay = %dms" % (monitor.data_path_id, resp_seq, delay))
+        self._on_probe_result(state, delay)
+
+    def _on_probe_result(self, state, delay):
+        """
+        Handles the result of the outstanding probe according to the DataPath's current phase.
+        :param delay: the probe's RTT (in ms) or False if it timed out
+        """
+        monitor = state.monitor
+        if delay is False:
+            log.info("DP %s: Timeout Probe (seq:%d)" % (monitor.data_path_id, state.outstanding_seq))
+        state.outstanding_seq = None
+        state.timer_token = None
+
+        if state.phase == self.ESTIMATION:
+            # timeouts only count towards the link loss...
+            monitor.on_probe_result(delay)
+            state.probes_left -= 1
+            if state.probes_left > 0:
+                self._schedule(state, 0)
+            else:
+                monitor.finish_estimation_phase()
+                state.phase = self.MONITORING
+                state.successive_fails = 0
+                self._schedule(state, 0)
+
+        elif state.phase == self.MONITORING:
+            monitor.on_probe_result(delay)
+            if delay is False:
+                state.successive_fails += 1
+                delay = monitor._timeout
+            else:
+                state.successive_fails = 0
+
+            if monitor.check_data_path_status(state.successive_fails) == DATA_PATH_DOWN:
+                monitor.update_link_status(DATA_PATH_DOWN)
+                # Continue monitoring DataPath until it recovers
+                state.phase = self.RECOVERY
+                state.nsuccesses = monitor.enter_recovery_phase()
+                state.successive_successes = 0
+                self._schedule(state, 0)
+            else:
+                monitor.adapt_probing_parameters()
+                self._schedule(state, monitor.get_time_until_next_probe(delay))
+
+        else:
+            if delay is not False:
+                state.successive_successes += 1
+            else:
+                state.successive_successes = 0
+                delay = monitor._timeout
+
+            # Fast-recovery scheme: see RideCDataPathMonitor.data_path_recovery_detection()
+            if state.successive_successes == 0:
+                self._schedule(state, monitor.get_time_until_next_probe(delay))
+            elif state.successive_successes >= state.nsuccesses:
+                log.debug("DataPath %s recovered after %d successful probes in a row!" % (monitor.data_path_id,
+                                                                                         state.nsuccesses))
+                monitor.update_link_status(DATA_PATH_UP)
+                # NOTE: the wait uses the interval from before we reset our probing parameters
+                self._schedule(state, monitor.get_time_until_next_probe(delay))
+                monitor.adapt_probing_parameters()
+                state.phase = self.MONITORING
+                state.successive_fails = 0
+            else:
+                self._schedule(state, 0)
@@ -0,0 +1,247 @@
+# Caches MDMTs so that RideD needn't rebuild them when nothing relevant has changed
+import os
+import sys
+import json
+import struct
+import hashlib
+import tempfile
+from array import array
+from collections import OrderedDict
+
+import networkx as nx
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class MdmtCache(object):
+    """
+    Caches the MDMTs built for a topic so that they can be re-used as long as the topology, root, subscribers,
+    and construction algorithm (+ its args and # trees) don't change.  Entries are keyed by make_key(), which uses
+    a canonical hash of the topology (see get_topology_fingerprint()).
+
+    There are two tiers: a bounded in-memory LRU tier and an optional on-disk tier (one file per entry in the
+    cache_dir) so that restarts and repeated experiment treatments can re-use MDMTs.  Both store just the trees'
+    node/edge lists (see serialize_trees() for the compact binary format used on disk); when retrieving an entry
+    we rebuild the trees as fresh subgraphs of the current topology so that they have all the expected
+    (e.g. port) attributes and callers can freely modify them (e.g. to assign their addresses).
+
+    Cache hits/misses are counted in stats and reported via get_stats().
+    NOTE: assumes the topology's nodes are strings (as elsewhere in RideD).
+    """
+
+    FILE_EXTENSION = '.mdmt'
+    MAGIC = 'MDMT'
+    VERSION = 1
+
+    def __init__(self, max_entries=16, cache_dir=None):
+        """
+        :param int max_entries: max # entries kept in the in-memory LRU tier
+        :param str cache_dir: if specified, entries are also stored in (and loaded from) files in this directory
+        """
+        super(MdmtCache, self).__init__()
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        if cache_dir is not None and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        self._entries = OrderedDict()
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'disk_writes': 0}
+
+    @staticmethod
+    def get_topology_fingerprint(topo):
+        """
+        Returns a canonical hash of the topology's nodes and links (including their attributes such as node weights
+        and link weights/ports), which is independent of the order in which they were added to the graph.
+        :type topo: nx.Graph
+        :rtype: str
+        """
+        h = hashlib.sha1()
+        for n, data in sorted(topo.nodes(data=True), key=lambda x: x[0]):
+            h.update(repr((n, json.dumps(data, sort_keys=True, default=str))))
+        h.update('|')
+        edges = []
+        for u, v, data in topo.edges(data=True):
+            if not topo.is_directed() and v < u:
+                u, v = v, u
+            edges.append((u, v, json.dumps(data, sort_keys=True, default=str)))
+        for e in sorted(edges):
+            h.update(repr(e))
+        return h.hexdigest()
+
+    @staticmethod
+    def make_key(topology_fingerprint, root, subscribers, algorithm, heur_args, k, *options):
+        """
+        Builds the cache key for MDMTs built with the given parameters.
+        :param options: any other parameters that affect the MDMTs (e.g. weight metric)
+        :rtype: tuple
+        """
+        return (topology_fingerprint, root, frozenset(subscribers), algorithm, tuple(heur_args), k, tuple(options))
+
+    def get(self, key, topo):
+        """
+        Returns the MDMTs cached for key rebuilt from the given topology or None if they aren't cached.
+        :type topo: nx.Graph
+        :rtype: list[nx.Graph]|None
+        """
+        trees = self._entries.get(key)
+        if trees is not None:
+            # move to the end so it's the most recently used
+            del self._entries[key]
+            self._entries[key] = trees
+            self.stats['memory_hits'] += 1
+            log.debug("MDMT cache hit (memory) for root %s with %d subscribers" % (key[1], len(key[2])))
+            return self._rebuild_trees(trees, topo)
+
+        if self.cache_dir is not None:
+            filename = self._get_filename(key)
+            if os.path.exists(filename):
+                try:
+                    with open(filename, 'rb') as f:
+                        trees = self.deserialize_trees(f.read())
+                # NOTE: a truncated/corrupt file can cause any of these so we just treat it as a miss
+                except (IOError, ValueError, IndexError, struct.error) as e:
+                    log.warning("failed to read MDMT cache file %s: %s" % (filename, e))
+                else:
+                    self._put_in_memory(key, trees)
+                    self.stats['disk_hits'] += 1
+                    log.debug("MDMT cache hit (disk) for root %s with %d subscribers" % (key[1], len(key[2])))
+                    return self._rebuild_trees(trees, topo)
+
+        self.stats['misses'] += 1
+        return None
+
+    def put(self, key, mdmts):
+        """
+        Caches the given MDMTs under key.
+        :type mdmts: list[nx.Graph]
+        """
+        trees = [(list(t.nodes()), list(t.edges())) for t in mdmts]
+        self._put_in_memory(key, trees)
+
+        if self.cache_dir is not None:
+            filename = self._get_filename(key)
+            # write to a temp file and then rename it so that readers (e.g. other experiment processes sharing
+            # the cache_dir) never see a partially-written file
+            tmp_filename = None
+            try:
+                fd, tmp_filename = tempfile.mkstemp(dir=self.cache_dir, prefix='.mdmt')
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(self.serialize_trees(trees))
+                os.rename(tmp_filename, filename)
+                self.stats['disk_writes'] += 1
+            except (IOError, OSError) as e:
+                if tmp_filename is not None and os.path.exists(tmp_filename):
+                    os.remove(tmp_filename)
+                log.warning("failed to write MDMT cache file %s: %s" % (filename, e))
+
+    def clear(self):
+        """Clears the in-memory tier (the on-disk tier is left alone)."""
+        self._entries.clear()
+
+    def get_stats(self):
+        """Returns a copy of the cache hit/miss statistics along with the hit ratio."""
+        stats = dict(self.stats)
+        hits = stats['memory_hits'] + stats['disk_hits']
+        total = hits + stats['misses']
+        stats['hit_ratio'] = float(hits) / total if total else 0.0
+        stats['entries'] = len(self._entries)
+        return stats
+
+    def _put_in_memory(self, key, trees):
+        if key in self._entries:
+            del self._entries[key]
+        self._entries[key] = trees
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _get_filename(self, key):
+        topo_hash, root, subs, algorithm, heur_args, k, options = key
+        # NOTE: need a canonical (i.e. sorted) version of the key since e.g. frozenset's ordering isn't
+        canonical = json.dumps([topo_hash, root, sorted(subs), algorithm, heur_args, k, options], default=str)
+        return os.path.join(self.cache_dir, hashlib.sha1(canonical).hexdigest() + self.FILE_EXTENSION)
+
+    @staticmethod
+    def _rebuild_trees(trees, topo):
+        results = []
+        for nodes, edges in trees:
+            if edges:
+                t = nx.Graph(topo.edge_subgraph(edges))
+            else:
+                t = nx.Graph()
+            t.add_nodes_from(nodes)
+            results.append(t)
+        return results
+
+    @classmethod
+    def serialize_trees(cls, trees):
+        """
+        Serializes the trees, each a (nodes, edges) tuple, into a compact binary string formatted as:
+        header (magic, version, # trees, # nodes), then each node name as length-prefixed UTF-8,
+        then for each tree its # nodes and # edges followed by its node and edge end-point indices
+        into the node table as arrays of unsigned ints.
+        :rtype: str
+        """
+        node_ids = {}
+        node_names = []
+        for nodes, edges in trees:
+            for n in nodes:
+                if n not in node_ids:
+                    node_ids[n] = len(node_names)
+                    node_names.append(n)
+
+        parts = [struct.pack('<4sBHI', cls.MAGIC, cls.VERSION, len(trees), len(node_names))]
+        for n in node_names:
+            name = unicode(n).encode('utf-8')
+            parts.append(struct.pack('<H', len(name)))
+            parts.append(name)
+        for nodes, edges in trees:
+            parts.append(struct.pack('<II', len(nodes), len(edges)))
+            parts.append(cls._to_little_endian(array('I', (node_ids[n] for n in nodes))).tostring())
+            parts.append(cls._to_little_endian(array('I', (node_ids[n] for e in edges for n in e))).tostring())
+        return ''.join(parts)
+
+    @staticmethod
+    def _to_little_endian(a):
+        """Byte-swaps (in place) the array if needed so that it's stored little-endian like the header."""
+        if sys.byteorder != 'little':
+            a.byteswap()
+        return a
+
+    @classmethod
+    def deserialize_trees(cls, data):
+        """
+        Inverse of serialize_trees()
+        :raises ValueError: if the data isn't properly formatted
+        :rtype: list[tuple]
+        """
+        magic, version, ntrees, nnodes = struct.unpack_from('<4sBHI', data)
+        if magic != cls.MAGIC or version != cls.VERSION:
+            raise ValueError("unrecognized MDMT cache format: magic=%s, version=%d" % (magic, version))
+        offset = struct.calcsize('<4sBHI')
+
+        node_names = []
+        for i in range(nnodes):
+            length, = struct.unpack_from('<H', data, offset)
+            offset += 2
+            node_names.append(data[offset:offset + length].decode('utf-8'))
+            offset += length
+
+        itemsize = array('I').itemsize
+        trees = []
+        for i in range(ntrees):
+            n, m = struct.unpack_from('<II', data, offset)
+            offset += 8
+            nodes = array('I')
+            nodes.fromstring(data[offset:offset + n * itemsize])
+            offset += n * itemsize
+            endpoints = array('I')
+            endpoints.fromstring(data[offset:offset + 2 * m * itemsize])
+            offset += 2 * m * itemsize
+            cls._to_little_endian(nodes)
+            cls._to_little_endian(endpoints)
+            if len(nodes) != n or len(endpoints) != 2 * m:
+                raise ValueError("truncated MDMT cache data")
+            trees.append(([node_names[j] for j in nodes],
+                          [(node_names[endpoints[j]], node_names[endpoints[j + 1]]) for j in range(0, 2 * m, 2)]))
+        return trees
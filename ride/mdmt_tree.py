@@ -0,0 +1,169 @@
+# Compact representation of the MDMTs that RideD keeps around for each topic
+from array import array
+
+import networkx as nx
+
+
+class NodeIndex(object):
+    """
+    Maps the topology's nodes to consecutive integer IDs so that MdmtTrees built from the same topology can share
+    a single copy of the node names and store just integer arrays indexed by these IDs.
+    Nodes can be added later (e.g. when repairing MDMTs after the topology changed) without invalidating the IDs
+    of existing ones.
+    """
+
+    __slots__ = ('nodes', 'ids')
+
+    def __init__(self, nodes=()):
+        self.nodes = []
+        self.ids = dict()
+        for n in nodes:
+            self.get_id(n)
+
+    def get_id(self, node):
+        """Returns the ID of the node, first adding it to the index if it isn't already in there."""
+        _id = self.ids.get(node)
+        if _id is None:
+            _id = self.ids[node] = len(self.nodes)
+            self.nodes.append(node)
+        return _id
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, node):
+        return node in self.ids
+
+
+class MdmtTree(object):
+    """
+    A multicast tree stored as an array of each node's parent (by ID in a NodeIndex shared by all of the MDMTs built
+    from the same topology) rather than as a networkx graph with its dict-of-dicts adjacency and copies of all the
+    topology's edge attributes.  RideD keeps its MDMTs in this form as it holds several per topic (and its
+    AlertContexts reference them) but only needs a graph view of them when e.g. compiling their flow rules:
+    use to_networkx() for these cases and from_graph() to convert the trees built by the NetworkTopology.
+
+    Like the graphs RideD previously stored, an MdmtTree has a name (by default its address) used to identify it.
+    """
+
+    __slots__ = ('root', 'parents', 'terminals', 'name', 'address', 'node_index')
+
+    # value in the parents array for nodes not in the tree; the root is its own parent
+    NOT_IN_TREE = -1
+
+    def __init__(self, root, parents, terminals, node_index, name=None, address=None):
+        """
+        :param root: root node (e.g. the server) from which the tree is oriented
+        :param array parents: each node's parent ID (NOT_IN_TREE if it isn't in the tree) indexed by node ID
+        :param terminals: the destinations (e.g. subscribers) the tree was built to reach
+        :type node_index: NodeIndex
+        """
+        self.root = root
+        self.parents = parents
+        self.terminals = frozenset(terminals)
+        self.node_index = node_index
+        self.address = address
+        self.name = name if name is not None else address
+
+    @classmethod
+    def from_graph(cls, tree, root, terminals, node_index=None, name=None, address=None):
+        """
+        Builds an MdmtTree from the given networkx tree, which must contain the root.
+        Any name/address stored in the tree's graph attributes are kept unless others are specified.
+        :type tree: nx.Graph
+        :param node_index: index shared with the other MDMTs (default=a new index of tree's nodes)
+        :type node_index: NodeIndex
+        :raises nx.NetworkXError: if the root isn't in the tree
+        :rtype: MdmtTree
+        """
+        if root not in tree:
+            raise nx.NetworkXError("root %s not in multicast tree %s" % (root, tree.graph.get('name')))
+        if node_index is None:
+            node_index = NodeIndex(tree.nodes())
+
+        get_id = node_index.get_id
+        root_id = get_id(root)
+        for n in tree.nodes():
+            get_id(n)
+
+        parents = array('i', [cls.NOT_IN_TREE]) * len(node_index)
+        parents[root_id] = root_id
+        for u, v in nx.bfs_edges(tree, root):
+            parents[get_id(v)] = get_id(u)
+
+        if address is None:
+            address = tree.graph.get('address')
+        if name is None:
+            name = tree.graph.get('name')
+        return cls(root, parents, terminals, node_index, name=name or None, address=address)
+
+    def to_networkx(self, topo=None):
+        """
+        Returns a new networkx view of this tree with its name and address set in the graph attributes.
+        :param topo: if specified, the edges' attributes (e.g. ports) are copied from this topology
+        :type topo: nx.Graph
+        :rtype: nx.Graph
+        """
+        if topo is not None:
+            t = nx.Graph(topo.edge_subgraph(self.edges()))
+        else:
+            t = nx.Graph(self.edges())
+        t.add_node(self.root)
+        t.graph['address'] = self.address
+        t.name = self.name
+        return t
+
+    def _get_parent_id(self, _id):
+        # node added to the index after this tree was built?
+        if _id is None or _id >= len(self.parents):
+            return self.NOT_IN_TREE
+        return self.parents[_id]
+
+    def nodes(self):
+        """Generates the nodes in the tree."""
+        names = self.node_index.nodes
+        for i, p in enumerate(self.parents):
+            if p != self.NOT_IN_TREE:
+                yield names[i]
+
+    def edges(self):
+        """Generates the tree's edges as (parent, child) tuples."""
+        names = self.node_index.nodes
+        for i, p in enumerate(self.parents):
+            if p != self.NOT_IN_TREE and p != i:
+                yield names[p], names[i]
+
+    def number_of_nodes(self):
+        return sum(1 for p in self.parents if p != self.NOT_IN_TREE)
+
+    def number_of_edges(self):
+        return self.number_of_nodes() - 1
+
+    def __contains__(self, node):
+        return self._get_parent_id(self.node_index.ids.get(node)) != self.NOT_IN_TREE
+
+    def __len__(self):
+        return self.number_of_nodes()
+
+    def get_parent(self, node):
+        """Returns the node's parent (None for the root).
+        :raises KeyError: if the node isn't in the tree"""
+        _id = self.node_index.ids.get(node)
+        p = self._get_parent_id(_id)
+        if p == self.NOT_IN_TREE:
+            raise KeyError("node %s not in MDMT %s" % (node, self.name))
+        return None if p == _id else self.node_index.nodes[p]
+
+    def get_path(self, node):
+        """Returns the (only) path from the root to the given node as a list of nodes.
+        :raises KeyError: if the node isn't in the tree"""
+        path = [node]
+        parent = self.get_parent(node)
+        while parent is not None:
+            path.append(parent)
+            parent = self.get_parent(parent)
+        path.reverse()
+        return path
+
+    def __repr__(self):
+        return "MdmtTree(name=%s, root=%s, %d nodes)" % (self.name, self.root, self.number_of_nodes())
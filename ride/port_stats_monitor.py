@@ -0,0 +1,187 @@
+import time
+import logging
+
+from ride.data_path_monitor import DataPathMonitor, DATA_PATH_UP, DATA_PATH_DOWN
+
+log = logging.getLogger(__name__)
+
+
+class PortStatsDataPathMonitor(DataPathMonitor):
+    """
+    Passively infers a DataPath's health from the SDN controller's statistics for the gateway's port towards the
+    cloud rather than (only) actively probing it.  If we keep sending packets out that port without receiving any
+    for max_stall_time, we suspect a failure: we resume active probing immediately so the associated
+    RideCDataPathMonitor (if any) can confirm it or, without a probing monitor, deem the DataPath DOWN ourselves.
+    Without a probing monitor, we deem it UP again when packets are received again; with one, it decides the
+    DataPath's status (see is_data_path_down).
+
+    The port's counters also include other applications' traffic, so they alone can't prove the publishers' traffic
+    gets through.  Hence we only tell the probing monitor to hold off on its probes while responses keep coming in on
+    that port via the publishers' own flow rules (i.e. their packet counters progressing): see flow_rule_filter.
+
+    Status changes go through the same update_link_status() path (i.e. status_change_callback) as the probing monitors.
+    NOTE: when the port is idle (neither counter progressing), we don't infer anything and active probing takes over.
+    """
+
+    def __init__(self, rest_api, switch_id, port, poll_interval=1.0, max_stall_time=3.0, probing_monitor=None,
+                 flow_rule_filter=None, **kwargs):
+        """
+        :param rest_api: used to get the port statistics (see rest_api.onos_api.OnosRestApi.get_statistics())
+        :param switch_id: DPID of the DataPath's gateway
+        :param port: the gateway's port (number) towards the cloud (see RideC.get_data_path_port())
+        :param poll_interval: how often (in seconds) to get the port's statistics
+        :param max_stall_time: how long (in seconds) we can send packets out the port without receiving any before
+         suspecting the DataPath failed; also how long each bit of received traffic suppresses active probing for
+        :param probing_monitor: the DataPath's RideCDataPathMonitor (optional)
+        :type probing_monitor: ride.data_path_monitor.RideCDataPathMonitor
+        :param flow_rule_filter: function returning True for those of the gateway's flow rules (as returned by
+         rest_api.get_flow_rules()) that carry the publishers' traffic; without it we never suppress active probing
+        :param kwargs: passed to super(...)
+        """
+        super(PortStatsDataPathMonitor, self).__init__(**kwargs)
+
+        if poll_interval <= 0:
+            raise ValueError("cannot specify a poll_interval <= 0!! Requested: %f" % poll_interval)
+
+        self.rest_api = rest_api
+        self.switch_id = switch_id
+        self.port = port
+        self.poll_interval = poll_interval
+        self.max_stall_time = max_stall_time
+        self.probing_monitor = probing_monitor
+        self.flow_rule_filter = flow_rule_filter
+
+        # last counter values and when the received one last progressed
+        self._packets_sent = None
+        self._packets_received = None
+        self._last_progress = None
+        # last total of the publishers' flow rules' received packets counters
+        self._flow_packets_received = None
+
+        self._running = False
+
+    @property
+    def is_data_path_down(self):
+        # the probing monitor confirms failures and detects recoveries so its status is the DataPath's
+        if self.probing_monitor is not None:
+            return self.probing_monitor.is_data_path_down
+        return super(PortStatsDataPathMonitor, self).is_data_path_down
+
+    @property
+    def link_status(self):
+        return DATA_PATH_DOWN if self.is_data_path_down else DATA_PATH_UP
+
+    def on_port_statistics(self, stats, now=None):
+        """
+        Updates the DataPath's inferred status according to the latest statistics for our port.
+        :param stats: the port's entry from the controller's port statistics e.g. {'port': 1, 'packetsSent': 100,
+         'packetsReceived': 80, ...}
+        :param now: time (time.time()) the statistics were collected (default=now)
+        :return: the DataPath's status
+        """
+        if now is None:
+            now = time.time()
+        sent = stats['packetsSent']
+        received = stats['packetsReceived']
+
+        # first sample or the counters were reset (e.g. switch restarted)
+        if self._packets_sent is None or sent < self._packets_sent or received < self._packets_received:
+            log.debug("DP %s: (re-)starting port stats for switch %s port %s" % (self.data_path_id, self.switch_id,
+                                                                                self.port))
+            self._packets_sent = sent
+            self._packets_received = received
+            self._last_progress = now
+            return self.link_status
+
+        sent_progress = sent > self._packets_sent
+        received_progress = received > self._packets_received
+        self._packets_sent = sent
+        self._packets_received = received
+
+        if received_progress:
+            self._last_progress = now
+            if self.probing_monitor is None and self.is_data_path_down:
+                log.info("DP %s: traffic received again so it's UP" % self.data_path_id)
+                self.update_link_status(DATA_PATH_UP)
+        elif not sent_progress:
+            # idle: don't treat the time since the last traffic as a stall
+            self._last_progress = now
+        elif now - self._last_progress >= self.max_stall_time and not self.is_data_path_down:
+            log.info("DP %s: no traffic received in %fs despite sending some" % (self.data_path_id,
+                                                                                now - self._last_progress))
+            if self.probing_monitor is not None:
+                self.probing_monitor.resume_probing()
+            else:
+                self.update_link_status(DATA_PATH_DOWN)
+
+        return self.link_status
+
+    def on_flow_statistics(self, flow_rules):
+        """
+        Suppresses the probing monitor's probes if responses were received via the publishers' flow rules since
+        the last time we checked.
+        :param flow_rules: the publishers' flow rules on the gateway (see get_publisher_flow_rules())
+        :return: True if we suppressed probing
+        """
+        received = sum(int(f.get('packets', 0)) for f in flow_rules if self._matches_in_port(f))
+        last_received = self._flow_packets_received
+        self._flow_packets_received = received
+        # NOTE: a decrease means the rules were re-installed (or the counters reset) so we just start over
+        if last_received is None or received <= last_received or self.probing_monitor is None or \
+                self.is_data_path_down:
+            return False
+        self.probing_monitor.suppress_probing(self.max_stall_time)
+        return True
+
+    def _matches_in_port(self, flow_rule):
+        # XXX: this is ONOS-specific like the statistics format (see get_port_statistics())
+        return any(c.get('type') == 'IN_PORT' and str(c.get('port')) == str(self.port)
+                   for c in flow_rule.get('selector', {}).get('criteria', []))
+
+    def get_publisher_flow_rules(self):
+        """Returns the gateway's flow rules that carry the publishers' traffic (see flow_rule_filter)."""
+        return [f for f in self.rest_api.get_flow_rules(self.switch_id) if self.flow_rule_filter(f)]
+
+    def get_port_statistics(self):
+        """Returns our port's entry from the controller's port statistics or None if it's missing."""
+        for device in self.rest_api.get_statistics(self.switch_id):
+            if device['device'] != self.switch_id:
+                continue
+            for port_stats in device['ports']:
+                if str(port_stats['port']) == str(self.port):
+                    return port_stats
+        return None
+
+    def poll(self):
+        """Gets the latest port (and publishers' flow rule) statistics and updates the status accordingly (if we
+        could get them)."""
+        if self.flow_rule_filter is not None and self.probing_monitor is not None:
+            try:
+                self.on_flow_statistics(self.get_publisher_flow_rules())
+            # XXX: see below
+            except Exception as e:
+                log.warning("DP %s: failed to get flow rule statistics: %s" % (self.data_path_id, e))
+
+        try:
+            stats = self.get_port_statistics()
+        # XXX: the REST API could raise many different errors (e.g. controller unreachable, malformed response)
+        except Exception as e:
+            log.warning("DP %s: failed to get port statistics: %s" % (self.data_path_id, e))
+            return self.link_status
+        if stats is None:
+            log.warning("DP %s: no statistics for switch %s port %s" % (self.data_path_id, self.switch_id, self.port))
+            return self.link_status
+        return self.on_port_statistics(stats)
+
+    def run(self):
+        log.info("starting passive monitoring on DataPath %s (switch %s port %s)" % (self.data_path_id,
+                                                                                   self.switch_id, self.port))
+        self._running = True
+        while self._running:
+            start = time.time()
+            self.poll()
+            time.sleep(max(self.poll_interval - (time.time() - start), 0))
+
+    def finish(self):
+        log.info("closing PortStatsDataPathMonitor...")
+        self._running = False
@@ -0,0 +1,170 @@
+# Pluggable estimators of a DataPath's loss rate and RTT used by RideCDataPathMonitor to adapt its probing parameters
+from array import array
+
+
+class LossEstimator(object):
+    """Estimates a DataPath's loss rate from the outcomes of its probes.  Each update is O(1)."""
+
+    def update(self, lost):
+        """Records the outcome of a probe.
+        :param lost: True if the probe timed out, False if it was responded to
+        :return: the new loss rate estimate"""
+        raise NotImplementedError
+
+    @property
+    def loss_rate(self):
+        raise NotImplementedError
+
+
+class SlidingWindowLossEstimator(LossEstimator):
+    """Loss rate over the last window_size probes, which are kept in a ring buffer."""
+
+    def __init__(self, window_size=100):
+        if window_size < 1:
+            raise ValueError("window_size must be positive! Requested: %d" % window_size)
+        self._outcomes = array('B', [0]) * window_size
+        self._next = 0
+        self._nprobes = 0
+        self._nlost = 0
+
+    def update(self, lost):
+        lost = 1 if lost else 0
+        if self._nprobes == len(self._outcomes):
+            # evict the oldest probe's outcome
+            self._nlost -= self._outcomes[self._next]
+        else:
+            self._nprobes += 1
+        self._outcomes[self._next] = lost
+        self._nlost += lost
+        self._next = (self._next + 1) % len(self._outcomes)
+        return self.loss_rate
+
+    @property
+    def loss_rate(self):
+        return float(self._nlost) / self._nprobes if self._nprobes else 0.0
+
+
+class EwmaLossEstimator(LossEstimator):
+    """Exponentially-weighted moving average of the probes' loss (0 or 1) so that recent ones count more.
+    It starts from no loss rather than the first probe's outcome so that losing that probe doesn't mean 100% loss."""
+
+    def __init__(self, alpha=0.95):
+        """
+        :param alpha: weighting factor applied to the previous estimate
+        """
+        self.alpha = alpha
+        self._loss_rate = 0.0
+
+    def update(self, lost):
+        lost = 1.0 if lost else 0.0
+        self._loss_rate = self.alpha * self._loss_rate + (1.0 - self.alpha) * lost
+        return self._loss_rate
+
+    @property
+    def loss_rate(self):
+        return self._loss_rate
+
+
+class RttEstimator(object):
+    """Estimates a DataPath's RTT (and a corresponding probe timeout) from its probes' delays (in ms)."""
+
+    def update(self, delay):
+        """Records the delay of a probe that was responded to and returns the new RTT estimate."""
+        raise NotImplementedError
+
+    @property
+    def rtt(self):
+        raise NotImplementedError
+
+    @property
+    def timeout(self):
+        raise NotImplementedError
+
+
+class EwmaRttEstimator(RttEstimator):
+    """The original RideC estimator: exponentially-weighted moving average of the RTT with timeout = 2 * RTT."""
+
+    def __init__(self, alpha=0.8):
+        """
+        :param alpha: weighting factor applied to the previously estimated RTT
+        """
+        self.alpha = alpha
+        self._rtt = None
+
+    def update(self, delay):
+        if self._rtt is None:
+            self._rtt = delay
+        else:
+            self._rtt = self.alpha * self._rtt + (1.0 - self.alpha) * delay
+        return self._rtt
+
+    @property
+    def rtt(self):
+        return self._rtt
+
+    @property
+    def timeout(self):
+        return 2 * self._rtt
+
+
+class Rfc6298RttEstimator(RttEstimator):
+    """
+    Smoothed RTT and RTT variance as in TCP's retransmission timer (RFC 6298): the timeout is
+    SRTT + max(G, K * RTTVAR) so that it adapts to the RTT's jitter rather than simply being a multiple of it.
+    NOTE: we don't back off the timeout after a timeout as probes aren't retransmitted.
+    """
+
+    def __init__(self, alpha=0.125, beta=0.25, k=4, granularity=1.0, min_timeout=0.0):
+        """
+        :param alpha: gain applied to new RTT samples for SRTT (RFC 6298 recommends 1/8)
+        :param beta: gain applied to new RTT deviations for RTTVAR (RFC 6298 recommends 1/4)
+        :param k: # RTTVARs the timeout allows for
+        :param granularity: clock granularity G (ms)
+        :param min_timeout: lower bound on the timeout (ms); RFC 6298 uses 1s for TCP but we probe more aggressively
+        """
+        self.alpha = alpha
+        self.beta = beta
+        self.k = k
+        self.granularity = granularity
+        self.min_timeout = min_timeout
+        self._srtt = None
+        self._rttvar = None
+
+    def update(self, delay):
+        if self._srtt is None:
+            self._srtt = delay
+            self._rttvar = delay / 2.0
+        else:
+            self._rttvar = (1.0 - self.beta) * self._rttvar + self.beta * abs(self._srtt - delay)
+            self._srtt = (1.0 - self.alpha) * self._srtt + self.alpha * delay
+        return self._srtt
+
+    @property
+    def rtt(self):
+        return self._srtt
+
+    @property
+    def rtt_variance(self):
+        return self._rttvar
+
+    @property
+    def timeout(self):
+        return max(self._srtt + max(self.granularity, self.k * self._rttvar), self.min_timeout)
+
+
+LOSS_ESTIMATORS = {'window': SlidingWindowLossEstimator, 'ewma': EwmaLossEstimator}
+RTT_ESTIMATORS = {'ewma': EwmaRttEstimator, 'rfc6298': Rfc6298RttEstimator}
+
+
+def build_estimator(estimator, estimators):
+    """
+    Returns the estimator specified either as an instance or the name of one of the given estimators (built with
+    its default parameters).  None is returned as is (i.e. use the monitor's default behavior).
+    :param estimators: LOSS_ESTIMATORS or RTT_ESTIMATORS
+    """
+    if isinstance(estimator, basestring):
+        try:
+            return estimators[estimator]()
+        except KeyError:
+            raise ValueError("unrecognized estimator '%s': must be one of %s" % (estimator, estimators.keys()))
+    return estimator
@@ -0,0 +1,93 @@
+# Wire format of the probes RideC's DataPathMonitors send to the echo server
+import struct
+import time
+
+# Binary probes are a fixed-size header: magic, version, type, sequence #, and the monotonic time (ns) it was sent.
+# The echo server returns it with the type changed to RESPONSE (or VERSION_UNSUPPORTED along with the newest version
+# it supports if it doesn't support the probe's version) so the sender can calculate the RTT from its own clock.
+PROBE_MAGIC = 'RP'
+PROBE_VERSION = 1
+PROBE_HEADER = struct.Struct('!2sBBQQ')
+
+PROBE = 0
+RESPONSE = 1
+VERSION_UNSUPPORTED = 2
+
+# Names of the formats a monitor can send probes in: JSON dicts (seq, time_sent in ms) are the original format,
+# which we fall back to if the echo server doesn't support any binary version
+BINARY_PROBE_FORMAT = 'binary'
+JSON_PROBE_FORMAT = 'json'
+PROBE_FORMATS = (BINARY_PROBE_FORMAT, JSON_PROBE_FORMAT)
+
+
+# We need a monotonic clock so that RTTs aren't affected by wall-clock adjustments, but Python 2 doesn't expose one
+if hasattr(time, 'monotonic_ns'):
+    monotonic_ns = time.monotonic_ns
+else:
+    try:
+        import ctypes
+        import ctypes.util
+
+        CLOCK_MONOTONIC = 1  # from <linux/time.h>
+
+        class _Timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        _libc = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True)
+        _clock_gettime = _libc.clock_gettime
+        _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+
+        def monotonic_ns():
+            """Returns the time (in ns) of a monotonic clock with an arbitrary reference point."""
+            ts = _Timespec()
+            if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+                raise OSError(ctypes.get_errno(), "clock_gettime(CLOCK_MONOTONIC) failed")
+            return ts.tv_sec * 1000000000 + ts.tv_nsec
+
+        monotonic_ns()
+    except (ImportError, OSError, AttributeError, TypeError):
+        # e.g. not Linux: fall back to the (non-monotonic) wall clock
+        def monotonic_ns():
+            """Returns the wall-clock time in ns as no monotonic clock is available."""
+            return int(time.time() * 1000000000)
+
+
+def is_binary_probe(data):
+    """Returns True if the raw data is a binary probe (of any version), False if e.g. it's a JSON probe."""
+    return len(data) >= PROBE_HEADER.size and data[:len(PROBE_MAGIC)] == PROBE_MAGIC
+
+
+def pack_probe(seq, time_sent_ns, probe_type=PROBE, version=PROBE_VERSION):
+    """
+    Returns the raw binary probe.
+    :param seq: sequence #
+    :param time_sent_ns: from monotonic_ns()
+    """
+    return PROBE_HEADER.pack(PROBE_MAGIC, version, probe_type, seq, time_sent_ns)
+
+
+def unpack_probe(data):
+    """
+    Parses the binary probe (ignoring anything after the header e.g. from future versions).
+    :return: version, probe_type, seq, time_sent_ns
+    :raises ValueError: if it isn't a binary probe
+    """
+    if not is_binary_probe(data):
+        raise ValueError("not a binary probe: %r" % data[:PROBE_HEADER.size])
+    magic, version, probe_type, seq, time_sent_ns = PROBE_HEADER.unpack_from(data)
+    return version, probe_type, seq, time_sent_ns
+
+
+def make_probe_response(data):
+    """
+    Returns the echo server's response to the raw probe: binary probes of a version we support are echoed back
+    as a RESPONSE and those of newer versions get a VERSION_UNSUPPORTED response stating the version we do support
+    (still with the same seq/time sent so the sender can use it as a response).  Anything else (e.g. JSON probes)
+    is echoed back unchanged.
+    """
+    if not is_binary_probe(data):
+        return data
+    version, probe_type, seq, time_sent_ns = unpack_probe(data)
+    if version > PROBE_VERSION:
+        return pack_probe(seq, time_sent_ns, VERSION_UNSUPPORTED)
+    return pack_probe(seq, time_sent_ns, RESPONSE, version)
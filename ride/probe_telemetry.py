@@ -0,0 +1,278 @@
+# Lightweight metrics about RideCDataPathMonitors' probing for tuning their parameters (e.g. max_detection_time and
+# max_false_positive) against actual probe behavior.  Recording is O(1) per probe so it doesn't slow down the probing
+# loop; snapshots (see RideCDataPathMonitor.get_telemetry_snapshot()) can be read in-process or exported to a file or
+# plain-text HTTP endpoint by a TelemetryExporter.
+import os
+import json
+import time
+import logging
+import tempfile
+from collections import deque
+from threading import Thread
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+log = logging.getLogger(__name__)
+
+# phases each DataPath goes through (see RideCDataPathMonitor.run())
+ESTIMATION_PHASE = 'estimation'
+MONITORING_PHASE = 'monitoring'
+RECOVERY_PHASE = 'recovery'
+
+
+class RttHistogram(object):
+    """
+    HDR-style (log-linear) histogram of RTTs: values are counted in sub_buckets linear buckets per power of 2 (of
+    microseconds) so that its relative error is bounded (< 2 / sub_buckets) across the whole range of RTTs while
+    recording is just an array increment.
+    """
+
+    def __init__(self, sub_bucket_bits=6):
+        """
+        :param sub_bucket_bits: log2(# buckets per power of 2); the default of 6 gives < 3.2% error
+        """
+        self._sub_bucket_bits = sub_bucket_bits
+        self._sub_buckets = 1 << sub_bucket_bits
+        self._half_sub_buckets = self._sub_buckets >> 1
+        self._counts = []
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def _get_index(self, value_us):
+        if value_us < self._sub_buckets:
+            return value_us
+        exponent = value_us.bit_length() - self._sub_bucket_bits
+        return self._sub_buckets + (exponent - 1) * self._half_sub_buckets + (value_us >> exponent) - \
+            self._half_sub_buckets
+
+    def _get_bucket_range(self, index):
+        """Returns the [lower, upper) bounds (in microseconds) of values counted in the bucket."""
+        if index < self._sub_buckets:
+            return index, index + 1
+        exponent = (index - self._sub_buckets) // self._half_sub_buckets + 1
+        mantissa = (index - self._sub_buckets) % self._half_sub_buckets + self._half_sub_buckets
+        return mantissa << exponent, (mantissa + 1) << exponent
+
+    def record(self, rtt):
+        """:param rtt: in ms"""
+        index = self._get_index(max(int(rtt * 1000), 0))
+        if index >= len(self._counts):
+            self._counts.extend([0] * (index + 1 - len(self._counts)))
+        self._counts[index] += 1
+        self.count += 1
+        self.total += rtt
+        if self.min is None or rtt < self.min:
+            self.min = rtt
+        if self.max is None or rtt > self.max:
+            self.max = rtt
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def get_buckets(self):
+        """Returns a list of (lower, upper, count) for the non-empty buckets, where the bounds are in ms."""
+        # NOTE: copy first as the probing thread may be recording at the same time
+        counts = list(self._counts)
+        buckets = []
+        for i, c in enumerate(counts):
+            if c:
+                lower, upper = self._get_bucket_range(i)
+                buckets.append((lower / 1000.0, upper / 1000.0, c))
+        return buckets
+
+    def get_percentile(self, percentile, buckets=None):
+        """
+        Returns the (upper bound of the bucket containing the) given percentile of RTTs (in ms) or None if empty.
+        :param percentile: in range [0, 100]
+        :param buckets: from get_buckets() (default gets them)
+        """
+        if buckets is None:
+            buckets = self.get_buckets()
+        total = sum(c for l, u, c in buckets)
+        if not total:
+            return None
+        target = max(percentile / 100.0 * total, 1)
+        seen = 0
+        for lower, upper, c in buckets:
+            seen += c
+            if seen >= target:
+                return upper
+        return buckets[-1][1]
+
+
+class ProbeTelemetry(object):
+    """Per-DataPath probe metrics: RTT histogram, probe/loss counters, time in each phase, and status transitions."""
+
+    PERCENTILES = (50, 90, 99, 99.9)
+
+    def __init__(self, max_transitions=100):
+        """
+        :param max_transitions: # most recent status transitions to keep
+        """
+        self.rtt_histogram = RttHistogram()
+        self.probes = 0
+        self.responses = 0
+        self.timeouts = 0
+        # time (time.time()) of each of the most recent (transition time, status)
+        self.status_transitions = deque(maxlen=max_transitions)
+
+        self.phase = None
+        self._phase_start = None
+        self._phase_times = dict()  # phase --> total seconds, not including the current phase
+
+    def record_probe(self, delay):
+        """:param delay: the probe's RTT (in ms) or False if it timed out"""
+        self.probes += 1
+        if delay is False:
+            self.timeouts += 1
+        else:
+            self.responses += 1
+            self.rtt_histogram.record(delay)
+
+    def enter_phase(self, phase, now=None):
+        if phase == self.phase:
+            return
+        if now is None:
+            now = time.time()
+        if self.phase is not None:
+            self._phase_times[self.phase] = self._phase_times.get(self.phase, 0) + now - self._phase_start
+        self.phase = phase
+        self._phase_start = now
+
+    def on_status_change(self, status, now=None):
+        if now is None:
+            now = time.time()
+        self.status_transitions.append((now, status))
+
+    def get_phase_times(self, now=None):
+        """Returns a dict of the total time (in seconds) spent in each phase including the current one."""
+        if now is None:
+            now = time.time()
+        phase_times = dict(self._phase_times)
+        phase, start = self.phase, self._phase_start
+        if phase is not None:
+            phase_times[phase] = phase_times.get(phase, 0) + now - start
+        return phase_times
+
+    def snapshot(self, now=None):
+        """Returns the current metrics as a JSON-serializable dict."""
+        if now is None:
+            now = time.time()
+        buckets = self.rtt_histogram.get_buckets()
+        return dict(time=now, probes=self.probes, responses=self.responses, timeouts=self.timeouts,
+                    loss_rate=float(self.timeouts) / self.probes if self.probes else 0.0,
+                    rtt=dict(count=self.rtt_histogram.count, min=self.rtt_histogram.min, max=self.rtt_histogram.max,
+                             mean=self.rtt_histogram.mean,
+                             percentiles={str(p): self.rtt_histogram.get_percentile(p, buckets)
+                                          for p in self.PERCENTILES},
+                             buckets=buckets),
+                    phase=self.phase, phase_times=self.get_phase_times(now),
+                    status_transitions=list(self.status_transitions))
+
+
+def format_snapshots_text(snapshots):
+    """
+    Formats the monitors' snapshots as plain text (in the Prometheus exposition format) e.g. for a text endpoint.
+    :param snapshots: dict of data_path_id --> RideCDataPathMonitor.get_telemetry_snapshot()
+    """
+    lines = []
+
+    def add(name, dp, value, **labels):
+        if value is None:
+            return
+        labels['data_path'] = dp
+        lines.append('ride_c_%s{%s} %s' % (name, ','.join('%s="%s"' % (k, v) for k, v in sorted(labels.items())),
+                                           value))
+
+    for dp, s in sorted(snapshots.items()):
+        for counter in ('probes', 'responses', 'timeouts', 'loss_rate', 'link_loss', 'detection_window_size',
+                        'sending_interval', 'timeout', 'status'):
+            add(counter, dp, s.get(counter))
+        for stat in ('count', 'min', 'max', 'mean'):
+            add('rtt_ms_%s' % stat, dp, s['rtt'][stat])
+        for p, value in sorted(s['rtt']['percentiles'].items(), key=lambda x: float(x[0])):
+            add('rtt_ms', dp, value, quantile=float(p) / 100)
+        # cumulative buckets as in Prometheus histograms
+        cumulative = 0
+        for lower, upper, count in s['rtt']['buckets']:
+            cumulative += count
+            add('rtt_ms_bucket', dp, cumulative, le=upper)
+        for phase, t in sorted(s['phase_times'].items()):
+            add('phase_seconds', dp, t, phase=phase)
+        if s['status_transitions']:
+            add('last_status_change_time', dp, s['status_transitions'][-1][0])
+    return '\n'.join(lines) + '\n'
+
+
+class TelemetryExporter(object):
+    """Periodically writes the monitors' telemetry snapshots to a file (JSON or text) and/or serves them as text
+    over HTTP.  Everything happens in its own threads so the probing loops aren't affected."""
+
+    def __init__(self, monitors, filename=None, interval=10, text_format=False, http_port=None):
+        """
+        :param monitors: the RideCDataPathMonitors to export telemetry of
+        :param filename: file to (atomically) overwrite with the latest snapshots every interval seconds
+        :param text_format: write the file in the text format (see format_snapshots_text()) rather than JSON
+        :param http_port: serve the latest snapshots as text at any path on this port
+        """
+        self.monitors = monitors
+        self.filename = filename
+        self.interval = interval
+        self.text_format = text_format
+        self.http_port = http_port
+
+        self._running = False
+        self._http_server = None
+
+    def get_snapshots(self):
+        return {m.data_path_id: m.get_telemetry_snapshot() for m in self.monitors}
+
+    def write_snapshots(self):
+        """Writes the current snapshots to our file, replacing it atomically so readers never see a partial one."""
+        snapshots = self.get_snapshots()
+        data = format_snapshots_text(snapshots) if self.text_format else json.dumps(snapshots, indent=2)
+        dirname = os.path.dirname(os.path.abspath(self.filename))
+        fd, tmp_filename = tempfile.mkstemp(dir=dirname, prefix='.telemetry')
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+        os.rename(tmp_filename, self.filename)
+
+    def run(self):
+        self._running = True
+        if self.http_port is not None:
+            self._http_server = HTTPServer(('', self.http_port), self._make_request_handler())
+            t = Thread(target=self._http_server.serve_forever)
+            t.daemon = True
+            t.start()
+
+        while self._running and self.filename is not None:
+            try:
+                self.write_snapshots()
+            except (IOError, OSError) as e:
+                log.error("failed to write telemetry snapshot to %s: %s" % (self.filename, e))
+            time.sleep(self.interval)
+
+    def _make_request_handler(self):
+        exporter = self
+
+        class _TelemetryRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                data = format_snapshots_text(exporter.get_snapshots())
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                log.debug("telemetry request: " + format % args)
+
+        return _TelemetryRequestHandler
+
+    def finish(self):
+        self._running = False
+        if self._http_server is not None:
+            self._http_server.shutdown()
+            self._http_server.server_close()
@@ -1,7 +1,10 @@
 # Resilient IoT Data Exchange - Collection middleware
 import logging
+import hashlib
+import math
 
 from ride.data_path_monitor import DATA_PATH_UP, DATA_PATH_DOWN
+from ride.port_stats_monitor import PortStatsDataPathMonitor
 from config import *
 
 import topology_manager
@@ -29,8 +32,12 @@ class RideC(object):
     instance specified in __init__
     """
 
+    DATA_PATH_ASSIGNMENT_POLICIES = ('balanced', 'priority')
+    MULTI_SOURCE_PATHS_ALGORITHMS = ('flow', 'greedy')
+
     def __init__(self, edge_server=None, cloud_server=None, topology_mgr='onos',
-                 reroute_policy=DEFAULT_REROUTE_POLICY, distance_metric=DISTANCE_METRIC, **kwargs):
+                 reroute_policy=DEFAULT_REROUTE_POLICY, distance_metric=DISTANCE_METRIC,
+                 assignment_policy=DEFAULT_DATA_PATH_ASSIGNMENT_POLICY, multi_source_paths_algorithm='flow', **kwargs):
         """
         :param edge_server: DPID of the managed edge server
         :param cloud_server: DPID of the managed cloud server
@@ -41,6 +48,11 @@ class RideC(object):
         can be one of: 'disjoint' (default; choose maximally-disjoint shortish paths), 'shortest' (regular shortest paths)
         :param distance_metric: the distance metric determines the length of the paths used when managing
          routing in the local network since these paths are chosen to be minimal (default='latency')
+        :param assignment_policy: how to assign hosts to DataPaths: 'priority' (default; all on the available one with
+        the lowest ID) or 'balanced' (spread them across the available ones according to their capacity and measured
+        RTT/loss: see _choose_data_path() and register_data_path_monitor())
+        :param multi_source_paths_algorithm: how to compute the 'disjoint' reroute_policy's paths: 'flow' (default;
+        min-cost flow) or 'greedy' (scales to many more hosts): see SdnTopology.get_multi_source_disjoint_paths()
         :param kwargs: ignored (just present so we can pass args from other classes without causing errors)
         """
         # XXX: even though we KNOW an object takes no __init__ args, multiple inheritance may cause us to need
@@ -83,6 +95,19 @@ class RideC(object):
 
         self._distance_metric = distance_metric
         self._reroute_policy = reroute_policy
+        if assignment_policy not in self.DATA_PATH_ASSIGNMENT_POLICIES:
+            raise ValueError("unrecognized assignment_policy '%s': must be one of %s" %
+                             (assignment_policy, self.DATA_PATH_ASSIGNMENT_POLICIES))
+        self._assignment_policy = assignment_policy
+        if multi_source_paths_algorithm not in self.MULTI_SOURCE_PATHS_ALGORITHMS:
+            raise ValueError("unrecognized multi_source_paths_algorithm '%s': must be one of %s" %
+                             (multi_source_paths_algorithm, self.MULTI_SOURCE_PATHS_ALGORITHMS))
+        self._multi_source_paths_algorithm = multi_source_paths_algorithm
+
+        # used to weight DataPaths when assigning hosts to them
+        self._data_path_capacity = dict()     # DP --> capacity (relative to the others)
+        self._data_path_metrics = dict()      # DP --> (RTT in ms, loss rate); either may be None if unknown
+        self._data_path_monitors = dict()     # DP --> RideCDataPathMonitor we get these metrics from
 
         # Save the switches currently holding redirection flow rules so we can delete them later upon recovery.
         self.__redirecting_switches = set()
@@ -140,18 +165,79 @@ class RideC(object):
     def _choose_data_path(self, host_address=None):
         """
         Choose a DataPath from those currently up that's well-suited for the specified host.
-        Currently, we just choose the 'highest priority' (as determined by DataPathID order low-to-high) DataPath
-        that is currently functional.
-        :param host_address: optional and currently ignored
+        With the 'priority' assignment_policy (or no host specified), we just choose the 'highest priority' (as
+        determined by DataPathID order low-to-high) DataPath that is currently functional.
+
+        With the 'balanced' policy, we spread hosts across the available DataPaths in proportion to their weights
+        (see _get_data_path_weight()) using weighted rendezvous (highest random weight) hashing: each host ranks the
+        DataPaths by a hash of (host, DataPath) scaled by the weight and picks the top one that's up.  This is a form
+        of consistent hashing so a DataPath going down only moves its own hosts (to their next-ranked ones) and its
+        recovery only moves those back (plus any others that now rank it first: see _recover_data_path()).
+        :param host_address: the host to choose one for
         :return:
         """
         dp_choices = [dp for dp in self.data_paths if self.is_data_path_up(dp)]
         # TODO: how to handle none being available??? random choice? random.choice(self.data_paths)
-        dp_choices = sorted(dp_choices)
-        chosen_dp = dp_choices[0]
+        if self._assignment_policy == 'priority' or host_address is None:
+            chosen_dp = sorted(dp_choices)[0]
+        else:
+            chosen_dp = max(sorted(dp_choices), key=lambda dp: self._get_data_path_score(host_address, dp))
         log.debug("assigning host %s to DP %s" % (host_address, chosen_dp))
         return chosen_dp
 
+    def _get_data_path_score(self, host_address, data_path_id):
+        """Returns the host's weighted rendezvous hashing score for the DataPath (see _choose_data_path())."""
+        # NOTE: we need a hash that's stable across processes (unlike hash()) so assignments are reproducible
+        digest = hashlib.md5(repr((host_address, data_path_id))).hexdigest()
+        # uniform in (0, 1)
+        h = (int(digest[:16], 16) + 1.0) / (2 ** 64 + 1)
+        return -self._get_data_path_weight(data_path_id) / math.log(h)
+
+    def _get_data_path_weight(self, data_path_id):
+        """
+        Returns the DataPath's weight for assigning hosts to it: its capacity scaled down by its measured loss rate
+        and RTT (relative to the best DataPath's).  DataPaths with unknown RTT are treated as having the best one.
+        """
+        rtt, loss = self._data_path_metrics.get(data_path_id, (None, None))
+        known_rtts = [r for r, l in self._data_path_metrics.values() if r]
+        weight = self._data_path_capacity.get(data_path_id, 1.0)
+        if rtt and known_rtts:
+            weight *= min(known_rtts) / float(rtt)
+        if loss is not None:
+            # XXX: don't totally exclude a lossy DataPath as it's still UP
+            weight *= max(1.0 - loss, 0.01)
+        return weight
+
+    def update_data_path_metrics(self, data_path_id, rtt=None, loss_rate=None):
+        """
+        Updates the DataPath's measured characteristics used to weight host assignments, which only take effect for
+        hosts (re)assigned afterwards e.g. due to a DataPath failing/recovering.
+        NOTE: those of DataPaths with a registered monitor are updated automatically (see register_data_path_monitor())
+        :param rtt: in ms e.g. from its RideCDataPathMonitor's get_telemetry_snapshot()['rtt_estimate']
+        :param loss_rate: in range [0, 1] e.g. from its RideCDataPathMonitor's get_telemetry_snapshot()['link_loss']
+        """
+        if data_path_id not in self._data_path_status:
+            raise ValueError("DataPath %s not registered!" % data_path_id)
+        self._data_path_metrics[data_path_id] = (rtt, loss_rate)
+
+    def register_data_path_monitor(self, data_path_id, monitor):
+        """
+        Registers the (probing) monitor of the specified DataPath so that its measured RTT and loss rate weight the
+        host assignments (see _get_data_path_weight()).  We pull its latest measurements whenever we're about to
+        (re)assign hosts i.e. when registering one or when a DataPath's status changes.
+        :type monitor: ride.data_path_monitor.RideCDataPathMonitor
+        :raises ValueError: if the DataPath isn't registered
+        """
+        if data_path_id not in self._data_path_status:
+            raise ValueError("DataPath %s not registered!" % data_path_id)
+        self._data_path_monitors[data_path_id] = monitor
+
+    def pull_data_path_metrics(self):
+        """Updates the DataPaths' metrics from their registered monitors' telemetry (see get_telemetry_snapshot())."""
+        for data_path_id, monitor in self._data_path_monitors.items():
+            snapshot = monitor.get_telemetry_snapshot()
+            self.update_data_path_metrics(data_path_id, rtt=snapshot['rtt_estimate'], loss_rate=snapshot['link_loss'])
+
     ## the main public API: control, registration and notification functions
 
     def update(self):
@@ -188,6 +274,7 @@ class RideC(object):
             return
 
         self._data_path_status[data_path_id] = status
+        self.pull_data_path_metrics()
         if status == DATA_PATH_DOWN:
             if self.available_data_paths:
                 self._failover_data_path(data_path_id)
@@ -200,12 +287,13 @@ class RideC(object):
 
     # ENHANCE: unregister versions of these?
 
-    def register_data_path(self, data_path_id, gateway_id, cloud_id):
+    def register_data_path(self, data_path_id, gateway_id, cloud_id, capacity=1.0):
         """
         Registers the specified DataPath under RideC's management.
         :param data_path_id: a unique ID representing this DataPath
         :param gateway_id: DPID of the local gateway that this DataPath passes through (originates at)
         :param cloud_id: DPID of the cloud server that this DataPath terminates at
+        :param capacity: relative capacity (e.g. uplink bandwidth) for weighting how many hosts are assigned to it
         :return:
         :raises ValueError: if data_path_id is already registered or gateway_id is not found in the topology
         """
@@ -216,11 +304,43 @@ class RideC(object):
             raise ValueError("DataPath with id %s already registered!  We do not currently support updating it..." % data_path_id)
         assert cloud_id == self.cloud_server, "cloud_id specified that isn't the same as our cloud_server!  this is not yet supported..."
 
+        if capacity <= 0:
+            raise ValueError("DataPath capacity must be positive! Requested: %s" % capacity)
+
         self._data_path_status[data_path_id] = DATA_PATH_UP
         self._gateway_for_data_path[data_path_id] = gateway_id
+        self._data_path_capacity[data_path_id] = capacity
         # ENHANCE: implement this, which might include calling some remote node's API to start up a probe to this cloud...
         # self._cloud_for_data_path = cloud_id
 
+    def get_data_path_port(self, data_path_id):
+        """Returns the port # of the DataPath's gateway on its route to the cloud server."""
+        gateway = self._gateway_for_data_path[data_path_id]
+        route = self.topology_manager.get_path(gateway, self.cloud_server)
+        return self.topology_manager.get_ports_for_nodes(route[0], route[1])[0]
+
+    def build_port_stats_monitor(self, data_path_id, probing_monitor=None, **kwargs):
+        """
+        Builds a monitor that passively infers the specified (registered) DataPath's status from the controller's
+        statistics for its gateway's port and notifies us of changes; call its run() to start it.
+        :param probing_monitor: the DataPath's RideCDataPathMonitor, whose probing it suppresses while the registered
+         publishers' traffic shows the DataPath is healthy
+        :param kwargs: passed to PortStatsDataPathMonitor
+        :rtype: PortStatsDataPathMonitor
+        """
+        kwargs.setdefault('flow_rule_filter', self._is_publisher_flow_rule)
+        return PortStatsDataPathMonitor(self.topology_manager.rest_api, self._gateway_for_data_path[data_path_id],
+                                        self.get_data_path_port(data_path_id), probing_monitor=probing_monitor,
+                                        data_path_id=data_path_id,
+                                        status_change_callback=self.on_data_path_status_change, **kwargs)
+
+    def _is_publisher_flow_rule(self, flow_rule):
+        """Returns True if the (controller's) flow rule matches traffic from/to a registered publisher."""
+        # XXX: these are ONOS api-specific details of the flow rules (see also clear_redirection_flows())
+        ips = set('%s/32' % self._get_host_ip_address(h) for h in self.hosts)
+        return any(c.get('type') in ('IPV4_SRC', 'IPV4_DST') and c.get('ip') in ips
+                   for c in flow_rule.get('selector', {}).get('criteria', []))
+
     # ENHANCE: should accept
     def register_host(self, host_address, use_data_path=None):
         """
@@ -249,6 +369,7 @@ class RideC(object):
             raise ValueError("host %s already registered!  We currently do not support updating registrations..." % host_address)
 
         if use_data_path is None:
+            self.pull_data_path_metrics()
             use_data_path = self._choose_data_path(host_address)
 
         self._data_path_for_host[host_address] = use_data_path
@@ -319,7 +440,10 @@ class RideC(object):
         Reacts to the specified DataPath recovering by recomputing host assignments and possibly updating them if
         they're assigned to a different (possibly this newly-recovered) DataPath.  Note that we also have to remove
         any flow rules doing redirection here so that they don't prevent communication with the primary data sink (cloud).
-        :param data_path: currently ignored
+        With the 'balanced' assignment_policy, hosts on a DataPath that's still up only move if they now choose the
+        recovered one: the weights may have drifted since their assignment and we don't want to shuffle hosts
+        between DataPaths that never changed state.
+        :param data_path: the recovered DataPath
         :return:
         """
 
@@ -329,7 +453,11 @@ class RideC(object):
 
         for h in self.hosts:
             old_dp = self._data_path_for_host[h]
-            new_dp = self._data_path_for_host[h] = self._choose_data_path(h)
+            new_dp = self._choose_data_path(h)
+            if self._assignment_policy == 'balanced' and old_dp is not None and self.is_data_path_up(old_dp) \
+                    and new_dp != data_path:
+                continue
+            self._data_path_for_host[h] = new_dp
             if old_dp is None or old_dp != new_dp:
                 self._update_host_route(h)
 
@@ -356,7 +484,8 @@ class RideC(object):
             # flows take the same path, though in the future we may want to assign different paths for different flows...
             host_dpids = set(self.get_host_dpid(h) for h in self.hosts)
             # ENHANCE: pre-compute these for faster re-route
-            routes = {p[0]: p for p in self.topology_manager.get_multi_source_disjoint_paths(host_dpids, new_dest, weight=self._distance_metric)}
+            routes = {p[0]: p for p in self.topology_manager.get_multi_source_disjoint_paths(host_dpids, new_dest, weight=self._distance_metric,
+                                                                                                algorithm=self._multi_source_paths_algorithm)}
             assert list(sorted(routes.keys())) == list(sorted(host_dpids)), "not all hosts accounted for in disjoint paths!" \
                                                                             " Got: %s\nMissing: %s" % (routes, set(host_dpids) - set(routes.keys()))
 
@@ -15,6 +15,8 @@ import networkx as nx
 import topology_manager
 from ride.config import MULTICAST_FLOW_RULE_PRIORITY
 from stt_manager import SttManager
+from mdmt_cache import MdmtCache
+from mdmt_tree import MdmtTree, NodeIndex
 from topology_manager.sdn_topology import SdnTopology
 
 import logging
@@ -55,7 +57,9 @@ class RideD(object):
     MDMT_SELECTION_POLICIES = (MAX_OVERLAPPING_LINKS, MIN_MISSING_LINKS, MAX_REACHABLE_SUBSCRIBERS, MAX_LINK_IMPORTANCE)
 
     def __init__(self, topology_mgr, dpid, addresses, ntrees=2, tree_choosing_heuristic=MAX_LINK_IMPORTANCE,
-                 tree_construction_algorithm=('red-blue',), alert_sending_callback=None, max_retries=None, **kwargs):
+                 tree_construction_algorithm=('red-blue',), alert_sending_callback=None, max_retries=None,
+                 nprocesses=None, reduce_topology=False, mdmt_cache_size=0, mdmt_cache_dir=None, repair_mdmts=False,
+                 aggregate_subscribers=False, hierarchical_mdmts=False, merge_flow_rules=False, **kwargs):
         """
         :param SdnTopology|str topology_mgr: used as adapter to SDN controller for
          maintaining topology and multicast tree information
@@ -85,6 +89,24 @@ class RideD(object):
             be locked when it's called so be careful accessing it or you might deadlock!
         :param max_retries: number of times sending an alert will be retried (using a different MDMT each time).
             default=2*ntrees
+        :param nprocesses: if > 1, number of worker processes used to construct MDMTs in parallel (only supported by
+            some construction algorithms e.g. red-blue); default builds them serially.  Call finish() to stop them.
+        :param reduce_topology: if True, MDMTs are constructed on a reduced version of the topology (non-subscriber
+            leaves removed and degree-2 chains contracted) and then expanded back to the full topology
+        :param aggregate_subscribers: if True, MDMTs are constructed to reach the subscribers' edge switches and then
+            fan out to the subscribers themselves, which makes construction time depend on # edge switches not # hosts
+        :param hierarchical_mdmts: if True, MDMTs are constructed on only the topology's core (e.g. core/building
+            routers) and composed with the cached routes through e.g. buildings to reach the subscribers
+        :param mdmt_cache_size: # entries in the in-memory MDMT cache, which lets us re-use MDMTs when neither the
+            topology nor a topic's subscribers changed (see MdmtCache); 0 (default) disables it unless mdmt_cache_dir
+            is set
+        :param mdmt_cache_dir: if specified, MDMTs are also cached in files in this directory so they can be re-used
+            after restarting
+        :param repair_mdmts: if True, update() repairs only the MDMTs affected by failed links/nodes (see repair_mdmts())
+            rather than rebuilding all of them
+        :param merge_flow_rules: if True, the flow rules of all topics' MDMTs are compiled together so that those
+            with identical actions at a switch are merged into ones matching an address prefix and sharing a group
+            (see SdnTopology.build_flow_rules_from_multicast_trees()), which reduces the switches' flow table usage
         :param kwargs: ignored (just present so we can pass args from other classes without causing errors)
         """
         super(RideD, self).__init__()
@@ -123,10 +145,23 @@ class RideD(object):
         self.choosing_heuristic = tree_choosing_heuristic
         self.construction_algorithm = tree_construction_algorithm[0]
         self.const_args = tree_construction_algorithm[1:]
-
-        # maps topic IDs to MDMTs, which are NetworkX graphs having an
-        # attribute storing the address (IPv4?) of that tree
+        self.nprocesses = nprocesses
+        self.reduce_topology = reduce_topology
+        self.aggregate_subscribers = aggregate_subscribers
+        self.hierarchical_mdmts = hierarchical_mdmts
+        self.repair_mdmts_on_update = repair_mdmts
+        self.merge_flow_rules = merge_flow_rules
+        self.mdmt_cache = None
+        if mdmt_cache_size or mdmt_cache_dir is not None:
+            self.mdmt_cache = MdmtCache(max_entries=mdmt_cache_size, cache_dir=mdmt_cache_dir)
+
+        # maps topic IDs to MDMTs, which are compact MdmtTrees (see compact_mdmts()) storing the address
+        # (IPv4?) of that tree; NetworkX graphs having an 'address' graph attribute are also accepted
         self.mdmts = {}
+        # maps MDMT addresses to the (groups, flow rules) last installed for them
+        self._installed_mdmt_rules = {}
+        # (groups, flow rules) last installed for all MDMTs when merging their flow rules
+        self._installed_merged_rules = ([], [])
 
         # maps publishers to the network routes their packets take to get here
         self.publisher_routes = {}
@@ -159,6 +194,33 @@ class RideD(object):
                                 dest='tree_construction_algorithm',
                                 help='''heuristic algorithm for building multicast trees.  First arg is the heuristic
                                 name; all others are passed as args to the heuristic. (default=%(default)s)''')
+        arg_parser.add_argument('--nprocesses', type=int, default=None,
+                                help='''number of worker processes used to construct the multicast trees in parallel
+                                (only supported by some construction algorithms e.g. red-blue).
+                                (default=%(default)s, which builds them serially)''')
+        arg_parser.add_argument('--reduce-topology', action='store_true', dest='reduce_topology',
+                                help='''construct the multicast trees on a reduced topology with non-subscriber leaves
+                                removed and degree-2 chains contracted before expanding them back (default=%(default)s)''')
+        arg_parser.add_argument('--aggregate-subscribers', action='store_true', dest='aggregate_subscribers',
+                                help='''construct the multicast trees to reach the subscribers' edge switches and then
+                                fan out to the subscribers from there (default=%(default)s)''')
+        arg_parser.add_argument('--hierarchical-mdmts', action='store_true', dest='hierarchical_mdmts',
+                                help='''construct the multicast trees on only the topology's core and compose them with
+                                the (cached) routes through the subtrees (e.g. buildings) hanging off of it to reach
+                                the subscribers (default=%(default)s)''')
+        arg_parser.add_argument('--mdmt-cache-size', type=int, default=0,
+                                help='''number of entries in the in-memory cache of multicast trees, which are re-used
+                                when neither the topology nor subscribers change; 0 disables it (default=%(default)s)''')
+        arg_parser.add_argument('--mdmt-cache-dir', default=None,
+                                help='''directory in which to also cache multicast trees on disk for re-use after
+                                restarting or across experiment runs (default=%(default)s)''')
+        arg_parser.add_argument('--repair-mdmts', action='store_true', dest='repair_mdmts',
+                                help='''on update, repair only the multicast trees affected by failed links/nodes
+                                rather than rebuilding them all (default=%(default)s)''')
+        arg_parser.add_argument('--merge-flow-rules', action='store_true', dest='merge_flow_rules',
+                                help='''compile the flow rules of all multicast trees together, merging those with
+                                identical actions at a switch into rules matching an address prefix that share a group
+                                in order to reduce flow table usage (default=%(default)s)''')
         arg_parser.add_argument('--choosing-heuristic', '-c', default=cls.MAX_LINK_IMPORTANCE, dest='tree_choosing_heuristic',
                                 help='''multicast tree choosing heuristic to use (default=%(default)s)''')
 
@@ -190,14 +252,52 @@ class RideD(object):
 
     @staticmethod
     def get_address_for_mdmt(mdmt):
+        if isinstance(mdmt, MdmtTree):
+            return mdmt.address
         return mdmt.graph['address']
 
     @staticmethod
     def set_address_for_mdmt(mdmt, address):
-        mdmt.graph['address'] = address
+        if isinstance(mdmt, MdmtTree):
+            mdmt.address = address
+        else:
+            mdmt.graph['address'] = address
         # Also set the name so we can easily and uniquely identify the MDMT
         mdmt.name = address
 
+    @staticmethod
+    def get_mdmt_graph(mdmt):
+        """
+        Returns a networkx view of the MDMT for the few operations that need one (e.g. compiling its flow rules).
+        :param mdmt: either an MdmtTree (as RideD stores them) or an nx.Graph (returned as is)
+        :rtype: nx.Graph
+        """
+        if isinstance(mdmt, MdmtTree):
+            return mdmt.to_networkx()
+        return mdmt
+
+    def compact_mdmts(self, mdmts):
+        """
+        Converts the MDMTs (e.g. as returned by build_mdmts()) to the compact MdmtTree representation RideD stores
+        them in.  All of them share the same index of the topology's nodes.
+        :param mdmts: dict mapping topics to their list of MDMTs (nx.Graph)
+        :return: dict mapping topics to their list of MdmtTrees
+        """
+        node_index = NodeIndex(self.topology_manager.topo.nodes())
+        source = self.get_server_id()
+        return {topic: [MdmtTree.from_graph(t, source, self.subscribers.get(topic, []), node_index) for t in trees]
+                for topic, trees in mdmts.items()}
+
+    def _replace_mdmts(self, old_mdmts, new_trees, changed, topic):
+        """Returns a copy of old_mdmts with those at the indices in changed replaced by (compact versions of) the
+        corresponding ones of new_trees, which are nx.Graphs as returned by e.g. repair_multicast_trees()."""
+        mdmts = list(old_mdmts)
+        subs = self.subscribers.get(topic, [])
+        for i in changed:
+            node_index = old_mdmts[i].node_index if isinstance(old_mdmts[i], MdmtTree) else None
+            mdmts[i] = MdmtTree.from_graph(new_trees[i], self.get_server_id(), subs, node_index)
+        return mdmts
+
     def get_server_id(self):
         """
         Returns the ID of the server for use with the topology manager.
@@ -302,7 +402,10 @@ class RideD(object):
         """
 
         # determine the path used by this response and notify RideD that it is currently functional
-        route = nx.shortest_path(mdmt_used, self.get_server_id(), responder)
+        if isinstance(mdmt_used, MdmtTree):
+            route = mdmt_used.get_path(responder)
+        else:
+            route = nx.shortest_path(mdmt_used, self.get_server_id(), responder)
         log.debug("processing alert response via route: %s" % route)
 
         # NOTE: this likely won't do much as we probably already selected this MDMT since this route was functional...
@@ -338,13 +441,14 @@ class RideD(object):
 
         root = self.get_server_id()
         mdmts = alert_context.mdmts
+        graphs = [self.get_mdmt_graph(t) for t in mdmts]
 
         # To only consider branches of the MDMTs used for unreached subscribers, we need to trim them down.
         # IDEA: we compute 'importance' with only a subset of the subscribers (unreached ones), trim off any edges
         # with 0 importance, and use the resulting tree as both the MDMTs and also the importance graph
         if len(subscribers) < len(alert_context.subscribers):
             trees = []
-            for tree in mdmts:
+            for tree in graphs:
                 tree = self.get_importance_graph(tree, subscribers, root)
 
                 tree.remove_edges_from([(u, v) for u, v, imp in tree.edges(data=self.IMPORTANCE_ATTRIBUTE_NAME) if (imp == 0)])
@@ -354,9 +458,9 @@ class RideD(object):
         # None reached yet, so no need to trim...
         # BUT, ensure we've calculated the importance if that's the metric we're using!
         elif heuristic == self.MAX_LINK_IMPORTANCE:
-            trees = [self.get_importance_graph(tree, subscribers, root) for tree in mdmts]
+            trees = [self.get_importance_graph(tree, subscribers, root) for tree in graphs]
         else:
-            trees = mdmts
+            trees = graphs
 
         # ENHANCE: could try using nx.intersection(G,H) but it requires the same nodes
         stt_set = self.stt_mgr.get_stt_edges()
@@ -569,17 +673,36 @@ class RideD(object):
         source = self.get_server_id()
         mdmts = dict()
 
+        topo = self.topology_manager.topo
+        if self.mdmt_cache is not None:
+            topo_fingerprint = self.mdmt_cache.get_topology_fingerprint(topo)
+
         for topic, subs in subscribers.items():
             # XXX: ensure all subscribers are present in the topology to prevent e.g. KeyErrors from the various algorithms
-            subs = [s for s in subs if s in self.topology_manager.topo]
+            subs = [s for s in subs if s in topo]
             # TODO: check for reachability?  log error if they aren't available?
 
-            # ENHANCE: include weight?
-            trees = self.topology_manager.get_redundant_multicast_trees(
-                source, subs, self.ntrees, algorithm=self.construction_algorithm, heur_args=self.const_args)
+            trees = cache_key = None
+            if self.mdmt_cache is not None:
+                cache_key = self.mdmt_cache.make_key(topo_fingerprint, source, subs, self.construction_algorithm,
+                                                     self.const_args, self.ntrees, self.reduce_topology,
+                                                     self.aggregate_subscribers, self.hierarchical_mdmts)
+                trees = self.mdmt_cache.get(cache_key, topo)
+
+            if trees is None:
+                # ENHANCE: include weight?
+                trees = self.topology_manager.get_redundant_multicast_trees(
+                    source, subs, self.ntrees, algorithm=self.construction_algorithm, heur_args=self.const_args,
+                    nprocesses=self.nprocesses, reduce_topology=self.reduce_topology,
+                    aggregate_destinations=self.aggregate_subscribers, hierarchical=self.hierarchical_mdmts)
+                if cache_key is not None:
+                    self.mdmt_cache.put(cache_key, trees)
 
             mdmts[topic] = trees
 
+        if self.mdmt_cache is not None:
+            log.debug("MDMT cache stats: %s" % self.mdmt_cache.get_stats())
+
         return mdmts
 
     def install_mdmts(self, mdmts, address_pool=None):
@@ -588,7 +711,7 @@ class RideD(object):
         Also sets the IP addresses of the MDMTs from those specified (or self.address_pool if unspecified)
         WARNING: the IP addresses of the mdmts must be routable by the host!  Make sure
         you add them e.g. "ip route add 224.0.0.0/4 dev eth0"
-        :param List[nx.Graph] mdmts:
+        :param List[MdmtTree|nx.Graph] mdmts:
         :param List[str] address_pool: list of network addresses from which to assign the MDMTs their addresses.  Note
         that they must have the same length!  default=self.address_pool
         """
@@ -611,13 +734,7 @@ class RideD(object):
         for i, t, address in zip(range(len(mdmts)), mdmts, address_pool):
             self.set_address_for_mdmt(t, address)
             log.debug("Installing MDMT for address %s" % str(address))
-            matches = self.build_flow_matches_from_address(address)
-            # XXX: we need to include the UDP port so that hosts' responses can be routed via different MDMTs
-            response_matching = {"udp_dst": address[1]}
-            groups, flow_rules = self.topology_manager.build_flow_rules_from_multicast_tree(t, self.dpid, matches,
-                                                                                            group_id=i+10,
-                                                                                            priority=MULTICAST_FLOW_RULE_PRIORITY,
-                                                                                            route_responses=response_matching)
+            groups, flow_rules = self._build_mdmt_flow_rules(i, t, address)
             for g in groups:
                 # log.debug("Installing group: %s" % self.topology_manager.rest_api.pretty_format_parsed_response(g))
                 res = self.topology_manager.install_group(g)
@@ -631,6 +748,202 @@ class RideD(object):
         if not self.topology_manager.install_flow_rules(flows):
             log.error("Problem installing flow rules: %s" % flows)
 
+    def _build_mdmt_flow_rules(self, index, mdmt, address):
+        """
+        Builds the groups and flow rules for the given MDMT and records them as installed for its address.
+        :param index: index of the MDMT within its topic's list of MDMTs (determines its group ID)
+        :return: groups, flow_rules
+        """
+        matches = self.build_flow_matches_from_address(address)
+        # XXX: we need to include the UDP port so that hosts' responses can be routed via different MDMTs
+        response_matching = {"udp_dst": address[1]}
+        groups, flow_rules = self.topology_manager.build_flow_rules_from_multicast_tree(self.get_mdmt_graph(mdmt),
+                                                                                        self.dpid, matches,
+                                                                                        group_id=index+10,
+                                                                                        priority=MULTICAST_FLOW_RULE_PRIORITY,
+                                                                                        route_responses=response_matching)
+        self._installed_mdmt_rules[address] = (groups, flow_rules)
+        return groups, flow_rules
+
+    def install_merged_mdmts(self):
+        """
+        Like install_mdmts(), but for all topics' MDMTs at once with their flow rules merged wherever several MDMTs
+        have identical actions at a switch (see merge_flow_rules option).  The MDMTs are assigned addresses from
+        self.address_pool as in install_mdmts().
+        """
+
+        for topic, mdmts in self.mdmts.items():
+            if len(self.address_pool) < len(mdmts):
+                log.warning("requested to install %d MDMTs for topic %s but only have %d network addresses to assign"
+                            " them! Will install as many as we have addresses..." % (len(mdmts), topic, len(self.address_pool)))
+            for t, address in zip(mdmts, self.address_pool):
+                self.set_address_for_mdmt(t, address)
+
+        # NOTE: the merged rules match address prefixes so a new compile that groups the MDMTs differently won't
+        # simply overwrite the old rules: we remove the stale ones after installing the new ones.
+        old_groups, old_flows = self._installed_merged_rules
+        groups, flows = self._build_merged_flow_rules()
+        for g in groups:
+            if not self.topology_manager.install_group(g):
+                log.error("Problem installing group %s" % g)
+        # Need a chance for groups to populate: see install_mdmts()
+        time.sleep(2)
+        if not self.topology_manager.install_flow_rules(flows):
+            log.error("Problem installing flow rules: %s" % flows)
+        self._uninstall_stale_rules(old_groups, old_flows)
+
+    def _build_merged_flow_rules(self):
+        """
+        Builds the merged groups and flow rules for all topics' (addressed) MDMTs, logs how much they reduced the
+        switches' table occupancy, and records them as installed.
+        :return: groups, flow_rules
+        """
+        trees = []
+        matches_params = []
+        group_ids = []
+        response_matching = []
+        for mdmts in self.mdmts.values():
+            for i, t in enumerate(mdmts):
+                address = self.get_address_for_mdmt(t)
+                if address is None:
+                    continue
+                trees.append(self.get_mdmt_graph(t))
+                matches_params.append(self.build_flow_match_params_from_address(address))
+                group_ids.append(i + 10)
+                # XXX: see _build_mdmt_flow_rules()
+                response_matching.append({"udp_dst": address[1]})
+
+        groups, flow_rules, occupancy = self.topology_manager.build_flow_rules_from_multicast_trees(
+            trees, self.dpid, matches_params, group_ids, route_responses=response_matching,
+            priority=MULTICAST_FLOW_RULE_PRIORITY)
+
+        totals = {k: sum(o[k] for o in occupancy.values()) for k in ('flows', 'groups', 'unmerged_flows', 'unmerged_groups')}
+        log.info("merged flow rules for %d MDMTs: %d flows and %d groups (rather than %d and %d) across %d switches;"
+                 " max per switch: %d flows" % (len(trees), totals['flows'], totals['groups'], totals['unmerged_flows'],
+                                                totals['unmerged_groups'], len(occupancy),
+                                                max([o['flows'] for o in occupancy.values()] or [0])))
+        log.debug("per-switch flow table occupancy: %s" % occupancy)
+
+        self._installed_merged_rules = (groups, flow_rules)
+        return groups, flow_rules
+
+    def repair_mdmts(self, topics=None):
+        """
+        Repairs the MDMTs of each topic that contain links/nodes no longer in the (recently updated) topology by
+        reattaching their orphaned subtrees (see NetworkTopology.repair_multicast_trees()) and then re-installs only
+        those groups/flow rules that changed, i.e. those for switches along the repaired parts of the MDMTs.
+        Any outstanding alerts for a topic are also updated to use the repaired MDMTs.
+        :param topics: only repair these topics' MDMTs (default=all of them)
+        :return: dict mapping topic IDs to the list of indices of its MDMTs that were repaired
+        :raises nx.NetworkXError: if the MDMTs can't be repaired (e.g. the server is no longer in the topology)
+        """
+
+        source = self.get_server_id()
+        repaired = dict()
+        for topic, mdmts in self.mdmts.items():
+            if topics is not None and topic not in topics:
+                continue
+            subs = self.subscribers.get(topic, [])
+            new_trees, changed = self.topology_manager.repair_multicast_trees([self.get_mdmt_graph(m) for m in mdmts],
+                                                                              source, subs)
+            repaired[topic] = changed
+            if not changed:
+                continue
+            log.info("repaired MDMTs %s for topic %s" % (changed, topic))
+            self._reinstall_mdmts(topic, self._replace_mdmts(mdmts, new_trees, changed, topic), changed)
+
+        return repaired
+
+    def _reinstall_mdmts(self, topic, new_mdmts, changed):
+        """
+        Replaces the topic's MDMTs with the given modified (e.g. repaired) ones and installs only those groups/flow
+        rules of the changed MDMTs that differ from the ones last installed for them, i.e. those for the switches
+        along their modified parts, and then removes the stale ones (e.g. from switches no longer in an MDMT).
+        Any outstanding alerts for the topic are updated to use the new MDMTs.
+        :param new_mdmts: the topic's new list of MDMTs
+        :param changed: indices of the MDMTs that were modified
+        """
+
+        old_mdmts = self.mdmts[topic]
+        groups = []
+        flows = []
+        # all the previously-installed rules we replaced: those not overwritten by the new ones are stale
+        replaced_groups = []
+        replaced_flows = []
+        if self.merge_flow_rules:
+            # the changes may affect which rules can be merged so we recompile them all and just install the new ones
+            for i in changed:
+                self.set_address_for_mdmt(new_mdmts[i], self.get_address_for_mdmt(old_mdmts[i]))
+            self.mdmts[topic] = new_mdmts
+            old_groups, old_flows = self._installed_merged_rules
+            new_groups, new_flows = self._build_merged_flow_rules()
+            groups.extend(g for g in new_groups if g not in old_groups)
+            flows.extend(f for f in new_flows if f not in old_flows)
+            replaced_groups.extend(old_groups)
+            replaced_flows.extend(old_flows)
+            changed = ()
+
+        for i in changed:
+            address = self.get_address_for_mdmt(old_mdmts[i])
+            old_groups, old_flows = self._installed_mdmt_rules.get(address, ([], []))
+            self.set_address_for_mdmt(new_mdmts[i], address)
+            new_groups, new_flows = self._build_mdmt_flow_rules(i, new_mdmts[i], address)
+            groups.extend(g for g in new_groups if g not in old_groups)
+            flows.extend(f for f in new_flows if f not in old_flows)
+            replaced_groups.extend(old_groups)
+            replaced_flows.extend(old_flows)
+
+        self.mdmts[topic] = new_mdmts
+        for alert in list(self._alerts):
+            if alert.topic == topic:
+                alert.update_mdmts(new_mdmts)
+
+        log.debug("re-installing %d groups and %d flow rules for modified MDMTs" % (len(groups), len(flows)))
+        for g in groups:
+            if not self.topology_manager.install_group(g):
+                log.error("Problem installing group %s" % g)
+        if groups:
+            # Need a chance for groups to populate: see install_mdmts()
+            time.sleep(2)
+        if flows and not self.topology_manager.install_flow_rules(flows):
+            log.error("Problem installing flow rules: %s" % flows)
+
+        self._uninstall_stale_rules(replaced_groups, replaced_flows)
+
+    def _uninstall_stale_rules(self, old_groups, old_flows):
+        """
+        Uninstalls those of the given previously-installed groups/flow rules that weren't overwritten by the ones
+        currently installed for any MDMT (i.e. none of those has the same key: see SdnTopology.get_flow_rule_key()).
+        NOTE: flow rules are removed before the groups they may point to.
+        """
+
+        if self.merge_flow_rules:
+            installed = [self._installed_merged_rules]
+        else:
+            installed = self._installed_mdmt_rules.values()
+        tm = self.topology_manager
+        group_keys = set(tm.get_group_key(g) for groups, flows in installed for g in groups)
+        flow_keys = set(tm.get_flow_rule_key(f) for groups, flows in installed for f in flows)
+
+        stale_flows = dict()
+        for f in old_flows:
+            key = tm.get_flow_rule_key(f)
+            if key not in flow_keys:
+                stale_flows[key] = f
+        stale_groups = dict()
+        for g in old_groups:
+            key = tm.get_group_key(g)
+            if key not in group_keys:
+                stale_groups[key] = g
+
+        log.debug("uninstalling %d stale groups and %d stale flow rules" % (len(stale_groups), len(stale_flows)))
+        for f in stale_flows.values():
+            if not tm.uninstall_flow_rule(f):
+                log.error("Problem uninstalling flow rule %s" % f)
+        for g in stale_groups.values():
+            if not tm.uninstall_group(g):
+                log.error("Problem uninstalling group %s" % g)
+
     def build_flow_matches_from_address(self, address):
         """
         Builds flow matching objects from the given address, which by default is assumed to be a tuple of:
@@ -638,11 +951,19 @@ class RideD(object):
         :param address:
         :return:
         """
-        # TODO: need anything else here?  ip_proto=udp???  udp_dst???
         assert isinstance(self.topology_manager, SdnTopology)
+        return self.topology_manager.build_matches(**self.build_flow_match_params_from_address(address))
+
+    def build_flow_match_params_from_address(self, address):
+        """
+        Like build_flow_matches_from_address() but returns the matches as key-value pairs for build_matches() (e.g.
+        so that they can be merged with those of other MDMTs).
+        :param address:
+        :rtype: dict
+        """
+        # TODO: need anything else here?  ip_proto=udp???  udp_dst???
         src_ip = self.topology_manager.get_ip_address(self.get_server_id())
-        matches = self.topology_manager.build_matches(ipv4_src=src_ip, ipv4_dst=address[0], udp_src=address[1])
-        return matches
+        return dict(ipv4_src=src_ip, ipv4_dst=address[0], udp_src=address[1])
 
     def update(self):
         """
@@ -653,42 +974,140 @@ class RideD(object):
         """
 
         # ENHANCE: extend the REST APIs to support updating the topology rather than getting a whole new one.
+        old_topo = nx.Graph(self.topology_manager.topo) if self.repair_mdmts_on_update and self.mdmts else None
         self.topology_manager.build_topology(from_scratch=True)
 
         # TODO: need to invalidate outstanding alerts if the MDMTs change!  or at least invalidate their changed MDMTs...
+        # (repair_mdmts() does update them to use the repaired MDMTs)
+
+        # Repairing only fixes MDMTs broken by failures: any topics whose MDMTs don't match their subscribers still
+        # need to be (re)built, as do all of them if links/nodes were added (e.g. recovered) as they may be improved.
+        rebuild_topics = None  # i.e. all of them
+        if old_topo is not None:
+            rebuild_topics = self._get_topics_to_rebuild(old_topo)
+            try:
+                self.repair_mdmts(topics=[t for t in self.mdmts if t not in rebuild_topics])
+                if not rebuild_topics:
+                    return
+                log.info("rebuilding MDMTs for topics %s as repairing them isn't enough" % rebuild_topics)
+            except nx.NetworkXError as e:
+                log.error("failed to repair MDMTs so rebuilding them instead due to error: \n%s" % e)
+                rebuild_topics = None
 
         # XXX: during lots of failures, the updated topology won't see a lot of the nodes so we'll be catching errors...
         trees = None
         try:
-            trees = self.build_mdmts()
-            # TODO: maybe we should only save the built MDMTs as we add their flow rules? this could ensure that any MDMT we try to use will at least be fully-installed...
-            # could even use a thread lock to block until the first one is installed
-            self.mdmts = trees
+            if rebuild_topics is None:
+                trees = self.build_mdmts()
+                # TODO: maybe we should only save the built MDMTs as we add their flow rules? this could ensure that any MDMT we try to use will at least be fully-installed...
+                # could even use a thread lock to block until the first one is installed
+                self.mdmts = self.compact_mdmts(trees)
+            else:
+                trees = self.build_mdmts({t: self.subscribers[t] for t in rebuild_topics})
+                self.mdmts.update(self.compact_mdmts(trees))
         except nx.NetworkXError as e:
             log.error("failed to create MDMTs (likely due to topology disconnect) due to error: \n%s" % e)
 
-        if trees:
+        if trees and self.merge_flow_rules:
+            try:
+                self.install_merged_mdmts()
+            except nx.NetworkXError as e:
+                log.error("failed to install_merged_mdmts due to error: %s" % e)
+        elif trees:
             # ENHANCE: error checking/handling esp. for the multicast address pool that must be shared across all topics!
-            for mdmts in trees.values():
+            for topic in trees:
                 try:
-                    self.install_mdmts(mdmts)
+                    self.install_mdmts(self.mdmts[topic])
                 except nx.NetworkXError as e:
                     log.error("failed to install_mdmts due to error: %s" % e)
         elif self.subscribers:
             log.error("empty return value from build_mdmts() when we do have subscribers!")
         # ENHANCE: retrieve publication routes rather than rely on them being manually set...
 
-    def add_subscriber(self, subscriber, topic_id):
+    def finish(self):
+        """Releases our resources: currently just the topology manager's worker processes for constructing MDMTs in
+        parallel (see nprocesses option), which are otherwise re-used for each update()."""
+        self.topology_manager.close()
+
+    def _get_topics_to_rebuild(self, old_topo):
+        """
+        Returns the topics whose MDMTs can't just be repaired after updating the topology: all topics with subscribers
+        if the topology gained any links/nodes (e.g. they recovered from failure) since old_topo, otherwise those
+        without MDMTs or whose MDMTs weren't built for (or don't reach) the current subscribers.
+        :type old_topo: nx.Graph
+        :rtype: list
+        """
+        topo = self.topology_manager.topo
+        if any(n not in old_topo for n in topo.nodes()) or any(not old_topo.has_edge(u, v) for u, v in topo.edges()):
+            log.debug("topology gained links/nodes so rebuilding all MDMTs")
+            return list(self.subscribers.keys())
+
+        topics = []
+        for topic, subs in self.subscribers.items():
+            subs = frozenset(subs)
+            mdmts = self.mdmts.get(topic)
+            if not mdmts:
+                topics.append(topic)
+                continue
+            for m in mdmts:
+                # NOTE: MDMTs set directly as nx.Graphs don't record the subscribers they were built for
+                if (m.terminals != subs) if isinstance(m, MdmtTree) else any(s not in m for s in subs):
+                    topics.append(topic)
+                    break
+        return topics
+
+    def add_subscriber(self, subscriber, topic_id, graft=False):
         """
         Adds the specified subscriber host ID to the list of hosts currently subscribed
         to the given topic.  This is needed for calculating the multicast trees.
         :param subscriber:
         :param topic_id:
+        :param graft: if True and the topic already has MDMTs, the subscriber is incrementally grafted onto each of
+         them (see NetworkTopology.graft_multicast_trees()) and only the affected switches' groups/flow rules are
+         installed; otherwise it won't be reached until the MDMTs are rebuilt by the next update()
         :return:
         """
 
         self.subscribers.setdefault(topic_id, []).append(subscriber)
 
+        if graft and self.mdmts.get(topic_id):
+            mdmts = self.mdmts[topic_id]
+            new_trees, changed = self.topology_manager.graft_multicast_trees([self.get_mdmt_graph(m) for m in mdmts],
+                                                                             self.get_server_id(), subscriber)
+            if changed:
+                self._reinstall_mdmts(topic_id, self._replace_mdmts(mdmts, new_trees, changed, topic_id), changed)
+            self._update_mdmt_terminals(topic_id)
+
+    def remove_subscriber(self, subscriber, topic_id, prune=False):
+        """
+        Removes the specified subscriber host ID from the list of hosts currently subscribed to the given topic.
+        :param subscriber:
+        :param topic_id:
+        :param prune: if True and the topic already has MDMTs, the subscriber's now-unnecessary branches are pruned
+         from each of them (see NetworkTopology.prune_multicast_trees()) and only the affected switches'
+         groups/flow rules are re-installed (the stale ones being uninstalled)
+        :raises ValueError: if the subscriber isn't subscribed to the topic
+        """
+
+        self.subscribers.get(topic_id, []).remove(subscriber)
+
+        if prune and self.mdmts.get(topic_id):
+            mdmts = self.mdmts[topic_id]
+            new_trees, changed = self.topology_manager.prune_multicast_trees([self.get_mdmt_graph(m) for m in mdmts],
+                                                                             self.get_server_id(), subscriber,
+                                                                             self.subscribers[topic_id])
+            if changed:
+                self._reinstall_mdmts(topic_id, self._replace_mdmts(mdmts, new_trees, changed, topic_id), changed)
+            self._update_mdmt_terminals(topic_id)
+
+    def _update_mdmt_terminals(self, topic_id):
+        """Records that all of the topic's MDMTs (including those a graft/prune didn't change) now serve its current
+        subscribers so that update() needn't rebuild them (see _get_topics_to_rebuild())."""
+        subs = frozenset(self.subscribers.get(topic_id, []))
+        for m in self.mdmts.get(topic_id, []):
+            if isinstance(m, MdmtTree):
+                m.terminals = subs
+
     def get_subscribers_for_topic(self, topic_id):
         """
         Return a list of all subscribers registered for the given topic.
@@ -791,7 +1210,7 @@ class RideD(object):
             # create a copy to ignore later additions; use set to easily determine which ones we haven't reached yet
             self.subscribers = set(subscribers)
             self.mdmts = mdmts
-            # TODO: if we update the MDMTs, need some way of changing the available ones known by the context...
+            # NOTE: if we repair the MDMTs, RideD will call update_mdmts()
             self.id = _id
 
             # This data will be updated as alerts are sent/retried/responded to
@@ -814,6 +1233,18 @@ class RideD(object):
             # THREADING: we don't bother locking since this should be called serially only from main send_alert or re-tx thread
             self.mdmts_used.append(mdmt)
 
+        def update_mdmts(self, mdmts):
+            """
+            Replaces the available MDMTs with the given (e.g. repaired) ones.  Any MDMTs already used are mapped to
+            their replacements (i.e. those with the same address) so the record of which ones were used remains valid.
+            :param mdmts:
+            :type mdmts: list
+            """
+            with self.thread_lock:
+                replacements = {RideD.get_address_for_mdmt(m): m for m in mdmts}
+                self.mdmts_used = [replacements.get(RideD.get_address_for_mdmt(m), m) for m in self.mdmts_used]
+                self.mdmts = mdmts
+
         def is_mdmt_used(self, mdmt):
             """
             :return: True if the specified MDMT has been used during the lifetime of this alert
@@ -3,6 +3,9 @@ from threading import Thread
 from time import sleep
 
 from ride.data_path_monitor import *
+from ride.data_path_probing_engine import DataPathProbingEngine
+from ride.port_stats_monitor import PortStatsDataPathMonitor
+from ride import probe_format, probe_estimators, probe_telemetry
 from ride.udp_echo_server import EchoServer, parse_args as parse_echo_server_args
 
 import logging
@@ -28,11 +31,313 @@ class TestParameters(unittest.TestCase):
                 self.assertTrue(False, "should not generate error for any values in legal range:"
                                        " max_false_pos_rate=%f, link_loss=%f" % (mfpr, ll))
 
+    def test_engine_rejects_pipelining(self):
+        """The probing engine only keeps one probe in flight so it shouldn't accept a pipelining monitor."""
+        engine = DataPathProbingEngine()
+        pipelined_monitor = RideCDataPathMonitor(address='127.0.0.1', dst_port=9999, pipeline_depth=4)
+        try:
+            self.assertRaises(ValueError, engine.add_monitor, pipelined_monitor)
+            engine.add_monitor(self.monitor)
+        finally:
+            engine.finish(close_monitors=False)
+            pipelined_monitor.finish()
+
     def tearDown(self):
         # make sure we close the sockets
         self.monitor.finish()
 
 
+class TestProbeFormat(unittest.TestCase):
+    """Verify the binary probe format's responses and falling back to older versions/JSON."""
+
+    def setUp(self):
+        self.monitor = RideCDataPathMonitor(address='127.0.0.1', dst_port=9999)
+
+    def test_binary_probes(self):
+        probe = probe_format.pack_probe(3, probe_format.monotonic_ns() - 2000000)
+        self.assertEqual(len(probe), probe_format.PROBE_HEADER.size)
+        version, probe_type, seq, time_sent = probe_format.unpack_probe(probe_format.make_probe_response(probe))
+        self.assertEqual((version, probe_type, seq), (probe_format.PROBE_VERSION, probe_format.RESPONSE, 3))
+
+        delay, seq = self.monitor.on_response_received(probe_format.make_probe_response(probe))
+        self.assertEqual(seq, 3)
+        self.assertTrue(2 <= delay < 1000, "RTT should be (sub-)ms precision: %s" % delay)
+
+    def test_fallback(self):
+        # echo server responds to newer versions with the version it supports
+        probe = probe_format.pack_probe(4, probe_format.monotonic_ns(), version=probe_format.PROBE_VERSION + 1)
+        version, probe_type, seq, time_sent = probe_format.unpack_probe(probe_format.make_probe_response(probe))
+        self.assertEqual((version, probe_type), (probe_format.PROBE_VERSION, probe_format.VERSION_UNSUPPORTED))
+
+        # JSON probes are just echoed back
+        json_probe = json.dumps(dict(seq=5, time_sent=int(time.time() * 1000)))
+        self.assertEqual(probe_format.make_probe_response(json_probe), json_probe)
+        self.assertEqual(self.monitor.on_response_received(json_probe)[1], 5)
+
+        # a server that doesn't support binary probes at all makes us fall back to JSON
+        response = probe_format.pack_probe(6, probe_format.monotonic_ns(), probe_format.VERSION_UNSUPPORTED, version=0)
+        self.assertEqual(self.monitor.on_response_received(response)[1], 6)
+        self.assertEqual(self.monitor.probe_format, probe_format.JSON_PROBE_FORMAT)
+
+    def tearDown(self):
+        self.monitor.finish()
+
+
+class TestProbeSequenceWindow(unittest.TestCase):
+    """Verify that pipelined probes' responses are attributed correctly and they only expire after their deadline."""
+
+    def test_window(self):
+        window = ProbeSequenceWindow()
+        for seq in range(4):
+            window.add(seq, 10 + seq)
+        self.assertEqual(window.next_deadline(), 10)
+
+        # responses can arrive out of order; late/duplicate ones aren't attributed to any probe
+        self.assertTrue(window.on_response(2))
+        self.assertFalse(window.on_response(2))
+        self.assertEqual(window.expire(9.5), [])
+        self.assertEqual(window.expire(11), [0, 1])
+        self.assertFalse(window.on_response(0))
+        self.assertEqual(len(window), 1)
+        self.assertEqual(window.next_deadline(), 13)
+        self.assertEqual(window.expire(20), [3])
+        self.assertIsNone(window.next_deadline())
+
+
+class TestEstimators(unittest.TestCase):
+    """Verify the pluggable loss/RTT estimators and that they feed the monitor's adaptive probing parameters."""
+
+    def test_window_loss(self):
+        est = probe_estimators.SlidingWindowLossEstimator(window_size=4)
+        self.assertEqual(est.loss_rate, 0.0)
+        for lost in (True, True, False, False):
+            est.update(lost)
+        self.assertEqual(est.loss_rate, 0.5)
+        # the older losses fall out of the window
+        est.update(False)
+        est.update(False)
+        self.assertEqual(est.loss_rate, 0.0)
+
+    def test_ewma_loss(self):
+        est = probe_estimators.EwmaLossEstimator(alpha=0.9)
+        self.assertEqual(est.loss_rate, 0.0)
+        # losing the first probe shouldn't mean 100% loss
+        self.assertAlmostEqual(est.update(True), 0.1)
+        self.assertAlmostEqual(est.update(False), 0.09)
+        self.assertAlmostEqual(est.loss_rate, 0.09)
+
+    def test_total_loss(self):
+        """Even if every probe was lost, the detection window size should still be defined."""
+        monitor = RideCDataPathMonitor(address='127.0.0.1', dst_port=9999, loss_estimator='window')
+        try:
+            self.assertEqual(monitor.set_detection_window_size(0.01, 1.0), math.ceil(math.log(0.01, MAX_LINK_LOSS)))
+            # e.g. as estimated before the DataPath started dropping everything
+            monitor._rtt_a = 20
+            for i in range(10):
+                monitor.on_probe_result(False)
+            monitor.adapt_probing_parameters()
+            self.assertEqual(monitor._link_loss, 1.0)
+            self.assertTrue(monitor._detection_window_size > 1)
+        finally:
+            monitor.finish()
+
+    def test_rfc6298_rtt(self):
+        est = probe_estimators.Rfc6298RttEstimator()
+        est.update(100)
+        self.assertEqual((est.rtt, est.rtt_variance, est.timeout), (100, 50, 300))
+        for i in range(100):
+            est.update(100)
+        # timeout tightens as the jitter goes away, but never below the clock granularity
+        self.assertAlmostEqual(est.rtt, 100)
+        self.assertAlmostEqual(est.timeout, 100 + est.granularity)
+
+    def test_monitor_parameters(self):
+        monitor = RideCDataPathMonitor(address='127.0.0.1', dst_port=9999, loss_estimator='window',
+                                       rtt_estimator='rfc6298')
+        try:
+            monitor._total_sent = 10
+            for delay in (20, False, 20, 20):
+                monitor.on_probe_result(delay)
+            monitor.adapt_probing_parameters()
+            self.assertEqual(monitor._link_loss, 0.25)
+            self.assertEqual(monitor._timeout, monitor.rtt_estimator.timeout)
+            self.assertRaises(ValueError, RideCDataPathMonitor, address='127.0.0.1', dst_port=9999,
+                              loss_estimator='bogus')
+        finally:
+            monitor.finish()
+
+
+class TestTelemetry(unittest.TestCase):
+    """Verify the probe telemetry's histogram accuracy and snapshots."""
+
+    def test_histogram(self):
+        hist = probe_telemetry.RttHistogram()
+        for rtt in range(1, 1001):
+            hist.record(rtt)
+        self.assertEqual((hist.count, hist.min, hist.max), (1000, 1, 1000))
+        for p in (50, 90, 99):
+            self.assertTrue(abs(hist.get_percentile(p) - p * 10) <= p * 10 * 0.032,
+                            "%dth percentile of %s too inaccurate" % (p, hist.get_percentile(p)))
+
+    def test_snapshot(self):
+        monitor = RideCDataPathMonitor(address='127.0.0.1', dst_port=9999, data_path_id=1,
+                                       status_change_callback=lambda dp, status: None)
+        try:
+            monitor._total_sent, monitor._total_received = 4, 3
+            monitor.telemetry.enter_phase(probe_telemetry.ESTIMATION_PHASE)
+            for delay in (20, False, 30, 25):
+                monitor.on_probe_result(delay)
+            monitor.finish_estimation_phase()
+            monitor.update_link_status(DATA_PATH_DOWN)
+
+            snapshot = monitor.get_telemetry_snapshot()
+            self.assertEqual((snapshot['probes'], snapshot['timeouts'], snapshot['rtt']['count']), (4, 1, 3))
+            self.assertEqual(snapshot['phase'], probe_telemetry.RECOVERY_PHASE)
+            self.assertEqual(set(snapshot['phase_times']), {probe_telemetry.ESTIMATION_PHASE,
+                                                            probe_telemetry.MONITORING_PHASE,
+                                                            probe_telemetry.RECOVERY_PHASE})
+            self.assertEqual(snapshot['status_transitions'][-1][1], DATA_PATH_DOWN)
+            json.dumps(snapshot)
+            self.assertIn('ride_c_timeouts{data_path="1"} 1', probe_telemetry.format_snapshots_text({1: snapshot}))
+        finally:
+            monitor.finish()
+
+
+class TestPortStatsMonitor(unittest.TestCase):
+    """Verify passively inferring DataPath status from port statistics and suppressing active probing meanwhile."""
+
+    def setUp(self):
+        self.statuses = []
+        self.probing_monitor = RideCDataPathMonitor(address='127.0.0.1', dst_port=9999)
+        self.probing_monitor._sending_interval = 100
+
+    def build_monitor(self, probing_monitor=None, **kwargs):
+        return PortStatsDataPathMonitor(None, 'of:1', 2, max_stall_time=3, probing_monitor=probing_monitor,
+                                        status_change_callback=lambda dp, status: self.statuses.append(status),
+                                        **kwargs)
+
+    @staticmethod
+    def build_flow_rule(in_port, packets):
+        """Builds a flow rule in the (relevant parts of the) ONOS REST API's format."""
+        return {'packets': packets, 'selector': {'criteria': [{'type': 'IN_PORT', 'port': in_port},
+                                                              {'type': 'IPV4_DST', 'ip': '10.0.0.1/32'}]}}
+
+    def test_standalone(self):
+        monitor = self.build_monitor()
+        monitor.on_port_statistics(dict(port=2, packetsSent=10, packetsReceived=10), now=0)
+        # idle periods aren't failures
+        monitor.on_port_statistics(dict(port=2, packetsSent=10, packetsReceived=10), now=10)
+        monitor.on_port_statistics(dict(port=2, packetsSent=20, packetsReceived=10), now=12)
+        self.assertEqual(self.statuses, [])
+        self.assertEqual(monitor.on_port_statistics(dict(port=2, packetsSent=30, packetsReceived=10), now=13),
+                         DATA_PATH_DOWN)
+        self.assertEqual(monitor.on_port_statistics(dict(port=2, packetsSent=40, packetsReceived=11), now=14),
+                         DATA_PATH_UP)
+        self.assertEqual(self.statuses, [DATA_PATH_DOWN, DATA_PATH_UP])
+
+    def test_probing_suppression(self):
+        monitor = self.build_monitor(self.probing_monitor, flow_rule_filter=lambda f: True)
+        self.assertAlmostEqual(self.probing_monitor.get_time_until_next_probe(), 0.1)
+        # the port's counters alone could be other traffic's
+        monitor.on_port_statistics(dict(port=2, packetsSent=10, packetsReceived=10), now=0)
+        monitor.on_port_statistics(dict(port=2, packetsSent=20, packetsReceived=20), now=1)
+        self.assertAlmostEqual(self.probing_monitor.get_time_until_next_probe(), 0.1)
+
+        # but responses via the publishers' flow rules show it's healthy (only rules from our port count)
+        self.assertFalse(monitor.on_flow_statistics([self.build_flow_rule(2, 5), self.build_flow_rule(1, 5)]))
+        self.assertFalse(monitor.on_flow_statistics([self.build_flow_rule(2, 5), self.build_flow_rule(1, 9)]))
+        self.assertAlmostEqual(self.probing_monitor.get_time_until_next_probe(), 0.1)
+        self.assertTrue(monitor.on_flow_statistics([self.build_flow_rule(2, 8), self.build_flow_rule(1, 9)]))
+        self.assertTrue(self.probing_monitor.get_time_until_next_probe() > 2)
+
+        # a stall resumes probing rather than deeming the DataPath DOWN
+        monitor.on_port_statistics(dict(port=2, packetsSent=30, packetsReceived=20), now=4)
+        self.assertAlmostEqual(self.probing_monitor.get_time_until_next_probe(), 0.1)
+        self.assertEqual(self.statuses, [])
+
+    def test_probing_monitor_status(self):
+        """With a probing monitor, it decides the DataPath's status."""
+        monitor = self.build_monitor(self.probing_monitor)
+        monitor.on_port_statistics(dict(port=2, packetsSent=10, packetsReceived=10), now=0)
+        self.probing_monitor._link_status = DATA_PATH_DOWN
+        self.assertTrue(monitor.is_data_path_down)
+        # received traffic doesn't override its recovery detection
+        self.assertEqual(monitor.on_port_statistics(dict(port=2, packetsSent=20, packetsReceived=20), now=1),
+                         DATA_PATH_DOWN)
+        self.probing_monitor._link_status = DATA_PATH_UP
+        self.assertEqual(monitor.link_status, DATA_PATH_UP)
+        self.assertEqual(self.statuses, [])
+
+    def test_poll_errors(self):
+        """Errors getting the statistics should just be logged, but not e.g. KeyboardInterrupt."""
+        class _FailingRestApi(object):
+            def __init__(self, error):
+                self.error = error
+
+            def get_statistics(self, switch_id):
+                raise self.error
+
+            get_flow_rules = get_statistics
+
+        monitor = self.build_monitor(self.probing_monitor, flow_rule_filter=lambda f: True)
+        monitor.rest_api = _FailingRestApi(IOError("controller unreachable"))
+        self.assertEqual(monitor.poll(), DATA_PATH_UP)
+        monitor.rest_api = _FailingRestApi(KeyboardInterrupt())
+        self.assertRaises(KeyboardInterrupt, monitor.poll)
+
+    def test_pipelined_probing_suppression(self):
+        """Pipelined probing rounds shouldn't send probes while suppressed, but should wait out the suppression."""
+        self.probing_monitor.pipeline_depth = 3
+        self.probing_monitor.suppress_probing(0.5)
+        start = time.time()
+        self.assertEqual(self.probing_monitor.do_pipelined_probing_round(), [])
+        self.assertTrue(time.time() - start >= 0.45)
+        self.assertEqual(self.probing_monitor._seq, 0)
+
+        # resuming cancels the rest of the round
+        self.probing_monitor.suppress_probing(10)
+        Thread(target=lambda: (sleep(0.3), self.probing_monitor.resume_probing())).start()
+        start = time.time()
+        self.probing_monitor.do_pipelined_probing_round()
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual(self.probing_monitor._seq, 0)
+
+    def tearDown(self):
+        self.probing_monitor.finish()
+
+
+class TestEchoServer(unittest.TestCase):
+    """Verify the EchoServer delays (without a thread per probe) and drops responses as configured."""
+
+    NPROBES = 200
+
+    def setUp(self):
+        self.echo_server = EchoServer(parse_echo_server_args(['-p', '9998', '-d', '0.2', '-b', '16']))
+        self._echo_thread = Thread(target=self.echo_server.run)
+        self._echo_thread.start()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.settimeout(1)
+
+    def test_delay_and_loss(self):
+        start = time.time()
+        for seq in range(self.NPROBES):
+            self.sock.sendto(probe_format.pack_probe(seq, probe_format.monotonic_ns()), ('127.0.0.1', 9998))
+        seqs = set()
+        for seq in range(self.NPROBES):
+            seqs.add(probe_format.unpack_probe(self.sock.recv(2048))[2])
+        self.assertTrue(time.time() - start >= 0.2, "responses should have been delayed!")
+        self.assertEqual(seqs, set(range(self.NPROBES)))
+
+        self.echo_server.loss_rate = 1.0
+        self.sock.sendto(probe_format.pack_probe(0, probe_format.monotonic_ns()), ('127.0.0.1', 9998))
+        self.assertRaises(socket.timeout, self.sock.recv, 2048)
+
+    def tearDown(self):
+        self.sock.close()
+        self.echo_server.finish()
+        self._echo_thread.join(3)
+
+
 class TestBasicMonitoring(unittest.TestCase):
     """Verify that a DPMonitor will detect an outage, update its status, detect the path recovery, and again update."""
 
@@ -99,6 +404,14 @@ class TestBasicMonitoring(unittest.TestCase):
         link_up = not self.monitor.is_data_path_down
         self.assertTrue(link_up, "data path monitor should think the data path is back up since the echo server is running again!")
 
+    def test_pipelined_failure_detection(self):
+        """Verify the same failure detection/recovery when keeping several probes in flight."""
+        self.monitor.finish()
+        self.monitor = RideCDataPathMonitor(address='127.0.0.1', dst_port=9999, init_window=10, pipeline_depth=3,
+                                            status_change_callback=self.dp_status_callback)
+        self._monitor_thread = Thread(target=self.monitor.run)
+        self.test_basic_failure_detection()
+
     def test_congestion_loss_rate(self):
         """Verify that the DPMonitor detects severe congestion events and marks the DataPath as DOWN until it recovers.
         It should also keep the path marked as UP despite slight lossiness."""
@@ -194,5 +507,69 @@ class TestBasicMonitoring(unittest.TestCase):
         self._monitor_thread.join(3)
         self._echo_thread.join(3)
 
+class TestProbingEngine(unittest.TestCase):
+    """Verify that a single DataPathProbingEngine monitoring several DataPaths detects their outage and recovery."""
+
+    NMONITORS = 3
+    PHASE1_DURATION = TestBasicMonitoring.PHASE1_DURATION
+    PHASE2_DURATION = TestBasicMonitoring.PHASE2_DURATION
+    PHASE3_DURATION = TestBasicMonitoring.PHASE3_DURATION
+
+    def dp_status_callback(self, dp_id, status):
+        self.assertEqual(self.expected_status, status, self._dp_status_msg)
+        self.status_changes.append((dp_id, status))
+
+    def setUp(self):
+        self.expected_status = -1
+        self._dp_status_msg = "new DataPath status did not match the expected status of %s" % self.expected_status
+        self.status_changes = []
+
+        self.monitors = [RideCDataPathMonitor(address='127.0.0.1', dst_port=9999, init_window=10, data_path_id=i,
+                                              status_change_callback=self.dp_status_callback)
+                         for i in range(self.NMONITORS)]
+        self.engine = DataPathProbingEngine(self.monitors)
+        self._engine_thread = Thread(target=self.engine.run)
+
+    def run_echo_server(self, quit_time=0):
+        _echo_args = parse_echo_server_args(['-p', '9999', '-q', str(quit_time), '-d', '0.001'])
+        self.echo_server = EchoServer(_echo_args)
+        self._echo_thread = Thread(target=self.echo_server.run)
+        self._echo_thread.start()
+
+    def test_basic_failure_detection(self):
+        """Verify that all DataPaths go DOWN after the EchoServer stops responding and UP again once it restarts."""
+
+        self.run_echo_server(self.PHASE1_DURATION)
+        self._engine_thread.start()
+
+        sleep(self.PHASE1_DURATION)
+        for m in self.monitors:
+            self.assertGreater(m._sending_interval, 0, "link characteristic estimation phase should have finished!")
+        self.expected_status = DATA_PATH_DOWN
+        self._dp_status_msg = "EchoServer quitting should have caused the DP to go DOWN!"
+        self._echo_thread.join(3)
+
+        sleep(self.PHASE2_DURATION)
+        for m in self.monitors:
+            self.assertTrue(m.is_data_path_down, "DP %s should be DOWN since the echo server stopped!" % m.data_path_id)
+
+        self.expected_status = DATA_PATH_UP
+        self._dp_status_msg = "EchoServer restarting should have caused the DP to go UP!"
+        self.run_echo_server(self.PHASE3_DURATION)
+        sleep(self.PHASE3_DURATION)
+
+        for m in self.monitors:
+            self.assertFalse(m.is_data_path_down, "DP %s should be back UP since the echo server is running again!"
+                             % m.data_path_id)
+        self.assertEqual(len(self.status_changes), 2 * self.NMONITORS, "each DP should have changed status exactly"
+                                                                       " twice but got: %s" % self.status_changes)
+
+    def tearDown(self):
+        self.engine.finish()
+        self.echo_server.finish()
+        self._engine_thread.join(3)
+        self._echo_thread.join(3)
+
+
 if __name__ == '__main__':
     unittest.main()
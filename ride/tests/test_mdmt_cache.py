@@ -0,0 +1,98 @@
+import unittest
+import os
+import shutil
+import struct
+import tempfile
+
+import networkx as nx
+
+from ride.mdmt_cache import MdmtCache
+from ride.ride_d import RideD
+
+
+class TestMdmtCache(unittest.TestCase):
+    """Tests the MDMT cache's keys and its in-memory and on-disk tiers."""
+
+    def setUp(self):
+        self.topo = nx.Graph()
+        nx.add_path(self.topo, ['s0', 'c0', 'b0', 'h0'], weight=1)
+        nx.add_path(self.topo, ['s0', 'c1', 'b1', 'h1'], weight=2)
+        self.topo.add_edge('b0', 'b1', weight=3)
+        self.mdmts = [nx.Graph([('s0', 'c0'), ('c0', 'b0'), ('b0', 'h0'), ('b0', 'b1'), ('b1', 'h1')]),
+                      nx.Graph([('s0', 'c1'), ('c1', 'b1'), ('b1', 'h1'), ('b1', 'b0'), ('b0', 'h0')])]
+        self.key = MdmtCache.make_key(MdmtCache.get_topology_fingerprint(self.topo), 's0', ['h0', 'h1'],
+                                      'red-blue', (), 2)
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def assertSameTrees(self, trees, expected):
+        self.assertEqual([set(frozenset(e) for e in t.edges()) for t in trees],
+                         [set(frozenset(e) for e in t.edges()) for t in expected])
+
+    def test_disabled_by_default(self):
+        args = RideD.get_arg_parser().parse_args([])
+        self.assertEqual(args.mdmt_cache_size, 0)
+        self.assertIsNone(args.mdmt_cache_dir)
+
+    def test_fingerprint(self):
+        fingerprint = MdmtCache.get_topology_fingerprint(self.topo)
+
+        # independent of the order nodes/links were added in
+        same = nx.Graph()
+        same.add_edges_from(reversed(list(self.topo.edges(data=True))))
+        self.assertEqual(MdmtCache.get_topology_fingerprint(same), fingerprint)
+
+        # but link and node attributes matter
+        changed = nx.Graph(self.topo)
+        changed['b0']['b1']['weight'] = 4
+        self.assertNotEqual(MdmtCache.get_topology_fingerprint(changed), fingerprint)
+        changed = nx.Graph(self.topo)
+        changed.nodes['c0']['weight'] = 5
+        self.assertNotEqual(MdmtCache.get_topology_fingerprint(changed), fingerprint)
+
+    def test_memory(self):
+        cache = MdmtCache(max_entries=1)
+        self.assertIsNone(cache.get(self.key, self.topo))
+        cache.put(self.key, self.mdmts)
+        trees = cache.get(self.key, self.topo)
+        self.assertSameTrees(trees, self.mdmts)
+        # rebuilt from the topology so they have its attributes
+        self.assertEqual(trees[0]['b0']['b1']['weight'], 3)
+
+        # LRU eviction
+        other_key = MdmtCache.make_key('other', 's0', ['h0'], 'red-blue', (), 2)
+        cache.put(other_key, self.mdmts)
+        self.assertIsNone(cache.get(self.key, self.topo))
+        stats = cache.get_stats()
+        self.assertEqual((stats['memory_hits'], stats['misses']), (1, 2))
+
+    def test_disk(self):
+        """Entries should be re-usable by a new cache (e.g. after restarting) and written atomically."""
+        MdmtCache(max_entries=0, cache_dir=self.cache_dir).put(self.key, self.mdmts)
+        self.assertEqual([f for f in os.listdir(self.cache_dir) if not f.endswith(MdmtCache.FILE_EXTENSION)], [])
+
+        cache = MdmtCache(max_entries=0, cache_dir=self.cache_dir)
+        self.assertSameTrees(cache.get(self.key, self.topo), self.mdmts)
+        self.assertEqual(cache.get_stats()['disk_hits'], 1)
+
+    def test_corrupt_file(self):
+        """A truncated or otherwise corrupt cache file should just be a cache miss."""
+        MdmtCache(max_entries=0, cache_dir=self.cache_dir).put(self.key, self.mdmts)
+        filename = os.path.join(self.cache_dir, os.listdir(self.cache_dir)[0])
+        with open(filename, 'rb') as f:
+            data = f.read()
+
+        # e.g. truncated mid-tree or header, an edge end-point's index out of range, garbage
+        bad_index = data[:-4] + struct.pack('<I', 1000)
+        for bad_data in (data[:len(data) - 3], data[:10], bad_index, '\xff' * len(data), ''):
+            with open(filename, 'wb') as f:
+                f.write(bad_data)
+            cache = MdmtCache(max_entries=0, cache_dir=self.cache_dir)
+            self.assertIsNone(cache.get(self.key, self.topo))
+            self.assertEqual(cache.get_stats()['misses'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import unittest
+
+import networkx as nx
+
+from ride.mdmt_tree import MdmtTree, NodeIndex
+
+
+class TestMdmtTree(unittest.TestCase):
+    """Tests that MdmtTrees are equivalent to the networkx trees they're built from."""
+
+    def setUp(self):
+        self.topo = nx.Graph()
+        nx.add_path(self.topo, ['s0', 'c0', 'b0', 'h0-b0'], weight=1, port=1)
+        nx.add_path(self.topo, ['s0', 'c1', 'b1', 'h0-b1'], weight=2, port=2)
+        nx.add_path(self.topo, ['b1', 'h1-b1'], weight=3, port=3)
+        self.topo.add_edge('b0', 'b1', weight=4, port=4)
+        self.topo.add_edge('c0', 'c1', weight=5, port=5)
+        self.root = 's0'
+        self.terminals = ['h0-b0', 'h0-b1', 'h1-b1']
+
+        self.trees = [nx.Graph([('s0', 'c0'), ('c0', 'b0'), ('b0', 'h0-b0'), ('b0', 'b1'), ('b1', 'h0-b1'),
+                                ('b1', 'h1-b1')]),
+                      nx.Graph([('s0', 'c1'), ('c1', 'b1'), ('b1', 'h0-b1'), ('b1', 'h1-b1'), ('c1', 'c0'),
+                                ('c0', 'b0'), ('b0', 'h0-b0')])]
+        self.trees[0].graph['address'] = ('224.0.0.1', 9000)
+        self.trees[0].name = 'tree0'
+        self.node_index = NodeIndex()
+        self.mdmts = [MdmtTree.from_graph(t, self.root, self.terminals, self.node_index) for t in self.trees]
+
+    def assertEquivalent(self, mdmt, tree):
+        self.assertEqual(set(mdmt.nodes()), set(tree.nodes()))
+        self.assertEqual(set(frozenset(e) for e in mdmt.edges()), set(frozenset(e) for e in tree.edges()))
+        self.assertEqual((mdmt.number_of_nodes(), mdmt.number_of_edges(), len(mdmt)),
+                         (tree.number_of_nodes(), tree.number_of_edges(), len(tree)))
+
+    def test_from_graph(self):
+        for mdmt, tree in zip(self.mdmts, self.trees):
+            self.assertEquivalent(mdmt, tree)
+            self.assertEqual(mdmt.terminals, frozenset(self.terminals))
+            # edges are oriented away from the root
+            for u, v in mdmt.edges():
+                self.assertLess(nx.shortest_path_length(tree, self.root, u),
+                                nx.shortest_path_length(tree, self.root, v))
+
+        self.assertEqual((self.mdmts[0].name, self.mdmts[0].address), ('tree0', ('224.0.0.1', 9000)))
+        # the address is the default name
+        self.assertEqual(self.mdmts[1].name, None)
+        mdmt = MdmtTree.from_graph(self.trees[1], self.root, self.terminals, address=('224.0.0.2', 9001))
+        self.assertEqual(mdmt.name, ('224.0.0.2', 9001))
+
+        with self.assertRaises(nx.NetworkXError):
+            MdmtTree.from_graph(self.trees[0], 'x0', self.terminals)
+
+    def test_to_networkx(self):
+        for mdmt, tree in zip(self.mdmts, self.trees):
+            self.assertEquivalent(mdmt, mdmt.to_networkx())
+            g = mdmt.to_networkx(self.topo)
+            self.assertEquivalent(mdmt, g)
+            for u, v, data in g.edges(data=True):
+                self.assertEqual(data, self.topo[u][v])
+            self.assertEqual(g.graph['address'], mdmt.address)
+            self.assertEqual(g.name, mdmt.name)
+
+            # and back again
+            self.assertEqual(list(MdmtTree.from_graph(g, self.root, self.terminals, self.node_index).edges()),
+                             list(mdmt.edges()))
+
+        # a lone root
+        lone = MdmtTree.from_graph(nx.Graph(self.topo.subgraph([self.root])), self.root, [])
+        self.assertEqual(list(lone.to_networkx().nodes()), [self.root])
+
+    def test_paths(self):
+        for mdmt, tree in zip(self.mdmts, self.trees):
+            for n in tree.nodes():
+                self.assertEqual(mdmt.get_path(n), nx.shortest_path(tree, self.root, n))
+            self.assertIsNone(mdmt.get_parent(self.root))
+            with self.assertRaises(KeyError):
+                mdmt.get_path('x0')
+
+    def test_contains(self):
+        for mdmt, tree in zip(self.mdmts, self.trees):
+            for n in self.topo.nodes():
+                self.assertEqual(n in mdmt, n in tree)
+            self.assertNotIn('x0', mdmt)
+
+    def test_shared_node_index(self):
+        """MDMTs built from the same topology share one index, which can be extended without affecting them."""
+        self.assertEqual(len(self.node_index), self.topo.number_of_nodes())
+        # the first tree was built before its index was extended with the second's nodes
+        self.assertLess(len(self.mdmts[0].parents), len(self.mdmts[1].parents))
+        self.assertIn('c1', self.node_index)
+        self.assertNotIn('c1', self.mdmts[0])
+
+        # e.g. a repaired tree uses a new node
+        repaired = nx.Graph(self.trees[0])
+        repaired.remove_edge('c0', 'b0')
+        nx.add_path(repaired, ['c0', 'r0', 'b0'])
+        repaired_mdmt = MdmtTree.from_graph(repaired, self.root, self.terminals, self.node_index)
+        self.assertIn('r0', self.node_index)
+        self.assertEquivalent(repaired_mdmt, repaired)
+        self.assertEqual(repaired_mdmt.get_path('h0-b0'), ['s0', 'c0', 'r0', 'b0', 'h0-b0'])
+
+        for mdmt, tree in zip(self.mdmts, self.trees):
+            self.assertEquivalent(mdmt, tree)
+            self.assertNotIn('r0', mdmt)
+            with self.assertRaises(KeyError):
+                mdmt.get_parent('r0')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+import unittest
+import os
+import json
+import shutil
+import tempfile
+
+from networkx.readwrite import json_graph
+
+from ride.ride_c import RideC
+from ride.data_path_monitor import RideCDataPathMonitor, DATA_PATH_UP, DATA_PATH_DOWN
+from topology_manager.networkx_sdn_topology import NetworkxSdnTopology
+from topology_manager.test_network_topology import build_campus_graph, get_hosts
+
+
+class TestDataPathAssignment(unittest.TestCase):
+    """Tests how RideC assigns hosts to DataPaths (but NOT the SDN mechanisms) using a NetworkxSdnTopology of a
+    campus network with 3 gateways to the cloud server."""
+
+    def setUp(self):
+        graph = build_campus_graph(nhosts=25)
+        for i in range(3):
+            graph.add_edge('g%d' % i, 'c%d' % i, weight=1)
+            graph.add_edge('g%d' % i, 'x0', weight=10)
+        self.tmp_dir = tempfile.mkdtemp()
+        topo_file = os.path.join(self.tmp_dir, 'topo.json')
+        with open(topo_file, 'w') as f:
+            json.dump(json_graph.node_link_data(graph), f)
+        self.topology = NetworkxSdnTopology(topo_file)
+        self.hosts = [(self.topology.get_ip_address(h), 5683) for h in get_hosts(graph)]
+        self.monitors = []
+
+    def tearDown(self):
+        for m in self.monitors:
+            m.finish()
+        shutil.rmtree(self.tmp_dir)
+
+    def build_ride_c(self, **kwargs):
+        rc = RideC(edge_server='s0', cloud_server='x0', topology_mgr=self.topology, **kwargs)
+        for i, capacity in enumerate((1.0, 1.0, 2.0)):
+            rc.register_data_path(i, 'g%d' % i, 'x0', capacity=capacity)
+        for h in self.hosts:
+            rc.register_host(h)
+        return rc
+
+    def get_assignments(self, rc):
+        return {h: dp for dp in rc.data_paths for h in rc.hosts_for_data_path(dp)}
+
+    def test_priority_by_default(self):
+        rc = self.build_ride_c()
+        self.assertEqual(set(self.get_assignments(rc).values()), {0})
+
+    def test_balanced(self):
+        rc = self.build_ride_c(assignment_policy='balanced')
+        counts = [len(rc.hosts_for_data_path(dp)) for dp in range(3)]
+        self.assertEqual(sum(counts), len(self.hosts))
+        # in proportion to their capacity (i.e. 1:1:2) give or take
+        self.assertTrue(all(c > len(self.hosts) / 8 for c in counts), counts)
+        self.assertTrue(counts[2] > max(counts[:2]), counts)
+
+    def test_failover(self):
+        """A DataPath failing should only move its own hosts and its recovery should move them back, even if the
+        other DataPaths' measurements changed in the meantime."""
+        rc = self.build_ride_c(assignment_policy='balanced')
+        assignments = self.get_assignments(rc)
+        for i in range(3):
+            monitor = RideCDataPathMonitor(address='127.0.0.1', dst_port=9999, data_path_id=i)
+            monitor._rtt_a = 20
+            rc.register_data_path_monitor(i, monitor)
+            self.monitors.append(monitor)
+
+        rc.on_data_path_status_change(1, DATA_PATH_DOWN)
+        failed_over = self.get_assignments(rc)
+        self.assertEqual(rc.hosts_for_data_path(1), [])
+        for h, dp in assignments.items():
+            if dp != 1:
+                self.assertEqual(failed_over[h], dp)
+            else:
+                self.assertIn(failed_over[h], (0, 2))
+            self.assertIn('g%d' % failed_over[h], rc._host_routes[h])
+
+        # DataPath 0 slows down so some of its hosts would now rather be on DataPath 2, but they shouldn't move
+        self.monitors[0]._rtt_a = 60
+        rc.pull_data_path_metrics()
+        self.assertTrue(any(rc._choose_data_path(h) == 2 for h, dp in failed_over.items() if dp == 0))
+
+        rc.on_data_path_status_change(1, DATA_PATH_UP)
+        recovered = self.get_assignments(rc)
+        for h, dp in assignments.items():
+            if dp == 1 or rc._choose_data_path(h) == 1:
+                self.assertEqual(recovered[h], 1)
+            else:
+                self.assertEqual(recovered[h], failed_over[h])
+
+    def test_monitor_metrics(self):
+        """Measurements from the DataPaths' monitors should weight the assignments."""
+        rc = RideC(edge_server='s0', cloud_server='x0', topology_mgr=self.topology, assignment_policy='balanced')
+        for i in range(3):
+            rc.register_data_path(i, 'g%d' % i, 'x0')
+            monitor = RideCDataPathMonitor(address='127.0.0.1', dst_port=9999, data_path_id=i)
+            monitor._rtt_a = 20
+            rc.register_data_path_monitor(i, monitor)
+            self.monitors.append(monitor)
+        # DataPath 2 is slow and lossy
+        self.monitors[2]._rtt_a = 40
+        self.monitors[2]._link_loss = 0.5
+        self.assertRaises(ValueError, rc.register_data_path_monitor, 3, self.monitors[0])
+
+        for h in self.hosts:
+            rc.register_host(h)
+        self.assertEqual(rc._data_path_metrics[2], (40, 0.5))
+        self.assertAlmostEqual(rc._get_data_path_weight(2), 0.25)
+        counts = [len(rc.hosts_for_data_path(dp)) for dp in range(3)]
+        self.assertTrue(counts[2] < min(counts[:2]), counts)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,16 +1,23 @@
 import unittest
 import os
+import json
+import shutil
+import tempfile
+import ipaddress
 from threading import Thread
 from time import sleep
 
 import networkx as nx
+from networkx.readwrite import json_graph
 import logging
 logging.basicConfig(level=logging.DEBUG)
 log = logging.getLogger('ride')
 log.setLevel(logging.DEBUG)
 
 from ride.ride_d import RideD
+from ride.config import MULTICAST_FLOW_RULE_PRIORITY
 from topology_manager.networkx_sdn_topology import NetworkxSdnTopology
+from topology_manager.test_network_topology import build_campus_graph
 
 ALERT_TOPIC = 'alert'
 ALERT_MSG = "warning!"
@@ -217,6 +224,139 @@ class TestMdmtSelection(unittest.TestCase):
         return mdmts
 
 
+class TestMdmtUpdate(unittest.TestCase):
+    """Tests RideD updating its MDMTs and their installed flow rules/groups as the topology and subscribers change
+    by using a NetworkxSdnTopology loaded from a topology file we modify."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.topo = build_campus_graph()
+        self.topo_file = self._write_topology(self.topo, 'topo.json')
+        self.topology = NetworkxSdnTopology(self.topo_file)
+
+        self.root = 's0'
+        self.ntrees = 2
+        addresses = [('224.0.0.%d' % (i + 1), 9000 + i) for i in range(self.ntrees)]
+        self.rided = RideD(topology_mgr=self.topology, ntrees=self.ntrees, dpid=self.root, addresses=addresses,
+                           tree_construction_algorithm=('diverse-paths',), repair_mdmts=True)
+        for sub in ('h0-b0', 'h0-b1'):
+            self.rided.add_subscriber(sub, ALERT_TOPIC)
+        self.rided.update()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _write_topology(self, topo, name):
+        filename = os.path.join(self.tmp_dir, name)
+        with open(filename, 'w') as f:
+            json.dump(json_graph.node_link_data(topo), f)
+        return filename
+
+    def assertMdmtsReach(self, topic, subscribers):
+        mdmts = self.rided.mdmts[topic]
+        self.assertEqual(len(mdmts), self.ntrees)
+        for m in mdmts:
+            for sub in subscribers:
+                self.assertIn(sub, m, "MDMT %s for topic %s doesn't reach subscriber %s" % (m, topic, sub))
+            for u, v in m.edges():
+                self.assertTrue(self.topology.topo.has_edge(u, v), "MDMT %s has missing link %s" % (m, (u, v)))
+
+    def test_update_new_subscribers(self):
+        """Even when repairing MDMTs, updating should build MDMTs for new topics and subscribers."""
+        self.assertMdmtsReach(ALERT_TOPIC, ['h0-b0', 'h0-b1'])
+
+        # nothing changed so nothing rebuilt
+        old_mdmts = self.rided.mdmts[ALERT_TOPIC]
+        self.rided.update()
+        self.assertIs(self.rided.mdmts[ALERT_TOPIC], old_mdmts)
+
+        # a new topic, which has no MDMTs
+        self.rided.add_subscriber('h0-b2', 'other_topic')
+        # a new subscriber that isn't grafted onto the existing MDMTs
+        self.rided.add_subscriber('h1-b3', ALERT_TOPIC)
+        self.rided.update()
+        self.assertMdmtsReach('other_topic', ['h0-b2'])
+        self.assertMdmtsReach(ALERT_TOPIC, ['h0-b0', 'h0-b1', 'h1-b3'])
+
+        # grafted subscribers shouldn't require rebuilding the MDMTs
+        self.rided.add_subscriber('h1-b2', 'other_topic', graft=True)
+        old_mdmts = self.rided.mdmts['other_topic']
+        self.rided.update()
+        self.assertIs(self.rided.mdmts['other_topic'], old_mdmts)
+        self.assertMdmtsReach('other_topic', ['h0-b2', 'h1-b2'])
+
+    def test_update_recovered_links(self):
+        """After a failure, the MDMTs are repaired but they should be rebuilt once the failed links recover."""
+        fresh_mdmts = [set(frozenset(e) for e in m.edges()) for m in self.rided.mdmts[ALERT_TOPIC]]
+        # NOTE: choose a link that has alternatives i.e. not a host's or the server's
+        failed_link = next(e for e in self.rided.mdmts[ALERT_TOPIC][0].edges()
+                           if not any(n.startswith('h') or n == self.root for n in e))
+        failed_topo = nx.Graph(self.topo)
+        failed_topo.remove_edge(*failed_link)
+        self.topology.filename = self._write_topology(failed_topo, 'failed_topo.json')
+
+        self.rided.update()
+        self.assertMdmtsReach(ALERT_TOPIC, ['h0-b0', 'h0-b1'])
+        self.assertNotIn(frozenset(failed_link), set(frozenset(e) for e in self.rided.mdmts[ALERT_TOPIC][0].edges()))
+
+        self.topology.filename = self.topo_file
+        self.rided.update()
+        self.assertMdmtsReach(ALERT_TOPIC, ['h0-b0', 'h0-b1'])
+        self.assertEqual([set(frozenset(e) for e in m.edges()) for m in self.rided.mdmts[ALERT_TOPIC]], fresh_mdmts)
+
+    def assertInstalledRules(self):
+        """The flow/group tables should hold exactly the rules compiled for the current MDMTs."""
+        groups = [g for gs, fs in self.rided._installed_mdmt_rules.values() for g in gs]
+        flows = [f for gs, fs in self.rided._installed_mdmt_rules.values() for f in fs]
+        self.assertEqual(sorted(self.topology.get_groups()), sorted(groups))
+        self.assertEqual(sorted(self.topology.get_flow_rules()), sorted(flows))
+
+    def test_prune_uninstalls_stale_rules(self):
+        """Pruning a subscriber's branches should remove the rules for switches no longer in the MDMTs."""
+        self.assertInstalledRules()
+        old_switches = set(r['switch'] for r in self.topology.get_flow_rules())
+
+        self.rided.remove_subscriber('h0-b1', ALERT_TOPIC, prune=True)
+        self.assertInstalledRules()
+        switches = set(r['switch'] for r in self.topology.get_flow_rules())
+        self.assertNotIn('b1', switches)
+        self.assertLess(switches, old_switches)
+        self.assertNotIn('b1', set(g['switch'] for g in self.topology.get_groups()))
+
+    def test_merged_rebuild_uninstalls_stale_rules(self):
+        """Rebuilding merged MDMTs' flow rules should remove the old ones, whose address prefixes would otherwise
+        overlap the new rules that group the MDMTs differently."""
+        topology = NetworkxSdnTopology(self.topo_file)
+        # NOTE: these addresses fall within a /31 prefix so both MDMTs' rules at b0 get merged into one
+        addresses = [('224.0.0.%d' % (i + 2), 9000 + i) for i in range(self.ntrees)]
+        rided = RideD(topology_mgr=topology, ntrees=self.ntrees, dpid=self.root, addresses=addresses,
+                      tree_construction_algorithm=('diverse-paths',), merge_flow_rules=True)
+        rided.add_subscriber('h0-b0', ALERT_TOPIC)
+        rided.update()
+        old_rules = list(topology.get_flow_rules())
+        self.assertIn('224.0.0.2/31', [r['matches'].get('ipv4_dst') for r in topology.get_flow_rules('b0')])
+
+        # another topic's MDMTs use the same addresses but forward elsewhere at b0 so can't be merged there
+        rided.add_subscriber('h1-b0', 'other_topic')
+        rided.update()
+        self.assertNotEqual(sorted(topology.get_flow_rules()), sorted(old_rules))
+
+        # NOTE: compare keys since rules with the same key (e.g. for both topics' MDMTs) replace each other
+        groups, flows = rided._installed_merged_rules
+        self.assertEqual(set(topology.get_flow_rule_key(f) for f in topology.get_flow_rules()),
+                         set(topology.get_flow_rule_key(f) for f in flows))
+        self.assertEqual(set(topology.get_group_key(g) for g in topology.get_groups()),
+                         set(topology.get_group_key(g) for g in groups))
+        for switch, table in topology.flow_tables.items():
+            prefixes = [ipaddress.ip_network(unicode(r['matches']['ipv4_dst'])) for r in table.values()
+                        if 'ipv4_dst' in r['matches'] and r.get('priority') == MULTICAST_FLOW_RULE_PRIORITY]
+            prefixes = [p for p in prefixes if p.is_multicast]
+            for i, a in enumerate(prefixes):
+                for b in prefixes[i+1:]:
+                    self.assertFalse(a.overlaps(b), "switch %s has overlapping multicast rules for %s and %s" %
+                                     (switch, a, b))
+
+
 class TestImportanceMetric(unittest.TestCase):
     """Tests the RideD 'max-link-importance' metric/algorithm"""
 
@@ -1,18 +1,31 @@
 #! /usr/bin/env python
 
-"""This file includes an EchoServer class used for testing with a DataPathMonitor."""
+"""This file includes an EchoServer class used for testing with a DataPathMonitor.  It's also the cloud-side endpoint
+for all of RideC's DataPath probes, so it's a single-threaded event loop that can handle high probing rates: delayed
+responses (for emulating congestion) are kept in a heap rather than each one waiting in its own thread, each wakeup
+reads and answers a batch of probes, and multiple processes (--nprocs) can share the port via SO_REUSEPORT."""
 
-# Reference: https://docs.python.org/2/library/asyncore.html
 import sys
-from socket import *
+import os
+import errno
 import time
-
-import asyncore
+import heapq
+import select
 import socket
 import logging as log
-from threading import Timer
 import argparse
 import random
+from multiprocessing import Process
+
+# When run as a script, the ride package may not be importable
+try:
+    from ride.probe_format import make_probe_response
+except ImportError:
+    from probe_format import make_probe_response
+
+# Python 2's socket module doesn't define this even though Linux (>= 3.9) supports it
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15 if sys.platform.startswith('linux') else None)
+
 
 def parse_args(args):
 
@@ -31,54 +44,165 @@ def parse_args(args):
                         help='''Simulate congestion-induced delay by having the EchoServer simply wait some time before
                          responding to probes.  By default we don't delay; the units are in seconds.''')
 
+    # performance tuning
+    parser.add_argument('--nprocs', '-n', type=int, default=1,
+                        help='''number of server processes sharing the port via SO_REUSEPORT: the kernel balances
+                        probes between them by their source address (default=%(default)s)''')
+    parser.add_argument('--batch_size', '-b', type=int, default=64,
+                        help='''max # probes to read (and then respond to) each time the socket becomes readable
+                        (default=%(default)s)''')
 
     return parser.parse_args(args)
 
-class EchoServer(asyncore.dispatcher):
+
+class EchoServer(object):
+
+    # max size of a probe we'll read
+    BUFFER_SIZE = 2048
 
     def __init__(self, config):
-        # Old-style class 'super' call...
-        asyncore.dispatcher.__init__(self)
+        """
+        :param config: the parsed args (see parse_args()); loss_rate and response_delay can also be changed on the
+        server itself while it's running
+        """
+        super(EchoServer, self).__init__()
 
         self.config = config
         self.loss_rate = config.loss_rate
         self.response_delay = config.response_delay
+        self.batch_size = max(getattr(config, 'batch_size', 1), 1)
 
         # setup socket
-        self.create_socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.set_reuse_addr()
-        self.bind(('', config.port))
-
-        if self.config.quit_time:
-            Timer(self.config.quit_time, self.finish).start()
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if getattr(config, 'nprocs', 1) > 1:
+            if SO_REUSEPORT is None:
+                raise ValueError("SO_REUSEPORT not supported on this platform: can't run multiple processes!")
+            self._socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        self._socket.setblocking(False)
+        self._socket.bind(('', config.port))
+
+        # heap of (time to send, tie-breaker, response, address) for delayed responses
+        self._delayed_responses = []
+        self._ndelayed = 0
+
+        # Self-pipe so that finish() wakes up the event loop
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        # NOTE: set here so that finish() being called before run() still stops it
+        self._running = True
+
+        self._quit_at = time.time() + config.quit_time if config.quit_time else None
 
     def handle_read(self):
-        """Receive the probe, optionally ignore it (loss_rate), and then optionally delay the echo response."""
-        data, addr = self.recvfrom(2048)
-        log.debug("EchoServer read data: %s" % data)
-        if self.loss_rate == 0 or random.random() > self.loss_rate:
+        """Receive a batch of probes, optionally ignore each (loss_rate), and then respond to them now or schedule
+        their responses if we're delaying them (response_delay).  Binary probes are answered as per ride.probe_format
+        (e.g. telling the sender if we don't support its version) while anything else (e.g. JSON probes) is just
+        echoed back."""
+        responses = []
+        now = time.time()
+        for i in range(self.batch_size):
+            try:
+                data, addr = self._socket.recvfrom(self.BUFFER_SIZE)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            log.debug("EchoServer read data: %r", data)
+
+            if self.loss_rate and random.random() <= self.loss_rate:
+                continue
+            data = make_probe_response(data)
             if self.response_delay:
-                log.debug("EchoServer delaying response by %fs" % self.response_delay)
-                Timer(self.response_delay, self.sendto, args=[data, addr]).start()
-                # time.sleep(self.response_delay)
+                self._ndelayed += 1
+                heapq.heappush(self._delayed_responses, (now + self.response_delay, self._ndelayed, data, addr))
             else:
-                self.sendto(data, addr)
-
-    def writable(self):
-        return False
+                responses.append((data, addr))
+
+        self.send_responses(responses)
+
+    def send_responses(self, responses):
+        """Sends the (response, address) pairs.  If the socket's send buffer is full we just drop the rest, which the
+        prober sees the same as congestion-induced loss."""
+        for i, (data, addr) in enumerate(responses):
+            try:
+                self._socket.sendto(data, addr)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+                    log.warning("EchoServer send buffer full: dropping %d responses" % (len(responses) - i))
+                    return
+                raise
+
+    def send_delayed_responses(self):
+        """Sends all of the delayed responses that are due and returns the time (in seconds) until the next one is
+        (None if there aren't any)."""
+        now = time.time()
+        responses = []
+        while self._delayed_responses and self._delayed_responses[0][0] <= now:
+            when, _, data, addr = heapq.heappop(self._delayed_responses)
+            responses.append((data, addr))
+        self.send_responses(responses)
+        if self._delayed_responses:
+            return self._delayed_responses[0][0] - now
+        return None
 
     def finish(self):
-        self.close()
+        """Stops the event loop (which then closes the socket); can be called from another thread."""
+        self._running = False
+        if self._wakeup_write is None:
+            return
+        try:
+            os.write(self._wakeup_write, 'x')
+        except OSError:
+            # already closed
+            pass
 
     def run(self):
         try:
-            asyncore.loop()
+            while self._running:
+                timeout = self.send_delayed_responses()
+                if self._quit_at is not None:
+                    time_to_quit = self._quit_at - time.time()
+                    if time_to_quit <= 0:
+                        break
+                    timeout = time_to_quit if timeout is None else min(timeout, time_to_quit)
+
+                try:
+                    readable = select.select([self._socket, self._wakeup_read], [], [], timeout)[0]
+                except select.error as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                if self._wakeup_read in readable:
+                    os.read(self._wakeup_read, 4096)
+                if self._socket in readable:
+                    self.handle_read()
         except Exception as e:
-            log.error("Error in EchoServer run() can't recover...")
-            self.finish()
+            log.error("Error in EchoServer run() can't recover: %s" % e)
+        finally:
+            self._running = False
+            self._socket.close()
+            wakeup_fds = self._wakeup_read, self._wakeup_write
+            self._wakeup_write = None
+            for fd in wakeup_fds:
+                os.close(fd)
+
+
+def run_server(config):
+    """Runs an EchoServer until it quits (or is interrupted)."""
+    server = EchoServer(config)
+    try:
+        server.run()
+    except KeyboardInterrupt:
+        server.finish()
+
 
 if __name__ == "__main__":
     log.basicConfig(format='%(levelname)s:%(module)s:%(message)s', level=log.DEBUG)
     args = parse_args(sys.argv[1:])
-    server = EchoServer(args)
-    server.run()
\ No newline at end of file
+    # The other processes each bind their own socket to the same port, which the kernel then balances probes across
+    procs = [Process(target=run_server, args=(args,)) for i in range(args.nprocs - 1)]
+    for p in procs:
+        p.start()
+    run_server(args)
+    for p in procs:
+        p.join()
@@ -0,0 +1,103 @@
+#!/usr/bin/python
+
+"""Compiles the flow rules/groups for a topic's MDMTs offline (i.e. without a controller or Mininet) using a
+NetworkxSdnTopology and reports the resulting flow table usage: rules and groups per switch, their estimated total
+size in bytes (as OpenFlow 1.3 messages), and the compile time.  Useful for capacity planning of switches' flow tables
+on large campus topologies.
+
+Example: python tools/flow_table_report.py topos/cloud_campus_topo_20b-10h-5ibl.json -s 10 50 200 -k 2 4 --merge"""
+
+import os
+import sys
+import time
+import random
+import argparse
+
+import ipaddress
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from topology_manager.networkx_sdn_topology import NetworkxSdnTopology
+from config import MULTICAST_ADDRESS_BASE, MULTICAST_ALERT_BASE_SRC_PORT
+from ride.config import MULTICAST_FLOW_RULE_PRIORITY
+
+
+def compile_mdmt_flow_rules(topo, server, subscribers, ntrees, algorithm, merge):
+    """Builds the MDMTs and their flow rules (addressed as in the Mininet experiments) and returns
+    (groups, flow_rules, compile time) where the time doesn't include building the MDMTs."""
+    trees = topo.get_redundant_multicast_trees(server, subscribers, ntrees, algorithm=algorithm[0],
+                                               heur_args=algorithm[1:])
+    base_addr = ipaddress.IPv4Address(MULTICAST_ADDRESS_BASE)
+    addresses = [(str(base_addr + i), MULTICAST_ALERT_BASE_SRC_PORT + i) for i in range(len(trees))]
+    src_ip = topo.get_ip_address(server)
+    matches_params = [dict(ipv4_src=src_ip, ipv4_dst=a[0], udp_src=a[1]) for a in addresses]
+    responses = [{"udp_dst": a[1]} for a in addresses]
+
+    start = time.time()
+    if merge:
+        groups, flows, _ = topo.build_flow_rules_from_multicast_trees(trees, server, matches_params,
+                                                                      range(10, 10 + len(trees)),
+                                                                      route_responses=responses,
+                                                                      priority=MULTICAST_FLOW_RULE_PRIORITY)
+    else:
+        groups = []
+        flows = []
+        for i, (t, params, resp) in enumerate(zip(trees, matches_params, responses)):
+            g, f = topo.build_flow_rules_from_multicast_tree(t, server, topo.build_matches(**params), group_id=i + 10,
+                                                             route_responses=resp,
+                                                             priority=MULTICAST_FLOW_RULE_PRIORITY)
+            groups.extend(g)
+            flows.extend(f)
+    return groups, flows, time.time() - start
+
+
+def run_report(topology_filename, nsubscribers, ntrees, algorithm, merge, nruns, seed, per_switch):
+    topo = NetworkxSdnTopology(topology_filename)
+    hosts = topo.get_hosts()
+    servers = topo.get_servers()
+    random.seed(seed)
+
+    print "topology %s: %d nodes, %d links, %d hosts, %d switches" % (topology_filename, topo.topo.number_of_nodes(),
+                                                                      topo.topo.number_of_edges(), len(hosts),
+                                                                      len(topo.get_switches()))
+    print "nsubs\tk\trun\tcompile_time(s)\tswitches\tflows\tgroups\tbytes\tmax_flows/switch\tmax_groups/switch" \
+          "\tmax_bytes/switch\tavg_flows/switch"
+    for nsubs in nsubscribers:
+        for k in ntrees:
+            for run in range(nruns):
+                subscribers = random.sample(hosts, min(nsubs, len(hosts)))
+                server = random.choice(servers)
+                groups, flows, elapsed = compile_mdmt_flow_rules(topo, server, subscribers, k, algorithm, merge)
+                stats = topo.get_flow_table_stats(flows, groups)
+                totals = [sum(s[field] for s in stats.values()) for field in ('flows', 'groups', 'bytes')]
+                maxes = [max(s[field] for s in stats.values()) for field in ('flows', 'groups', 'bytes')]
+                print "%d\t%d\t%d\t%.3f\t%d\t%d\t%d\t%d\t%d\t%d\t%d\t%.1f" % tuple(
+                    [len(subscribers), k, run, elapsed, len(stats)] + totals + maxes +
+                    [totals[0] / float(len(stats))])
+
+                if per_switch:
+                    print "switch\tflows\tgroups\tbytes"
+                    for switch, s in sorted(stats.items(), key=lambda x: (-x[1]['flows'], x[0])):
+                        print "%s\t%d\t%d\t%d" % (switch, s['flows'], s['groups'], s['bytes'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('topology', help='topology file to load')
+    parser.add_argument('--nsubscribers', '-s', type=int, nargs='+', default=[10, 50, 200],
+                        help='numbers of subscribers (randomly chosen hosts) to report on (default=%(default)s)')
+    parser.add_argument('--ntrees', '-k', type=int, nargs='+', default=[2],
+                        help='numbers of MDMTs to build (default=%(default)s)')
+    parser.add_argument('--mcast-construction-algorithm', '-a', nargs='+', default=['steiner'], dest='algorithm',
+                        help='''MDMT construction algorithm followed by any args to it (default=%(default)s)''')
+    parser.add_argument('--merge', action='store_true',
+                        help='''merge the MDMTs' flow rules where they have identical actions at a switch
+                        (see SdnTopology.build_flow_rules_from_multicast_trees()) (default=%(default)s)''')
+    parser.add_argument('--nruns', '-n', type=int, default=1,
+                        help='runs (randomly chosen subscribers/server) per configuration (default=%(default)s)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for choosing subscribers (default=%(default)s)')
+    parser.add_argument('--per-switch', action='store_true', help='also print the usage of each switch')
+    args = parser.parse_args()
+
+    run_report(args.topology, args.nsubscribers, args.ntrees, args.algorithm, args.merge, args.nruns, args.seed,
+               args.per_switch)
@@ -0,0 +1,65 @@
+#!/usr/bin/python
+
+"""Benchmarks the multi-source disjoint paths algorithms (see dsm_networkx_algorithms.get_multi_source_disjoint_paths)
+on a topology for varying numbers of publishers, reporting the run time and how much the paths overlap.
+
+Example: python tools/multi_source_paths_benchmark.py topos/cloud_campus_topo_20b-10h-5ibl.json -p 50 200 800"""
+
+import os
+import sys
+import time
+import random
+import argparse
+from collections import Counter
+
+import networkx as nx
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from topology_manager.networkx_sdn_topology import NetworkxSdnTopology
+import dsm_networkx_algorithms as dsm_algs
+
+
+def path_stats(G, paths, weight):
+    """Returns (max link sharing, avg link sharing, avg stretch over shortest path) for the given paths."""
+    link_uses = Counter(frozenset(e) for p in paths for e in dsm_algs.get_edges_for_path(p))
+    path_len = lambda p: sum(G[u][v].get(weight, 1) for u, v in dsm_algs.get_edges_for_path(p))
+    stretch = [path_len(p) / max(nx.shortest_path_length(G, p[0], p[-1], weight=weight), 1e-9) for p in paths]
+    return max(link_uses.values()), sum(link_uses.values()) / float(len(link_uses)), sum(stretch) / len(stretch)
+
+
+def run_benchmark(topology_filename, npublishers, algorithms, nruns, weight, seed):
+    topo = NetworkxSdnTopology(topology_filename)
+    G = topo.topo
+    hosts = topo.get_hosts()
+    servers = topo.get_servers()
+    random.seed(seed)
+
+    print "topology %s: %d nodes, %d links, %d hosts" % (topology_filename, G.number_of_nodes(),
+                                                         G.number_of_edges(), len(hosts))
+    print "npubs\talgorithm\ttime(s)\tmax_link_share\tavg_link_share\tavg_stretch"
+    for npubs in npublishers:
+        for run in range(nruns):
+            publishers = random.sample(hosts, min(npubs, len(hosts)))
+            server = random.choice(servers)
+            for alg in algorithms:
+                start = time.time()
+                paths = dsm_algs.get_multi_source_disjoint_paths(G, publishers, server, weight=weight, algorithm=alg)
+                elapsed = time.time() - start
+                assert sorted(p[0] for p in paths) == sorted(publishers)
+                print "%d\t%s\t%.3f\t%d\t%.2f\t%.3f" % ((len(publishers), alg, elapsed) + path_stats(G, paths, weight))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('topology', help='topology file to load')
+    parser.add_argument('--npublishers', '-p', type=int, nargs='+', default=[10, 50, 200],
+                        help='numbers of publishers (randomly chosen hosts) to benchmark (default=%(default)s)')
+    parser.add_argument('--algorithms', '-a', nargs='+', default=['greedy', 'flow'],
+                        help='algorithms to compare (default=%(default)s)')
+    parser.add_argument('--nruns', '-n', type=int, default=1, help='runs per number of publishers (default=%(default)s)')
+    parser.add_argument('--weight', '-w', default='latency', help='edge attribute for path lengths (default=%(default)s)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for choosing publishers (default=%(default)s)')
+    args = parser.parse_args()
+
+    run_benchmark(args.topology, args.npublishers, args.algorithms, args.nruns, args.weight, args.seed)
@@ -1,5 +1,5 @@
 import logging as log
-import math
+import heapq
 
 import networkx as nx
 import dsm_networkx_algorithms as dsm_algs
@@ -14,6 +14,15 @@ class NetworkTopology(object):
     you should implement generic graph algorithms for use in the
     other SdnTopology classes."""
 
+    # cached by get_topology_hierarchy()
+    _hierarchy = None
+    _hierarchy_key = None
+    # worker processes for building trees in parallel: created by get_process_pool() and shut down by close()
+    _process_pool = None
+    _process_pool_size = None
+    # a NetworkTopology for part of another's topology (e.g. its core) shares that one's process pool
+    _parent_topology = None
+
     def __init__(self, topo=None):
         """
         :type topo: nx.Graph
@@ -24,6 +33,41 @@ class NetworkTopology(object):
         else:
             self.topo = topo
 
+    def get_process_pool(self, nprocesses):
+        """
+        Returns a pool of nprocesses worker processes for building trees in parallel.  The pool is created on the
+        first request and then re-used by later ones (e.g. for each topic's MDMTs) until close() is called, as
+        starting the workers for every request would cancel out much of the speed-up.
+        :return: the concurrent.futures.ProcessPoolExecutor or None if concurrent.futures isn't available
+        """
+        if self._parent_topology is not None:
+            return self._parent_topology.get_process_pool(nprocesses)
+
+        import redundant_multicast_algorithms as rma
+        if rma.ProcessPoolExecutor is None:
+            log.warning("Requested %d processes for red-blue construction, but concurrent.futures isn't"
+                        " available (install the 'futures' backport)!  Building trees serially..." % nprocesses)
+            return None
+        if self._process_pool is not None and self._process_pool_size != nprocesses:
+            self.close()
+        if self._process_pool is None:
+            self._process_pool = rma.ProcessPoolExecutor(nprocesses)
+            self._process_pool_size = nprocesses
+        return self._process_pool
+
+    def close(self):
+        """Shuts down the worker processes (if any) used for building trees in parallel."""
+        if self._process_pool is not None:
+            self._process_pool.shutdown()
+            self._process_pool = None
+            self._process_pool_size = None
+
+    def _get_sub_topology(self, topo):
+        """Returns a NetworkTopology for the given part of our topology that shares our process pool."""
+        sub_topology = NetworkTopology(topo)
+        sub_topology._parent_topology = self
+        return sub_topology
+
     def load_from_file(self, filename):
         with open(filename) as f:
             data = json.load(f)
@@ -31,10 +75,24 @@ class NetworkTopology(object):
 
 
     def get_redundant_multicast_trees(self, source, destinations, k=2, algorithm='steiner',
-                                      weight_metric='weight', heur_args=None):
+                                      weight_metric='weight', heur_args=None, nprocesses=None,
+                                      reduce_topology=False, aggregate_destinations=False, hierarchical=False):
         """Builds k redundant multicast trees: trees should not share any edges
         unless necessary.  Supports various algorithms, several of which may not
-        work for k>2."""
+        work for k>2.
+        :param nprocesses: if > 1, the number of worker processes used to build the trees
+         in parallel (currently only supported by the red-blue algorithm)
+        :param reduce_topology: if True, the trees are built on a reduced copy of the topology
+         (see get_reduced_topology()) and then expanded back onto the full topology
+        :param aggregate_destinations: if True, destinations that are leaves (e.g. hosts) are grouped
+         by their attachment point (e.g. edge switch) and the trees are built to reach only these
+         attachment points, after which the leaves are added back to each tree.  Hence the number
+         of terminals (and so the construction time) depends on the # edge switches, not # hosts.
+        :param hierarchical: if True, the trees are built on just the topology's core (e.g. core and building
+         routers) to reach the points where the source's/destinations' pendant subtrees (e.g. buildings' floor/rack
+         switches) hang off of it; these core trees are then composed with the (unique and cached: see
+         get_topology_hierarchy()) routes through the pendant subtrees.  Only the core problem is recomputed
+         for each request, so construction time is roughly independent of the # hosts and buildings' sizes."""
 
         # Need to sanitize the input to ensure that we know about all of the given
         # destinations or else we'll cause an exception.
@@ -46,6 +104,79 @@ class NetworkTopology(object):
             else:
                 destinations.append(d)
 
+        if hierarchical:
+            core, parents, anchors = self.get_topology_hierarchy()
+            core_source = anchors.get(source, source)
+            core_terminals = set(anchors.get(d, d) for d in destinations)
+            core_terminals.discard(core_source)
+            log.debug("composing multicast trees from %d core terminals (out of %d core nodes) for %d destinations" %
+                      (len(core_terminals), core.number_of_nodes(), len(destinations)))
+
+            if core_terminals:
+                core_trees = self._get_sub_topology(core).get_redundant_multicast_trees(
+                    core_source, list(core_terminals), k, algorithm, weight_metric, heur_args, nprocesses,
+                    reduce_topology)
+            else:
+                core_trees = []
+                for i in range(k):
+                    core_trees.append(nx.Graph())
+                    core_trees[-1].add_node(core_source)
+
+            # The routes through the pendant subtrees are the same for each tree
+            pendant_edges = set()
+            for n in [source] + destinations:
+                while n in parents and (n, parents[n]) not in pendant_edges:
+                    pendant_edges.add((n, parents[n]))
+                    n = parents[n]
+
+            trees = []
+            for t in core_trees:
+                new_tree = nx.Graph(self.topo.edge_subgraph(list(t.edges()) + list(pendant_edges)))
+                new_tree.add_nodes_from(t.nodes())
+                new_tree.add_nodes_from(destinations)
+                t = new_tree
+                # routes between nodes in the same pendant subtree needn't reach its anchor
+                self._trim_multicast_tree(t, source, destinations)
+                trees.append(t)
+            return trees
+
+        if aggregate_destinations:
+            attachments = dict()
+            terminals = []
+            for d in destinations:
+                if d != source and self.topo.degree(d) == 1:
+                    attachments.setdefault(next(iter(self.topo.neighbors(d))), []).append(d)
+                else:
+                    terminals.append(d)
+            terminals.extend(a for a in attachments if a != source and a not in terminals)
+            log.debug("aggregated %d destinations to %d terminals for multicast tree construction" %
+                      (len(destinations), len(terminals)))
+
+            if terminals:
+                trees = self.get_redundant_multicast_trees(source, terminals, k, algorithm, weight_metric, heur_args,
+                                                           nprocesses, reduce_topology)
+            else:
+                # all the destinations hang directly off the source so the trees are just those links
+                trees = []
+                for i in range(k):
+                    trees.append(nx.Graph())
+                    trees[-1].add_node(source)
+            # Now fan out from each attachment point to its leaves
+            for t in trees:
+                for a, leaves in attachments.items():
+                    for d in leaves:
+                        t.add_edge(a, d, **self.topo[a][d])
+            return trees
+
+        if reduce_topology:
+            reduced = self.get_reduced_topology([source] + destinations, weight_metric)
+            log.debug("reduced topology from %d nodes/%d links to %d nodes/%d links for multicast tree construction" %
+                      (self.topo.number_of_nodes(), self.topo.number_of_edges(),
+                       reduced.number_of_nodes(), reduced.number_of_edges()))
+            trees = self._get_sub_topology(reduced).get_redundant_multicast_trees(source, destinations, k, algorithm,
+                                                                                  weight_metric, heur_args, nprocesses)
+            return [nx.Graph(dsm_algs.expand_reduced_graph(self.topo, reduced, t)) for t in trees]
+
         if algorithm == 'steiner':
             """Default algorithm implemented by networkx that uses sum of
             shortest paths 2*D approximation.  Currently not available in
@@ -117,8 +248,11 @@ class NetworkTopology(object):
             # but not an edge incident with that node, we have a cycle!
             trees = [set() for i in range(k)]
 
+            # Build the flow network only once for all the destinations
+            all_paths = self.get_redundant_paths_from_source(source, destinations, k)
+
             for _, d in sorted_destinations:
-                paths = self.get_redundant_paths(source, d, k)
+                paths = all_paths[d]
                 # ensure each tree receives a path
                 trees_left = set(range(k))
                 for i, p in enumerate(paths):
@@ -155,30 +289,20 @@ class NetworkTopology(object):
             This only gives us two redundant yet maximally disjoint subgraphs
             so we need to apply some other heuristic to further partition them.
 
-            Currently, we recursively apply this procedure to the pair of graphs
-            in order to generate a number of maximally disjoint trees numbering
-            a power of 2"""
-
-            # TODO: determine how to better support k not powers of 2
-            if k != (2**int(math.log(k, 2))):
-                log.warn("Requested %d redundant red-blue trees, but we currently only fully support powers of 2 for k!  Slicing off tail end of results..." % k)
+            Currently, we recursively apply this procedure to the largest of
+            the resulting graphs until we have k maximally disjoint DAGs.  For k
+            a power of 2 this is the same as splitting every graph each round."""
 
-            from redundant_multicast_algorithms import SkeletonList
+            import redundant_multicast_algorithms as rma
 
-            # Repeatedly apply the procedure over everything currently in the results,
-            # which doubles the number of maximally disjoint spanning DAGs each time
-            results = [self.topo]
+            # Each SkeletonList within a round (and each final steiner tree) is independent of the others,
+            # so we can optionally fan them out across a process pool (re-used across requests: see close()).
+            executor = None
+            if nprocesses is not None and nprocesses > 1:
+                executor = self.get_process_pool(nprocesses)
 
-            for i in range(int(math.ceil(math.log(k, 2)))):
-                this_round = []
-                for t in results:
-                    sl = SkeletonList(t, source)
-                    red_dag = sl.get_red_graph()
-                    blue_dag = sl.get_blue_graph()
-                    this_round.append(red_dag)
-                    this_round.append(blue_dag)
-                results = this_round
-            assert len(results) >= k
+            results = rma.red_blue_partition(self.topo, source, k, executor=executor)
+            assert len(results) == k
 
             # Now we need to turn the results into multicast trees
             try:
@@ -188,10 +312,8 @@ class NetworkTopology(object):
 
             assert all(all(d in g for d in destinations) for g in results)
 
-            # Slice off unrequested results, and then convert to undirected
-            # graphs
-            results = results[:k]
-            results = [steiner_tree(t, destinations, root=source, weight=weight_metric).to_undirected() for t in results]
+            # Convert the DAGs to undirected trees
+            results = rma.dag_steiner_trees(results, destinations, source, weight=weight_metric, executor=executor)
             assert not any(r.is_directed() for r in results)
 
         elif algorithm == 'ilp':
@@ -199,6 +321,35 @@ class NetworkTopology(object):
             from redundant_multicast_algorithms import ilp_redundant_multicast
             results = ilp_redundant_multicast(self.topo, source, destinations, k)
 
+        elif algorithm == 'sparse-ilp':
+            """Sparse version of our ILP formulation (see rma.sparse_ilp_redundant_multicast()) that's
+            warm-started with the red-blue trees.  The optional heuristic args are:
+            args[0] --> solver time limit in seconds (default=no limit)
+            args[1] --> relative MIP gap at which the solver may stop (default=solver's default)
+            args[2] --> # shortest paths per destination defining the candidate links (default=3)"""
+            import redundant_multicast_algorithms as rma
+
+            heur_args = list(heur_args) if heur_args is not None else []
+            heur_args.extend([None] * (3 - len(heur_args)))
+            time_limit = float(heur_args[0]) if heur_args[0] is not None else None
+            mip_gap = float(heur_args[1]) if heur_args[1] is not None else None
+            npaths = int(heur_args[2]) if heur_args[2] is not None else 3
+
+            try:
+                initial_trees = self.get_redundant_multicast_trees(source, destinations, k, 'red-blue', weight_metric,
+                                                                   nprocesses=nprocesses)
+            except (nx.NetworkXException, AssertionError) as e:
+                log.warning("failed to build red-blue trees for warm-starting the ILP so starting from scratch: %s" % e)
+                initial_trees = None
+            if initial_trees is not None and not all(nx.is_tree(t) and source in t and all(d in t for d in destinations)
+                                                     for t in initial_trees):
+                log.warning("red-blue trees aren't valid multicast trees so not warm-starting the ILP with them")
+                initial_trees = None
+
+            results = rma.sparse_ilp_redundant_multicast(self.topo, source, destinations, k, weight=weight_metric,
+                                                         npaths=npaths, time_limit=time_limit, mip_gap=mip_gap,
+                                                         initial_trees=initial_trees)
+
         else:
             raise ValueError("Unkown multicast tree generation algorithm %s" % algorithm)
 
@@ -220,6 +371,234 @@ class NetworkTopology(object):
 
         return results
 
+    def repair_multicast_trees(self, trees, source, destinations, weight_metric='weight'):
+        """Repairs the given (redundant) multicast trees after some of their links/nodes
+        failed (i.e. are no longer in the topology) rather than rebuilding them all.
+        For each tree containing failed components, we remove them and then reattach
+        each orphaned subtree that still contains destinations via the cheapest path
+        from the part of the tree still connected to the source.  To keep the trees
+        maximally disjoint, links used by the sibling trees are penalized so that they're
+        only chosen if no other path exists.  Finally, any branches left leading to
+        no destinations are trimmed.  Hence the work done scales with the failures'
+        footprint rather than with the whole network.
+
+        :param trees: the current trees, which are not modified
+        :type trees: list[nx.Graph]
+        :return: (new_trees, changed) where new_trees contains the repaired trees (and
+         the original unchanged ones) and changed is the list of indices of repaired trees
+        :raises nx.NetworkXError: if the source itself is no longer in the topology
+        """
+
+        if source not in self.topo:
+            raise nx.NetworkXError("can't repair multicast trees as source %s is no longer in the topology!" % source)
+
+        destinations = set(d for d in destinations if d in self.topo)
+        sibling_penalty = self._get_sibling_link_penalty(weight_metric)
+
+        new_trees = list(trees)
+        changed = []
+        for i, tree in enumerate(trees):
+            failed_nodes = [n for n in tree.nodes() if n not in self.topo]
+            failed_edges = [(u, v) for u, v in tree.edges() if not self.topo.has_edge(u, v)]
+            if not failed_nodes and not failed_edges:
+                continue
+            log.debug("repairing multicast tree %d with failed nodes %s and links %s" % (i, failed_nodes, failed_edges))
+
+            t = nx.Graph(tree)
+            t.remove_nodes_from(failed_nodes)
+            t.remove_edges_from(failed_edges)
+            t.add_node(source)
+            sibling_uses = self._get_sibling_link_uses(new_trees, i)
+
+            # Gather the orphaned subtrees that we need to reattach
+            rooted = set(nx.node_connected_component(t, source))
+            orphans = {}
+            for comp in nx.connected_components(t):
+                if source not in comp and any(d in destinations for d in comp):
+                    comp = frozenset(comp)
+                    for n in comp:
+                        orphans[n] = comp
+
+            # Repeatedly find the cheapest path from the rooted part to any orphan
+            while orphans:
+                path = self._get_cheapest_attachment_path(rooted, orphans, sibling_uses, sibling_penalty, weight_metric)
+                if path is None:
+                    lost = set(orphans) & destinations
+                    log.warning("couldn't reattach destinations %s to multicast tree %d as they're unreachable!" % (lost, i))
+                    break
+
+                t.add_edges_from(self.get_edges_for_path(path))
+                comp = orphans[path[-1]]
+                rooted.update(path)
+                rooted.update(comp)
+                for n in comp:
+                    del orphans[n]
+
+            # Remove any nodes not connected to the source along with any branches not leading to a destination
+            t.remove_nodes_from([n for n in list(t.nodes()) if n not in rooted])
+            self._trim_multicast_tree(t, source, destinations)
+
+            new_trees[i] = self._rebuild_multicast_tree(t, tree)
+            changed.append(i)
+
+        return new_trees, changed
+
+    def graft_multicast_trees(self, trees, source, destination, weight_metric='weight'):
+        """Attaches a new destination to each of the given (redundant) multicast trees
+        via the cheapest path from the tree that avoids links used by the sibling
+        trees when possible (see repair_multicast_trees()).
+
+        :param trees: the current trees, which are not modified
+        :type trees: list[nx.Graph]
+        :return: (new_trees, changed) as in repair_multicast_trees()
+        :raises nx.NetworkXNoPath: if the destination can't be reached
+        """
+
+        if destination not in self.topo:
+            raise nx.NetworkXNoPath("can't graft destination %s onto multicast trees as it isn't in the topology!" % destination)
+        sibling_penalty = self._get_sibling_link_penalty(weight_metric)
+
+        new_trees = list(trees)
+        changed = []
+        for i, tree in enumerate(trees):
+            if destination in tree:
+                continue
+
+            tree_nodes = set(tree.nodes())
+            tree_nodes.add(source)
+            sibling_uses = self._get_sibling_link_uses(new_trees, i)
+            path = self._get_cheapest_attachment_path(tree_nodes, (destination,), sibling_uses, sibling_penalty, weight_metric)
+            if path is None:
+                raise nx.NetworkXNoPath("no path to graft destination %s onto multicast tree %d" % (destination, i))
+            log.debug("grafting destination %s onto multicast tree %d via path %s" % (destination, i, path))
+
+            t = nx.Graph(tree)
+            t.add_edges_from(self.get_edges_for_path(path))
+            new_trees[i] = self._rebuild_multicast_tree(t, tree)
+            changed.append(i)
+
+        return new_trees, changed
+
+    def prune_multicast_trees(self, trees, source, destination, destinations):
+        """Removes a departed destination from each of the given multicast trees along
+        with its branch, i.e. anything that no longer leads to one of the (remaining) destinations.
+
+        :param trees: the current trees, which are not modified
+        :type trees: list[nx.Graph]
+        :param destinations: the remaining destinations
+        :return: (new_trees, changed) as in repair_multicast_trees()
+        """
+
+        destinations = set(destinations)
+        destinations.discard(destination)
+
+        new_trees = list(trees)
+        changed = []
+        for i, tree in enumerate(trees):
+            if destination not in tree or destination == source:
+                continue
+            t = nx.Graph(tree)
+            t.remove_node(destination)
+            self._trim_multicast_tree(t, source, destinations)
+            new_trees[i] = self._rebuild_multicast_tree(t, tree)
+            changed.append(i)
+
+        return new_trees, changed
+
+    def _get_sibling_link_penalty(self, weight_metric='weight'):
+        """Penalty for each sibling tree using a link that's larger than the length of any loop-free path."""
+        max_weight = max([w for u, v, w in self.topo.edges(data=weight_metric, default=1)] or [1])
+        return max_weight * self.topo.number_of_nodes()
+
+    @staticmethod
+    def _get_sibling_link_uses(trees, i):
+        """Counts how many of the trees other than the i-th one use each link (as a frozenset of its end-points)."""
+        sibling_uses = {}
+        for j, other in enumerate(trees):
+            if j != i:
+                for u, v in other.edges():
+                    e = frozenset((u, v))
+                    sibling_uses[e] = sibling_uses.get(e, 0) + 1
+        return sibling_uses
+
+    def _get_cheapest_attachment_path(self, tree_nodes, targets, sibling_uses, sibling_penalty, weight_metric='weight'):
+        """Finds the cheapest path (as a list of nodes) from any of the tree_nodes to any of the targets where
+        each link costs its weight plus sibling_penalty for each sibling tree using it.
+        :return: the path or None if no target is reachable"""
+        dist = {}
+        pred = {}
+        heap = [(0, n) for n in tree_nodes]
+        while heap:
+            d, u = heapq.heappop(heap)
+            if u in dist:
+                continue
+            dist[u] = d
+            if u in targets:
+                path = [u]
+                while path[-1] in pred:
+                    path.append(pred[path[-1]][0])
+                path.reverse()
+                return path
+            for v, data in self.topo[u].items():
+                if v in dist or v in tree_nodes:
+                    continue
+                cost = data.get(weight_metric, 1) + sibling_penalty * sibling_uses.get(frozenset((u, v)), 0)
+                if v not in pred or d + cost < pred[v][1]:
+                    pred[v] = (u, d + cost)
+                    heapq.heappush(heap, (d + cost, v))
+        return None
+
+    @staticmethod
+    def _trim_multicast_tree(t, source, destinations):
+        """Trims (in place) any branches of t that don't lead to one of the destinations."""
+        leaves = [n for n in t.nodes() if t.degree(n) <= 1 and n not in destinations and n != source]
+        while leaves:
+            n = leaves.pop()
+            if n not in t:
+                continue
+            neighbors = list(t.neighbors(n))
+            t.remove_node(n)
+            leaves.extend(v for v in neighbors if t.degree(v) <= 1 and v not in destinations and v != source)
+
+    def _rebuild_multicast_tree(self, t, old_tree):
+        """Rebuilds the modified tree t from the topology so all its attributes are up to date,
+        keeping the graph attributes (e.g. address) of the tree it replaces."""
+        new_tree = nx.Graph(self.topo.edge_subgraph(t.edges())) if t.number_of_edges() else nx.Graph()
+        new_tree.add_nodes_from(t.nodes())
+        new_tree.graph.update(old_tree.graph)
+        return new_tree
+
+    def get_topology_hierarchy(self):
+        """Returns the topology's core (a copy of the subgraph remaining after repeatedly removing all leaves)
+        and the pendant subtrees (e.g. buildings) hanging off of it as the (parents, anchors) dicts described in
+        dsm_networkx_algorithms.get_pendant_forest().  This is cached until the topology's nodes/links change.
+        NOTE: we only detect such changes by the # nodes/links (or a new topology object) as checking each link
+        would cost about as much as recomputing this; call clear_topology_hierarchy() after other changes.
+        :rtype: (nx.Graph, dict, dict)"""
+
+        key = (id(self.topo), self.topo.number_of_nodes(), self.topo.number_of_edges())
+        if self._hierarchy is None or self._hierarchy_key != key:
+            parents, anchors = dsm_algs.get_pendant_forest(self.topo)
+            core = nx.Graph(self.topo.subgraph(n for n in self.topo.nodes() if n not in parents))
+            log.debug("topology hierarchy has %d core nodes and %d nodes in pendant subtrees" %
+                      (core.number_of_nodes(), len(parents)))
+            self._hierarchy = (core, parents, anchors)
+            self._hierarchy_key = key
+        return self._hierarchy
+
+    def clear_topology_hierarchy(self):
+        """Forces get_topology_hierarchy() to recompute the core and pendant subtrees next time."""
+        self._hierarchy = None
+
+    def get_reduced_topology(self, terminals, weight_metric='weight'):
+        """Returns a reduced copy of the topology for building trees that connect the given terminals:
+        non-terminal leaves (e.g. hosts other than the terminals) and hence any subtrees (e.g. buildings)
+        without terminals are folded away and chains of degree-2 nodes are contracted into single
+        super-edges weighted by the chain's total weight.  See dsm_networkx_algorithms.reduce_graph()
+        :rtype: nx.Graph"""
+
+        return dsm_algs.reduce_graph(self.topo, terminals, weights=set((weight_metric, 'weight')))
+
     def get_multicast_tree(self, source, destinations, algorithm='steiner'):
         """Uses networkx algorithms to build a multicast tree for the given source node and
         destinations (an iterable).  Can be used to build and install flow rules.
@@ -241,9 +620,17 @@ class NetworkTopology(object):
 
         return dsm_algs.get_redundant_paths(self.topo, source, destination, k)
 
-    def get_multi_source_disjoint_paths(self, sources, target, weight='weight'):
-        """Returns disjoint (possibly shortest) paths from each source to the target."""
-        return dsm_algs.get_multi_source_disjoint_paths(self.topo, sources, target, weight=weight)
+    def get_redundant_paths_from_source(self, source, destinations, k=2):
+        """Same as get_redundant_paths() but for each of the destinations at once:
+        the transformed flow network is built only once for the source and re-used.
+        :returns: dict mapping each destination to its k paths"""
+
+        return dsm_algs.get_redundant_paths_from_source(self.topo, source, destinations, k)
+
+    def get_multi_source_disjoint_paths(self, sources, target, weight='weight', algorithm='flow'):
+        """Returns disjoint (possibly shortest) paths from each source to the target.
+        :param algorithm: 'flow' (default) or 'greedy': see dsm_networkx_algorithms.get_multi_source_disjoint_paths()"""
+        return dsm_algs.get_multi_source_disjoint_paths(self.topo, sources, target, weight=weight, algorithm=algorithm)
 
     def get_path(self, source, destination, weight='weight'):
         """Gets shortest path by the optionally specified weight attribute between the nodes.
@@ -1,8 +1,22 @@
 import logging as log
+from collections import OrderedDict
 
 import networkx as nx
 from sdn_topology import SdnTopology
 
+# Sizes (in bytes) of OpenFlow 1.3 messages/structures used to estimate how much flow table space rules take up
+OFP_FLOW_MOD_SIZE = 48  # ofp_flow_mod without its ofp_match
+OFP_MATCH_HEADER_SIZE = 4
+OFP_OXM_HEADER_SIZE = 4
+OFP_INSTRUCTION_ACTIONS_SIZE = 8
+OFP_GROUP_MOD_SIZE = 16
+OFP_BUCKET_SIZE = 16
+OFP_ACTION_SIZES = {'output': 16, 'group': 8, 'queue': 8}
+OFP_ACTION_SET_FIELD_HEADER_SIZE = 4
+# length of the values of the OXM match fields (also used for set_<field> actions); others are assumed to be 4 bytes
+OFP_OXM_FIELD_SIZES = {'in_port': 4, 'eth_type': 2, 'eth_src': 6, 'eth_dst': 6, 'ip_proto': 1,
+                       'ipv4_src': 4, 'ipv4_dst': 4, 'udp_src': 2, 'udp_dst': 2, 'tcp_src': 2, 'tcp_dst': 2}
+
 
 class NetworkxSdnTopology(SdnTopology):
     """Generates a networkx topology (undirected graph) from information
@@ -10,6 +24,11 @@ class NetworkxSdnTopology(SdnTopology):
     Supports various functions such as finding multicast spanning trees and
     counting number of flow rules that would be installed in a real setting.
 
+    Since there's no controller, we synthesize deterministic port numbers (each node numbers its links from 1 in
+    order of its sorted neighbors) and IP/MAC addresses (unless the topology file specifies 'ip'/'mac' attributes) when
+    building the topology.  Flow rules and groups are plain dicts that are 'installed' into this object's own
+    flow/group tables so that we can e.g. estimate flow table sizes without Mininet (see get_flow_table_stats()).
+
     The inheritance hierarchy works like this: the base class implements
     most of the interesting algorithms by using various helper functions.
     The derived classes implement those helper functions in order to adapt
@@ -21,6 +40,16 @@ class NetworkxSdnTopology(SdnTopology):
          and initialize network topology from."""
         super(NetworkxSdnTopology, self).__init__(None)
         self.filename = filename
+
+        # maps nodes to a dict of their neighbors' port numbers (i.e. the port on that node connecting to the neighbor)
+        self.ports = dict()
+        # maps hosts to their synthesized IP/MAC addresses
+        self.ip_addresses = dict()
+        self.mac_addresses = dict()
+        # the 'installed' flow rules and groups: for each switch, a dict of flow rule key (see get_flow_rule_key())
+        # to flow rule and of group_id to group respectively
+        self.flow_tables = dict()
+        self.group_tables = dict()
         self.build_topology(filename)
 
     def get_info(self):
@@ -73,32 +102,220 @@ class NetworkxSdnTopology(SdnTopology):
 
     # Overridden methods
 
-    def build_topology(self, filename=None):
+    def build_topology(self, filename=None, from_scratch=True):
+        """(Re-)loads the topology from the file (default=the one we were built from).
+        :param from_scratch: ignored as the whole topology is always re-loaded (present for SdnTopology compatibility)"""
         if filename is None:
             filename = self.filename
         self.load_from_file(filename)
+        self.clear_flow_compile_cache()
+        self.clear_topology_hierarchy()
+        self.assign_ports_and_addresses()
+
+    def assign_ports_and_addresses(self):
+        """Assigns each node's links deterministic port numbers and each node IP/MAC addresses (10.x.y.z and
+        00:00:00:x:y:z based on its position in the sorted nodes).  Note that these remain the same if the topology later has nodes/links
+        removed (e.g. failures) so the flow rules we build for the remaining ones don't change."""
+        self.ports = dict()
+        self.ip_addresses = dict()
+        self.mac_addresses = dict()
+        for i, n in enumerate(sorted(self.topo.nodes()), 1):
+            self.ports[n] = dict((neighbor, port) for port, neighbor in enumerate(sorted(self.topo.neighbors(n)), 1))
+            octets = ((i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff)
+            self.ip_addresses[n] = '10.%d.%d.%d' % octets
+            self.mac_addresses[n] = '00:00:00:%02x:%02x:%02x' % octets
 
     def is_host(self, node):
         """Returns True if the given node is a host, False if it is a switch."""
         return node.startswith('h')
 
     def get_ip_address(self, host):
-        """Gets the IP address associated with the given host in the topology.
-        Currently simply returns the host ID (number)."""
-        ip = self.topo.node[host][1:]
+        """Gets the IP address associated with the given host in the topology: either its 'ip' attribute or
+        the one we synthesized for it (see assign_ports_and_addresses())."""
+        ip = self.topo.node[host].get('ip')
+        if ip is None:
+            try:
+                ip = self.ip_addresses[host]
+            except KeyError:
+                raise AttributeError("Host %s has no IPv4 address: was it added after building the topology?" % host)
         return ip
 
+    def get_mac_address(self, host):
+        """Gets the MAC address associated with the given host in the topology: either its 'mac' attribute or
+        the one we synthesized for it (see assign_ports_and_addresses())."""
+        mac = self.topo.node[host].get('mac')
+        if mac is None:
+            try:
+                mac = self.mac_addresses[host]
+            except KeyError:
+                raise AttributeError("Host %s has no MAC address: was it added after building the topology?" % host)
+        return mac
+
     def get_ports_for_nodes(self, n1, n2):
-        """Returns a pair of port numbers (or IDs) corresponding with the link
-        connecting the two specified nodes respectively.  More than one link
-        connecting the nodes is undefined behavior."""
+        """Returns a pair of port numbers corresponding with the link connecting the two specified nodes
+        respectively.  Links added after building the topology are assigned the nodes' next available ports."""
+        if not self.topo.has_edge(n1, n2):
+            raise nx.NetworkXError("no link between %s and %s" % (n1, n2))
+        return self.__get_port(n1, n2), self.__get_port(n2, n1)
+
+    def __get_port(self, node, neighbor):
+        ports = self.ports.setdefault(node, dict())
+        port = ports.get(neighbor)
+        if port is None:
+            port = ports[neighbor] = max(ports.values() or [0]) + 1
+        return port
+
+    # Flow rule helper functions: the rules/groups are just plain dicts
+
+    def build_flow_rule(self, switch, matches, actions, **kwargs):
+        rule = self.__build_flow_rule(switch, **kwargs)
+        rule['matches'] = matches
+        rule['actions'] = actions
+        return rule
+
+    def build_actions(self, *args):
+        """Actions are kept as a list of (action, argument) tuples e.g. [('set_ipv4_dst', '10.0.0.1'), ('output', 3)]"""
+        actions = []
+        for a in args:
+            if isinstance(a, basestring):
+                a = (a,)
+            elif len(a) > 2:
+                raise NotImplementedError("Actions with more than one argument not supported!")
+            actions.append(tuple(a))
+        return actions
+
+    def build_bucket(self, actions, weight=None, watch_group=None, watch_port=None):
+        bucket = {'actions': actions}
+        if weight is not None:
+            bucket['weight'] = weight
+        if watch_port is not None:
+            bucket['watch_port'] = watch_port
+        if watch_group is not None:
+            bucket['watch_group'] = watch_group
+        return bucket
+
+    def build_group(self, switch, buckets, group_id='1', group_type='all', **kwargs):
+        rule = self.__build_flow_rule(switch, **kwargs)
+        rule['group_id'] = group_id
+        rule['group_type'] = group_type
+        rule['buckets'] = buckets
+        return rule
+
+    def __build_flow_rule(self, switch, **kwargs):
+        rule = {'switch': switch}
+        rule.update(kwargs)
+        return rule
+
+    # 'Installing' rules just records them in our flow/group tables
+
+    def get_flow_rule_key(self, rule):
+        return rule['switch'], rule.get('priority'), tuple(sorted(rule['matches'].items()))
+
+    def get_group_key(self, group):
+        return group['switch'], group['group_id']
+
+    def install_flow_rule(self, rule):
+        # like a real switch, a flow rule replaces any existing one with the same priority and matches
+        self.flow_tables.setdefault(rule['switch'], OrderedDict())[self.get_flow_rule_key(rule)] = rule
+        return True
+
+    def install_flow_rules(self, rules):
+        return [self.install_flow_rule(r) for r in rules]
+
+    def install_group(self, group):
+        # like a real switch, a group replaces any existing one with the same ID
+        self.group_tables.setdefault(group['switch'], OrderedDict())[group['group_id']] = group
+        return True
+
+    def get_flow_rules(self, switch=None):
+        if switch is not None:
+            return list(self.flow_tables.get(switch, dict()).values())
+        return [r for rules in self.flow_tables.values() for r in rules.values()]
+
+    def get_groups(self, switch=None):
+        if switch is not None:
+            return list(self.group_tables.get(switch, dict()).values())
+        return [g for groups in self.group_tables.values() for g in groups.values()]
+
+    def remove_flow_rule(self, switch_id, flow_id):
+        """Removes the flow_id'th flow rule installed on the switch (i.e. as ordered by get_flow_rules())."""
+        rules = self.flow_tables[switch_id]
+        del rules[list(rules.keys())[flow_id]]
+        return True
+
+    def uninstall_flow_rule(self, rule):
+        return self.flow_tables.get(rule['switch'], dict()).pop(self.get_flow_rule_key(rule), None) is not None
+
+    def uninstall_group(self, group):
+        return self.group_tables.get(group['switch'], dict()).pop(group['group_id'], None) is not None
+
+    def remove_all_flow_rules(self):
+        self.flow_tables.clear()
+        return True
+
+    def remove_all_groups(self, switch_id=None):
+        if switch_id is None:
+            self.group_tables.clear()
+        else:
+            self.group_tables.pop(switch_id, None)
+        return True
+
+    # Flow table size estimation
+
+    @staticmethod
+    def __get_oxm_size(field, value):
+        size = OFP_OXM_FIELD_SIZES.get(field, 4)
+        # masked (i.e. prefix) matches also include the mask
+        if isinstance(value, basestring) and '/' in value:
+            size *= 2
+        return OFP_OXM_HEADER_SIZE + size
+
+    @staticmethod
+    def __pad(size):
+        return (size + 7) // 8 * 8
+
+    def get_actions_size(self, actions):
+        """Returns the estimated size (in bytes) of the given actions (as returned by build_actions()) within an
+        OpenFlow 1.3 apply-actions instruction or bucket."""
+        size = 0
+        for a in actions:
+            if a[0].startswith('set_'):
+                size += self.__pad(OFP_ACTION_SET_FIELD_HEADER_SIZE + self.__get_oxm_size(a[0][4:], a[1]))
+            else:
+                size += OFP_ACTION_SIZES.get(a[0], 8)
+        return size
+
+    def get_flow_rule_size(self, rule):
+        """Returns the estimated size (in bytes) of the flow rule as an OpenFlow 1.3 flow_mod message."""
+        match_size = OFP_MATCH_HEADER_SIZE + sum(self.__get_oxm_size(k, v) for k, v in rule['matches'].items())
+        return OFP_FLOW_MOD_SIZE + self.__pad(match_size) + OFP_INSTRUCTION_ACTIONS_SIZE + \
+            self.get_actions_size(rule['actions'])
+
+    def get_group_size(self, group):
+        """Returns the estimated size (in bytes) of the group as an OpenFlow 1.3 group_mod message."""
+        return OFP_GROUP_MOD_SIZE + sum(OFP_BUCKET_SIZE + self.get_actions_size(b['actions']) for b in group['buckets'])
 
-        raise NotImplementedError()
+    def get_flow_table_stats(self, flow_rules=None, groups=None):
+        """
+        Returns the # flow rules, # groups, and their estimated total size in bytes (see get_flow_rule_size() and
+        get_group_size()) for each switch.
+        :param flow_rules: rules to count (default=those installed)
+        :param groups: groups to count (default=those installed)
+        :return: dict mapping each switch to a dict with its 'flows', 'groups', and 'bytes'
+        """
+        if flow_rules is None:
+            flow_rules = self.get_flow_rules()
+        if groups is None:
+            groups = self.get_groups()
 
-        # TODO: check whether the storage mechanism of networkx will ensure ordering of edges for this function
-        # Because of the undirected graph model, we have to disambiguate
-        # the directionality of the request in order to properly order
-        # the return values.
+        stats = dict()
+        for rules, field, get_size in ((flow_rules, 'flows', self.get_flow_rule_size),
+                                       (groups, 'groups', self.get_group_size)):
+            for r in rules:
+                switch_stats = stats.setdefault(r['switch'], dict(flows=0, groups=0, bytes=0))
+                switch_stats[field] += 1
+                switch_stats['bytes'] += get_size(r)
+        return stats
 
 if __name__ == '__main__':
     log.basicConfig(format='%(levelname)s:%(message)s', level=log.DEBUG)
@@ -1,3 +1,4 @@
+import json
 import logging
 log = logging.getLogger(__name__)
 
@@ -83,6 +84,27 @@ class OnosSdnTopology(SdnTopology):
         assert isinstance(self.rest_api, OnosRestApi)
         return self.rest_api.batch_push_flow_rules(rules)
 
+    def get_flow_rule_key(self, rule):
+        # NOTE: the criteria are compared regardless of their order
+        criteria = tuple(sorted(json.dumps(c, sort_keys=True) for c in rule['selector']['criteria']))
+        return rule['deviceId'], int(rule['priority']), criteria
+
+    def get_group_key(self, group):
+        return group['deviceId'], self.rest_api.get_group_key(group)
+
+    def uninstall_flow_rule(self, rule):
+        # ONOS assigns installed flow rules their IDs so we have to find the installed version of this one
+        # ENHANCE: get all the switch's flow rules once when uninstalling several of them
+        key = self.get_flow_rule_key(rule)
+        for installed in self.get_flow_rules(rule['deviceId']):
+            if self.get_flow_rule_key(installed) == key:
+                return self.remove_flow_rule(rule['deviceId'], installed['id'])
+        log.warning("couldn't find installed flow rule to uninstall: %s" % rule)
+        return False
+
+    def uninstall_group(self, group):
+        return self.rest_api.remove_group(group['deviceId'], self.rest_api.get_group_key(group))
+
     def build_flow_rule(self, switch, matches, actions, **kwargs):
         """Builds a flow rule that can be installed on the corresponding switch via the RestApi.
 
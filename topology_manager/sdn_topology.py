@@ -2,6 +2,8 @@ import argparse
 import logging
 log = logging.getLogger(__name__)
 import json
+from collections import OrderedDict
+import ipaddress
 import networkx as nx
 
 from network_topology import NetworkTopology
@@ -23,6 +25,10 @@ class SdnTopology(NetworkTopology):
     a particular data model and API (e.g. SDN controller, generic graph, etc.)
     to the SdnTopology tool."""
 
+    # see _get_flow_compile_cache()
+    _flow_compile_cache = None
+    _flow_compile_cache_key = None
+
     def __init__(self, rest_api):
         """
         :param rest_api.base_rest_api.BaseRestApi rest_api:
@@ -62,6 +68,8 @@ class SdnTopology(NetworkTopology):
 
         if from_scratch:
             self.topo.clear()
+        self.clear_flow_compile_cache()
+        self.clear_topology_hierarchy()
 
         # now add all the components
         for s in switches:
@@ -109,15 +117,15 @@ class SdnTopology(NetworkTopology):
 
         src_ip = dst_ip = None
         if use_matches is None:
-            src_ip = self.get_ip_address(path[0])
-            dst_ip = self.get_ip_address(path[-1])
+            src_ip = self._get_cached_ip_address(path[0])
+            dst_ip = self._get_cached_ip_address(path[-1])
 
         rules = []
         for src, switch, dst in zip(path[:-2], path[1:-1], path[2:]):
             # Since the edges in the topology are non-directional, we
             # need to determine which side of the links the src/dst are
-            in_port, _ = self.get_ports_for_nodes(switch, src)
-            out_port, _ = self.get_ports_for_nodes(switch, dst)
+            in_port, _ = self._get_cached_ports_for_nodes(switch, src)
+            out_port, _ = self._get_cached_ports_for_nodes(switch, dst)
 
             if use_queues is None:
                 actions = self.build_actions(("output", out_port))
@@ -166,60 +174,246 @@ class SdnTopology(NetworkTopology):
         group_flows = []
         flows = []
 
-        # Since we assume this is a directed multicast tree from the source,
-        # we should traverse the tree in a specific order from that source.
+        parents, successors = self._get_multicast_tree_bfs(tree, source)
+
         # Starting from the source host's switch (the host doesn't get flow rules),
         # look at each next node the tree reaches and install the proper flow rules for it.
-
-        # When we encounter a leaf of the tree (i.e. a host receiving the multicast packet),
-        # we convert the destination IP/MAC addresses to the final host's actual
-        # IP/MAC address in order to avoid having to manage multicast addresses
-        # being listened to on that host (MAC is necessary or it will drop packet).
-        def __get_action(_node, _succ):
-            port = self.get_ports_for_nodes(_node, _succ)[0]
-            if self.is_host(_succ):
-                _action = self.build_actions(("set_ipv4_dst", self.get_ip_address(_succ)),
-                                             ("set_eth_dst", "ff:ff:ff:ff:ff:ff"),
-                                             ("output", port))
-            else:
-                _action = self.build_actions(("output", port))
-            return _action
-
-        bfs = nx.bfs_successors(tree, source)
-        bfs.next()  # skip source host
-        for node, successors in bfs:
+        group_action = None
+        for node, succs in successors.items():
+            if node == source:
+                continue
             # if only one successor, we don't need a group flow
-            use_group_flow = len(successors) != 1
-            if use_group_flow:
-                # TODO: could move this to a helper function
-                buckets = []
-                for i, succ in enumerate(successors):
-                    action = __get_action(node, succ)
-                    buckets.append(self.build_bucket(action))
-                group_flows.append(self.build_group(node, buckets, group_id, 'ALL'))
-                action = self.build_actions(("group", group_id))
+            if len(succs) != 1:
+                group_flows.append(self.build_group(node, [self._get_cached_bucket(node, succ) for succ in succs],
+                                                    group_id, 'ALL'))
+                if group_action is None:
+                    group_action = self.build_actions(("group", group_id))
+                action = group_action
             else:
-                action = __get_action(node, successors[0])
+                action = self._get_cached_action(node, succs[0])
 
             # TODO: update matches with the src port/IP?
 
             flows.append(self.build_flow_rule(node, matches, action, **kwargs))
 
-            # print node, successors
-
         # To ensure responses flow along the same route as the multicast query, we offer this option to install static
         # routes in the reverse direction:
         if route_responses is not None:
-            # make sure we ignore switches!
-            leaves = set(n for n in tree.nodes() if self.is_host(n)) - {source}
-            for node in leaves:
-                path = nx.shortest_path(tree, node, source)
+            for node, path in self._get_multicast_response_paths(parents, source):
                 response_flows = self.build_flow_rules_from_path(path, add_matches=route_responses)
                 log.debug('adding response flows for node %s: %s' % (node, response_flows))
                 flows.extend(response_flows)
 
         return group_flows, flows
 
+    # match fields that may be dropped from (or, for IP addresses, aggregated into a prefix in) merged multicast
+    # flow rules as long as the merged rule's ipv4_dst prefix only covers the merged trees' addresses
+    MERGEABLE_MATCH_FIELDS = ('ipv4_dst', 'udp_src', 'tcp_src')
+
+    def build_flow_rules_from_multicast_trees(self, trees, source, matches_params, group_ids, route_responses=None,
+                                              merge=True, **kwargs):
+        """Like build_flow_rules_from_multicast_tree(), but for several trees at once (e.g. all MDMTs of all topics)
+        so that we can reduce the # flow table entries: for each switch where several trees forward to the same
+        successors (i.e. have identical actions), we merge their flow rules into one matching an ipv4_dst prefix
+        that covers exactly those trees' addresses (e.g. 224.0.0.0/30 for 224.0.0.[0-3]) and so they share one group.
+        Fields in MERGEABLE_MATCH_FIELDS that differ among the merged trees are dropped from the merged rule.
+        We don't merge trees whose address is also used by a tree with different actions at that switch.
+        The response flow rules are also deduplicated as trees often share the same response route.
+
+        :param trees: the multicast trees (nx.Graph)
+        :param source: source node from which to start the search
+        :param matches_params: for each tree, its matches as key-value pairs (i.e. as passed to build_matches())
+         rather than fully-built matches since we need to merge them
+        :param group_ids: for each tree, the group_id to assign its groups (merged rules use that of the first tree)
+        :param route_responses: None or, for each tree, the matches for its response flow rules (see
+         build_flow_rules_from_multicast_tree())
+        :param merge: if False, just builds the rules for each tree (and reports the occupancy) without merging them
+        :param kwargs: additional arguments passed to build_flow_rule()
+        :return group_flows, flows, occupancy: lists of all groups and flow rules and a dict mapping each switch to a
+         dict with its # 'flows' and 'groups' as well as the # it would have had without merging ('unmerged_flows'
+         and 'unmerged_groups')
+        """
+
+        occupancy = dict()
+
+        def __count(switch, field, n=1):
+            counts = occupancy.setdefault(switch, dict(flows=0, groups=0, unmerged_flows=0, unmerged_groups=0))
+            counts[field] += n
+
+        # Gather up the forwarding entries for each switch: (tree index, successors)
+        bfs_results = [self._get_multicast_tree_bfs(t, source) for t in trees]
+        entries = OrderedDict()
+        for i, (parents, successors) in enumerate(bfs_results):
+            for node, succs in successors.items():
+                if node == source:
+                    continue
+                # sort the successors so that the same actions in different trees are recognized as such
+                entries.setdefault(node, []).append((i, tuple(sorted(succs))))
+                __count(node, 'unmerged_flows')
+                if len(succs) != 1:
+                    __count(node, 'unmerged_groups')
+
+        def __common_key(i):
+            return frozenset((k, v) for k, v in matches_params[i].items() if k not in self.MERGEABLE_MATCH_FIELDS)
+
+        group_flows = []
+        flows = []
+        for switch, switch_entries in entries.items():
+            # Determine which trees we could merge: those with the same successors and non-mergeable match fields
+            merge_sets = OrderedDict()
+            addresses = dict()
+            for i, succs in switch_entries:
+                merge_sets.setdefault((succs, __common_key(i)), []).append(i)
+                addresses.setdefault(matches_params[i].get('ipv4_dst'), set()).add((succs, __common_key(i)))
+
+            blocks = []
+            for (succs, common), indices in merge_sets.items():
+                mergeable = [i for i in indices if merge and matches_params[i].get('ipv4_dst') is not None and
+                             len(addresses[matches_params[i]['ipv4_dst']]) == 1]
+                blocks.extend((succs, [i]) for i in indices if i not in mergeable)
+                if not mergeable:
+                    continue
+                networks = dict()
+                for i in mergeable:
+                    networks.setdefault(ipaddress.ip_network(unicode(matches_params[i]['ipv4_dst'])), []).append(i)
+                for prefix in ipaddress.collapse_addresses(networks.keys()):
+                    # collapsed prefixes are disjoint so each address overlaps exactly one of them
+                    block = [i for net, idx in networks.items() if prefix.overlaps(net) for i in idx]
+                    blocks.append((succs, sorted(block), prefix))
+
+            for block in blocks:
+                succs, indices = block[:2]
+                if len(indices) == 1:
+                    params = matches_params[indices[0]]
+                else:
+                    params = dict(common_item for common_item in matches_params[indices[0]].items()
+                                  if common_item[0] not in self.MERGEABLE_MATCH_FIELDS)
+                    for field in self.MERGEABLE_MATCH_FIELDS:
+                        values = set(matches_params[i].get(field) for i in indices)
+                        if len(values) == 1 and None not in values:
+                            params[field] = values.pop()
+                    params['ipv4_dst'] = str(block[2])
+
+                if len(succs) != 1:
+                    group_id = group_ids[indices[0]]
+                    group_flows.append(self.build_group(switch, [self._get_cached_bucket(switch, succ) for succ in succs],
+                                                        group_id, 'ALL'))
+                    __count(switch, 'groups')
+                    action = self.build_actions(("group", group_id))
+                else:
+                    action = self._get_cached_action(switch, succs[0])
+                flows.append(self.build_flow_rule(switch, self.build_matches(**params), action, **kwargs))
+                __count(switch, 'flows')
+
+        # Response flows: many trees share the same response routes so we just skip any duplicate rules
+        if route_responses is not None:
+            seen = set()
+            for (parents, successors), responses in zip(bfs_results, route_responses):
+                if responses is None:
+                    continue
+                for node, path in self._get_multicast_response_paths(parents, source):
+                    for switch, rule in zip(path[1:-1], self.build_flow_rules_from_path(path, add_matches=responses)):
+                        __count(switch, 'unmerged_flows')
+                        key = json.dumps(rule, sort_keys=True, default=str)
+                        if merge and key in seen:
+                            continue
+                        seen.add(key)
+                        flows.append(rule)
+                        __count(switch, 'flows')
+
+        return group_flows, flows, occupancy
+
+    @staticmethod
+    def _get_multicast_tree_bfs(tree, source):
+        """Since we assume the multicast tree is directed from the source, we traverse it in a specific order from
+        that source.  A single BFS gives us each node's successors (for the multicast flows) as well as its parent
+        (for routing responses back along the tree).
+        :return: parents, successors: OrderedDicts (in BFS order) mapping nodes to their parent/list of successors
+        """
+        parents = OrderedDict([(source, None)])
+        successors = OrderedDict()
+        for u, v in nx.bfs_edges(tree, source):
+            parents[v] = u
+            successors.setdefault(u, []).append(v)
+        return parents, successors
+
+    def _get_multicast_response_paths(self, parents, source):
+        """Generates (host, path) for each host (other than the source) in the multicast tree with the given
+        parents (see _get_multicast_tree_bfs()), where path goes from it back to the source along the tree."""
+        # make sure we ignore switches!
+        for node in parents:
+            if node == source or not self._is_cached_host(node):
+                continue
+            path = [node]
+            while parents[path[-1]] is not None:
+                path.append(parents[path[-1]])
+            yield node, path
+
+    # The actions/buckets for forwarding from a node to its successor only depend on the topology, so we
+    # memoize them across calls (e.g. for each MDMT of each topic) rather than rebuilding them for every rule.
+    # NOTE: this means rules may share the same action objects, so don't modify them in place!
+
+    def _get_cached_action(self, node, succ):
+        """Returns the actions for forwarding multicast packets from node to succ.  When we encounter a leaf of the
+        tree (i.e. a host receiving the multicast packet), we convert the destination IP/MAC addresses to the final
+        host's actual IP/MAC address in order to avoid having to manage multicast addresses being listened to on
+        that host (MAC is necessary or it will drop packet)."""
+        action_cache = self._get_flow_compile_cache()['actions']
+        action = action_cache.get((node, succ))
+        if action is None:
+            port = self._get_cached_ports_for_nodes(node, succ)[0]
+            if self._is_cached_host(succ):
+                action = self.build_actions(("set_ipv4_dst", self._get_cached_ip_address(succ)),
+                                            ("set_eth_dst", "ff:ff:ff:ff:ff:ff"),
+                                            ("output", port))
+            else:
+                action = self.build_actions(("output", port))
+            action_cache[node, succ] = action
+        return action
+
+    def _get_cached_bucket(self, node, succ):
+        bucket_cache = self._get_flow_compile_cache()['buckets']
+        bucket = bucket_cache.get((node, succ))
+        if bucket is None:
+            bucket = bucket_cache[node, succ] = self.build_bucket(self._get_cached_action(node, succ))
+        return bucket
+
+    def _get_flow_compile_cache(self):
+        """Returns the dict of caches used when compiling flow rules (ports/host status/IP addresses of nodes and
+        the actions/buckets for forwarding between them), which are cleared when the topology changes: either by
+        build_topology() or a change in the # nodes (see also clear_flow_compile_cache()).
+        NOTE: we don't check the # links as counting them is O(# nodes) and we look up the caches for every rule!"""
+        key = (id(self.topo), len(self.topo))
+        if self._flow_compile_cache is None or self._flow_compile_cache_key != key:
+            self._flow_compile_cache = dict(ports=dict(), hosts=dict(), ips=dict(), actions=dict(), buckets=dict())
+            self._flow_compile_cache_key = key
+        return self._flow_compile_cache
+
+    def clear_flow_compile_cache(self):
+        """Forces the flow rule compilation caches to be rebuilt e.g. after the topology's ports changed."""
+        self._flow_compile_cache = None
+
+    def _get_cached_ports_for_nodes(self, n1, n2):
+        ports = self._get_flow_compile_cache()['ports']
+        res = ports.get((n1, n2))
+        if res is None:
+            res = ports[n1, n2] = self.get_ports_for_nodes(n1, n2)
+        return res
+
+    def _is_cached_host(self, node):
+        hosts = self._get_flow_compile_cache()['hosts']
+        res = hosts.get(node)
+        if res is None:
+            res = hosts[node] = self.is_host(node)
+        return res
+
+    def _get_cached_ip_address(self, host):
+        ips = self._get_flow_compile_cache()['ips']
+        res = ips.get(host)
+        if res is None:
+            res = ips[host] = self.get_ip_address(host)
+        return res
+
     def build_redirection_flow_rules(self, source, old_dest, new_dest=None, route=None, tp_protocol=None,
                                      source_port=None, old_dest_port=None, new_dest_port=None, **kwargs):
         """
@@ -501,6 +695,28 @@ class SdnTopology(NetworkTopology):
     def remove_flow_rule(self, switch_id, flow_id):
         return self.rest_api.remove_flow_rule(switch_id, flow_id)
 
+    def get_flow_rule_key(self, rule):
+        """Returns a hashable key identifying the flow table entry that the given flow rule (as built by
+        build_flow_rule()) occupies: installing another rule with the same key on its switch replaces it."""
+        raise NotImplementedError
+
+    def get_group_key(self, group):
+        """Returns a hashable key identifying the given group (as built by build_group()) on its switch: installing
+        another group with the same key replaces it."""
+        raise NotImplementedError
+
+    def uninstall_flow_rule(self, rule):
+        """Removes the installed flow rule with the same key (see get_flow_rule_key()) as the given one (as built by
+        build_flow_rule()) from its switch.
+        :return: True if it was removed"""
+        raise NotImplementedError
+
+    def uninstall_group(self, group):
+        """Removes the installed group with the same key (see get_group_key()) as the given one (as built by
+        build_group()) from its switch.
+        :return: True if it was removed"""
+        raise NotImplementedError
+
     def remove_all_flow_rules(self):
         """
         Removes all flow rules from all managed devices that have been added using the REST API.
@@ -0,0 +1,425 @@
+# Test suite for the NetworkTopology class and the graph algorithms it builds on (i.e. those in
+# dsm_networkx_algorithms and redundant_multicast_algorithms).  Unlike test_sdn_topology, these don't need
+# a running SDN controller as they just use small networkx graphs built here.
+
+import unittest
+
+import networkx as nx
+try:
+    import pulp
+except ImportError:
+    pulp = None
+
+import dsm_networkx_algorithms as dsm_algs
+import redundant_multicast_algorithms as rma
+from topology_manager.network_topology import NetworkTopology
+
+
+def build_campus_graph(nbuildings=4, nhosts=2):
+    """
+    Builds a small campus-like topology similar to campus_topo_gen.py's: a server 's0' behind a gateway 'g0' that
+    connects to a ring of 4 core routers (with 2 cross-links), buildings 'b<i>' that each connect to 2 core routers
+    (with links between every other pair of neighboring buildings), and nhosts hosts 'h<j>-b<i>' in each building.
+    Link weights vary so that shortest paths are unique-ish.
+    :rtype: nx.Graph
+    """
+    g = nx.Graph()
+    g.add_edge('s0', 'g0', weight=1)
+    cores = ['c%d' % i for i in range(4)]
+    for i, c in enumerate(cores):
+        g.add_edge('g0', c, weight=1 + i % 2)
+        g.add_edge(c, cores[(i + 1) % len(cores)], weight=2)
+    g.add_edge('c0', 'c2', weight=3)
+    g.add_edge('c1', 'c3', weight=3)
+    for i in range(nbuildings):
+        b = 'b%d' % i
+        g.add_edge(b, cores[i % len(cores)], weight=1)
+        g.add_edge(b, cores[(i + 1) % len(cores)], weight=2)
+        if i % 2 and i > 0:
+            g.add_edge(b, 'b%d' % (i - 1), weight=4)
+        for j in range(nhosts):
+            g.add_edge('h%d-%s' % (j, b), b, weight=1)
+    return g
+
+
+def get_hosts(g):
+    return sorted(n for n in g.nodes() if n.startswith('h'))
+
+
+def edge_set(g):
+    return set(frozenset(e) for e in g.edges())
+
+
+def get_path_costs(g, paths, weight='weight'):
+    """
+    Returns the costs of the given redundant paths in the order the redundant paths algorithms minimize them.
+    :return: 3-tuple of (# times a node other than the endpoints is re-used, # times a link is re-used, total weight)
+    """
+    node_uses = dict()
+    link_uses = dict()
+    total_weight = 0
+    for p in paths:
+        for n in p[1:-1]:
+            node_uses[n] = node_uses.get(n, 0) + 1
+        for u, v in zip(p, p[1:]):
+            link_uses[frozenset((u, v))] = link_uses.get(frozenset((u, v)), 0) + 1
+            total_weight += g[u][v].get(weight, 1)
+    return (sum(c - 1 for c in node_uses.values()), sum(c - 1 for c in link_uses.values()), total_weight)
+
+
+class TestRedBlue(unittest.TestCase):
+    """Tests the red-blue (SkeletonList-based) redundant multicast tree construction."""
+
+    def setUp(self):
+        self.graph = build_campus_graph()
+        self.root = 's0'
+        self.hosts = get_hosts(self.graph)
+
+    def test_partition_sizes(self):
+        """Non-power-of-2 k should give exactly k DAGs that each still reach all the destinations."""
+        for k in (1, 2, 3, 5, 6):
+            dags = rma.red_blue_partition(self.graph, self.root, k)
+            self.assertEqual(len(dags), k, "wrong # DAGs for k=%d" % k)
+            for dag in dags:
+                self.assertTrue(all(h in dag for h in self.hosts), "DAG missing destinations for k=%d" % k)
+
+        # each round should only split the largest DAG(s) e.g. k=3 splits one of the 2 red/blue DAGs again
+        red, blue = rma.red_blue_split([self.graph], self.root)
+        largest = red if red.number_of_edges() >= blue.number_of_edges() else blue
+        dags = rma.red_blue_partition(self.graph, self.root, 3)
+        self.assertIn(set((red if largest is blue else blue).edges()), [set(d.edges()) for d in dags])
+
+    def test_partition_power_of_two(self):
+        """For k a power of 2, the partition should be the same as the old procedure of doubling every DAG."""
+        doubled = [self.graph]
+        for i in range(2):
+            doubled = rma.red_blue_split(doubled, self.root)
+        dags = rma.red_blue_partition(self.graph, self.root, 4)
+        self.assertEqual([set(d.edges()) for d in dags], [set(d.edges()) for d in doubled])
+
+    def test_non_power_of_two_trees(self):
+        topo = NetworkTopology(self.graph)
+        for k in (3, 5):
+            trees = topo.get_redundant_multicast_trees(self.root, self.hosts, k, 'red-blue')
+            self.assertEqual(len(trees), k)
+            for t in trees:
+                self.assertTrue(nx.is_tree(t))
+                self.assertTrue(all(h in t for h in self.hosts))
+
+    def test_parallel_partition(self):
+        """Building the SkeletonLists in a process pool should give exactly the same DAGs as building them serially."""
+        if rma.ProcessPoolExecutor is None:
+            self.skipTest("concurrent.futures not available")
+
+        for k in (2, 3, 4):
+            serial = rma.red_blue_partition(self.graph, self.root, k)
+            executor = rma.ProcessPoolExecutor(2)
+            try:
+                parallel = rma.red_blue_partition(self.graph, self.root, k, executor=executor)
+                # the DAGs' steiner trees should also match
+                serial_trees = rma.dag_steiner_trees(serial, self.hosts, self.root)
+                parallel_trees = rma.dag_steiner_trees(parallel, self.hosts, self.root, executor=executor)
+            finally:
+                executor.shutdown()
+
+            self.assertEqual(len(parallel), k)
+            for s, p in zip(serial, parallel):
+                self.assertEqual(set(s.edges()), set(p.edges()))
+            for s, p in zip(serial_trees, parallel_trees):
+                self.assertEqual(edge_set(s), edge_set(p))
+
+    def test_parallel_trees(self):
+        """Requesting nprocesses > 1 should give the same trees as the serial version."""
+        topo = NetworkTopology(self.graph)
+        serial = topo.get_redundant_multicast_trees(self.root, self.hosts, 4, 'red-blue')
+        try:
+            parallel = topo.get_redundant_multicast_trees(self.root, self.hosts, 4, 'red-blue', nprocesses=2)
+            self.assertEqual([edge_set(t) for t in serial], [edge_set(t) for t in parallel])
+            if rma.ProcessPoolExecutor is None:
+                return
+
+            # the worker processes should be re-used by later requests, including those on the topology's parts
+            pool = topo.get_process_pool(2)
+            parallel = topo.get_redundant_multicast_trees(self.root, self.hosts[:3], 2, 'red-blue', nprocesses=2,
+                                                          reduce_topology=True)
+            self.assertIs(topo.get_process_pool(2), pool)
+            for t in parallel:
+                self.assertTrue(all(h in t for h in self.hosts[:3]))
+        finally:
+            topo.close()
+        self.assertIsNone(topo._process_pool)
+
+
+class TestRedundantPaths(unittest.TestCase):
+    """Tests the various implementations of finding k redundant paths."""
+
+    def setUp(self):
+        self.graph = build_campus_graph()
+        self.source = 's0'
+        self.targets = get_hosts(self.graph) + ['b1', 'c2']
+
+    def assertValidPaths(self, paths, source, target, k):
+        self.assertEqual(len(paths), k)
+        for p in paths:
+            self.assertEqual(p[0], source)
+            self.assertEqual(p[-1], target)
+            self.assertTrue(dsm_algs.path_exists(self.graph, p), "invalid path: %s" % p)
+
+    def test_suurballe(self):
+        """Suurballe's algorithm should find 2 paths just as good (in terms of node sharing, then link sharing, then
+        total weight) as the general min-cost flow formulation."""
+        for t in self.targets:
+            paths = dsm_algs.suurballe_redundant_paths(self.graph, self.source, t)
+            self.assertValidPaths(paths, self.source, t, 2)
+            expected = dsm_algs.min_cost_flow_redundant_paths(self.graph, self.source, t, 2)
+            self.assertEqual(get_path_costs(self.graph, paths), get_path_costs(self.graph, expected),
+                             "suurballe's paths to %s differ from the min-cost flow's" % t)
+
+        # this graph has a cut vertex on the way to the source, which suurballe's algorithm must share
+        g = nx.Graph([('s', 'a'), ('a', 'b'), ('a', 'c'), ('b', 't'), ('c', 't'), ('b', 'c')])
+        paths = dsm_algs.suurballe_redundant_paths(g, 's', 't')
+        expected = dsm_algs.min_cost_flow_redundant_paths(g, 's', 't')
+        self.assertEqual(get_path_costs(g, paths), get_path_costs(g, expected))
+
+    def test_redundant_paths_dispatch(self):
+        """Whichever implementation get_redundant_paths() dispatches to for a k should match the min-cost flow's."""
+        for k in (2, 3, 4, dsm_algs.SUCCESSIVE_SHORTEST_PATHS_MAX_K + 1):
+            for t in self.targets:
+                paths = dsm_algs.get_redundant_paths(self.graph, self.source, t, k)
+                self.assertValidPaths(paths, self.source, t, k)
+                expected = dsm_algs.min_cost_flow_redundant_paths(self.graph, self.source, t, k)
+                self.assertEqual(get_path_costs(self.graph, paths), get_path_costs(self.graph, expected),
+                                 "paths to %s with k=%d differ from the min-cost flow's" % (t, k))
+
+    def test_paths_from_source(self):
+        """Re-using the flow network for all the targets should give paths just as good as computing each target's
+        paths from scratch."""
+        for k in (2, 3, 4):
+            all_paths = dsm_algs.get_redundant_paths_from_source(self.graph, self.source, self.targets, k)
+            self.assertEqual(set(all_paths.keys()), set(self.targets))
+            for t in self.targets:
+                self.assertValidPaths(all_paths[t], self.source, t, k)
+                expected = dsm_algs.get_redundant_paths(self.graph, self.source, t, k)
+                self.assertEqual(get_path_costs(self.graph, all_paths[t]), get_path_costs(self.graph, expected),
+                                 "different path costs for target %s with k=%d" % (t, k))
+
+        # also through the NetworkTopology interface
+        topo = NetworkTopology(self.graph)
+        all_paths = topo.get_redundant_paths_from_source(self.source, self.targets, 2)
+        for t in self.targets:
+            self.assertEqual(get_path_costs(self.graph, all_paths[t]),
+                             get_path_costs(self.graph, topo.get_redundant_paths(self.source, t, 2)))
+
+
+class TestReducedTopology(unittest.TestCase):
+    """Tests reducing the topology for tree construction and expanding the results back onto it."""
+
+    def setUp(self):
+        self.graph = build_campus_graph()
+        # add a chain of degree-2 routers between the gateway and a new building to be contracted
+        nx.add_path(self.graph, ['c3', 'r0', 'r1', 'r2', 'b4'], weight=2)
+        self.graph.add_edge('h0-b4', 'b4', weight=1)
+        self.graph.add_edge('b4', 'b0', weight=20)
+        self.source = 's0'
+        self.terminals = ['h0-b0', 'h1-b1', 'h0-b4']
+
+    def test_reduce(self):
+        reduced = dsm_algs.reduce_graph(self.graph, [self.source] + self.terminals)
+        for n in [self.source] + self.terminals:
+            self.assertIn(n, reduced)
+        # non-terminal hosts are folded away and the chain is contracted
+        for n in ('h1-b0', 'h0-b2', 'h1-b3', 'r0', 'r1', 'r2'):
+            self.assertNotIn(n, reduced)
+        self.assertEqual(reduced['c3']['b4']['weight'], 8)
+        # NOTE: the contracted path may be stored in either direction
+        path = reduced['c3']['b4'][dsm_algs.CONTRACTED_PATH_ATTRIBUTE]
+        self.assertIn(path, (['c3', 'r0', 'r1', 'r2', 'b4'], ['b4', 'r2', 'r1', 'r0', 'c3']))
+        # shortest path distances between the terminals are preserved
+        for t in self.terminals:
+            self.assertEqual(nx.shortest_path_length(reduced, self.source, t, weight='weight'),
+                             nx.shortest_path_length(self.graph, self.source, t, weight='weight'))
+
+    def test_round_trip(self):
+        """Expanding a subgraph of the reduced topology should give the corresponding subgraph of the original with
+        the contracted chains restored and the same total weight."""
+        reduced = dsm_algs.reduce_graph(self.graph, [self.source] + self.terminals)
+        paths = [nx.shortest_path(reduced, self.source, t, weight='weight') for t in self.terminals]
+        reduced_tree = nx.Graph()
+        for p in paths:
+            nx.add_path(reduced_tree, p)
+
+        expanded = dsm_algs.expand_reduced_graph(self.graph, reduced, reduced_tree)
+        self.assertTrue(nx.is_tree(expanded))
+        self.assertTrue(all(self.graph.has_edge(u, v) for u, v in expanded.edges()))
+        self.assertIn(frozenset(('r1', 'r2')), edge_set(expanded))
+        self.assertEqual(expanded.size(weight='weight'),
+                         sum(reduced[u][v]['weight'] for u, v in reduced_tree.edges()))
+
+        # an edgeless subgraph should keep its nodes
+        lone = nx.Graph()
+        lone.add_node(self.source)
+        self.assertEqual(list(dsm_algs.expand_reduced_graph(self.graph, reduced, lone).nodes()), [self.source])
+
+    def test_reduced_trees(self):
+        """Building the trees on the reduced topology should still give valid trees on the full one."""
+        topo = NetworkTopology(self.graph)
+        for alg in ('steiner', 'diverse-paths'):
+            trees = topo.get_redundant_multicast_trees(self.source, self.terminals, 2, alg, reduce_topology=True)
+            self.assertEqual(len(trees), 2)
+            for t in trees:
+                self.assertTrue(nx.is_tree(t), "%s didn't build a tree" % alg)
+                self.assertTrue(all(n in t for n in [self.source] + self.terminals))
+                self.assertTrue(all(self.graph.has_edge(u, v) for u, v in t.edges()))
+
+
+@unittest.skipIf(pulp is None, "pulp isn't installed")
+class TestSparseIlp(unittest.TestCase):
+    """Tests the sparse ILP formulation warm-started with the red-blue trees."""
+
+    def test_sparse_ilp_trees(self):
+        g = build_campus_graph()
+        topo = NetworkTopology(g)
+        source = 's0'
+        hosts = get_hosts(g)
+        red_blue = topo.get_redundant_multicast_trees(source, hosts, 2, 'red-blue')
+        trees = topo.get_redundant_multicast_trees(source, hosts, 2, 'sparse-ilp', heur_args=(30,))
+
+        self.assertEqual(len(trees), 2)
+        for t in trees:
+            self.assertTrue(nx.is_tree(t))
+            self.assertTrue(all(n in t for n in [source] + hosts))
+            self.assertTrue(all(g.has_edge(u, v) for u, v in t.edges()))
+        self.assertLessEqual(rma.get_overlap_cost(trees), rma.get_overlap_cost(red_blue))
+
+
+class TestAggregateDestinations(unittest.TestCase):
+    """Tests building trees to the destinations' attachment points rather than the destinations themselves."""
+
+    def test_aggregated_trees(self):
+        g = build_campus_graph()
+        hosts = get_hosts(g)
+        trees = NetworkTopology(g).get_redundant_multicast_trees('s0', hosts, 2, 'steiner',
+                                                                 aggregate_destinations=True)
+        self.assertEqual(len(trees), 2)
+        for t in trees:
+            self.assertTrue(nx.is_tree(t))
+            self.assertTrue(all(n in t for n in ['s0'] + hosts))
+            self.assertTrue(all(g.has_edge(u, v) for u, v in t.edges()))
+
+    def test_destinations_at_source(self):
+        """When all destinations are leaves attached to the source there's nothing to build trees to."""
+        g = build_campus_graph()
+        leaves = ['h0-s0', 'h1-s0']
+        for h in leaves:
+            g.add_edge(h, 's0', weight=1)
+        trees = NetworkTopology(g).get_redundant_multicast_trees('s0', leaves, 3, 'steiner',
+                                                                 aggregate_destinations=True)
+        self.assertEqual(len(trees), 3)
+        for t in trees:
+            self.assertEqual(edge_set(t), set([frozenset(('s0', h)) for h in leaves]))
+            self.assertEqual(t['s0']['h0-s0']['weight'], 1)
+
+
+class TestHierarchicalTrees(unittest.TestCase):
+    """Tests composing trees built on the topology's core with the routes through its pendant subtrees."""
+
+    def setUp(self):
+        self.g = build_campus_graph()
+        # a floor switch in building 0 so it has a pendant subtree deeper than just its hosts
+        self.floor_hosts = ['h0-f0', 'h1-f0']
+        self.g.add_edge('f0-b0', 'b0', weight=1)
+        for h in self.floor_hosts:
+            self.g.add_edge(h, 'f0-b0', weight=1)
+        self.topo = NetworkTopology(self.g)
+
+    def assertTreesReach(self, trees, source, destinations):
+        for t in trees:
+            self.assertTrue(nx.is_tree(t), "not a tree: %s" % list(t.edges()))
+            self.assertTrue(all(n in t for n in [source] + destinations))
+            self.assertTrue(all(self.g.has_edge(u, v) for u, v in t.edges()))
+
+    def test_hierarchical_trees(self):
+        hosts = get_hosts(self.g)
+        trees = self.topo.get_redundant_multicast_trees('s0', hosts, 2, 'steiner', hierarchical=True)
+        self.assertEqual(len(trees), 2)
+        self.assertTreesReach(trees, 's0', hosts)
+        for t in trees:
+            # the pendant subtrees' routes are unique
+            self.assertTrue(t.has_edge('f0-b0', 'b0'))
+            self.assertTrue(t.has_edge('s0', 'g0'))
+            # no branches leading nowhere
+            self.assertEqual([n for n in t.nodes() if t.degree(n) == 1 and n not in hosts], ['s0'])
+
+    def test_same_pendant_subtree(self):
+        """When the source and destinations share a pendant subtree, the trees shouldn't go up to its anchor."""
+        source, dest = self.floor_hosts
+        trees = self.topo.get_redundant_multicast_trees(source, [dest], 2, 'steiner', hierarchical=True)
+        self.assertEqual(len(trees), 2)
+        self.assertTreesReach(trees, source, [dest])
+        for t in trees:
+            self.assertEqual(edge_set(t), set([frozenset((source, 'f0-b0')), frozenset(('f0-b0', dest))]))
+
+        # another building's host is reached through the core while the floor's host isn't routed via b0's core
+        dests = [dest, 'h0-b2']
+        trees = self.topo.get_redundant_multicast_trees(source, dests, 2, 'steiner', hierarchical=True)
+        self.assertTreesReach(trees, source, dests)
+        for t in trees:
+            self.assertEqual(t.degree(dest), 1)
+            self.assertTrue(t.has_edge('f0-b0', dest))
+            self.assertIn('b0', t)
+
+
+class TestMultiSourcePaths(unittest.TestCase):
+    """Tests the algorithms for finding disjoint paths from many sources (e.g. publishers) to one target."""
+
+    def test_greedy_disjoint(self):
+        """The greedy algorithm should find completely disjoint paths when they exist even though all the sources'
+        shortest paths go through the same node."""
+        g = nx.Graph()
+        for i in range(3):
+            g.add_edge('a%d' % i, 't', weight=1 if i == 0 else 5)
+            for j in range(3):
+                g.add_edge('s%d' % j, 'a%d' % i, weight=1 if i == 0 else 5)
+        sources = ['s0', 's1', 's2']
+
+        paths = dsm_algs.get_multi_source_disjoint_paths(g, sources, 't', algorithm='greedy')
+        self.assertEqual([p[0] for p in paths], sources)
+        for p in paths:
+            self.assertEqual(p[-1], 't')
+            self.assertTrue(dsm_algs.path_exists(g, p))
+        self.assertEqual(get_path_costs(g, paths)[:2], (0, 0))
+        # the same as the min-cost flow version in this case
+        expected = dsm_algs.get_multi_source_disjoint_paths(g, sources, 't', algorithm='flow')
+        self.assertEqual(get_path_costs(g, paths), get_path_costs(g, expected))
+
+    def test_greedy_campus(self):
+        """On a tree-like campus topology the paths must share some components, but the greedy algorithm should
+        still give every source a path and share less than just taking each source's shortest path."""
+        g = build_campus_graph()
+        sources = get_hosts(g)
+        topo = NetworkTopology(g)
+        paths = topo.get_multi_source_disjoint_paths(sources, 's0', algorithm='greedy')
+        self.assertEqual([p[0] for p in paths], sources)
+        for p in paths:
+            self.assertEqual(p[-1], 's0')
+            self.assertTrue(dsm_algs.path_exists(g, p))
+
+        shortest_paths = [nx.shortest_path(g, src, 's0', weight='weight') for src in sources]
+        self.assertLess(get_path_costs(g, paths)[:2], get_path_costs(g, shortest_paths)[:2])
+
+        with self.assertRaises(ValueError):
+            topo.get_multi_source_disjoint_paths(sources, 's0', algorithm='bogus')
+
+    def test_greedy_duplicate_sources(self):
+        """A source listed more than once should get its (single) path for each of its entries."""
+        g = build_campus_graph()
+        hosts = get_hosts(g)
+        sources = hosts[:3] + hosts[:2]
+        paths = dsm_algs.get_multi_source_disjoint_paths(g, sources, 's0', algorithm='greedy')
+        self.assertEqual([p[0] for p in paths], sources)
+        self.assertEqual(paths[3:], paths[:2])
+        self.assertEqual(paths[:3], dsm_algs.get_multi_source_disjoint_paths(g, hosts[:3], 's0', algorithm='greedy'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,265 @@
+# Test suite for the NetworkxSdnTopology adapter, which builds its topology from a networkx JSON file and 'installs'
+# flow rules into its own tables so, unlike test_sdn_topology, it needs no running SDN controller.
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import ipaddress
+from collections import OrderedDict
+
+import networkx as nx
+from networkx.readwrite import json_graph
+
+from topology_manager.networkx_sdn_topology import NetworkxSdnTopology
+from topology_manager.test_network_topology import build_campus_graph, get_hosts
+
+
+def build_uncached_multicast_flow_rules(topology, tree, source, matches, group_id, route_responses):
+    """Compiles the multicast tree's flow rules as SdnTopology.build_flow_rules_from_multicast_tree() did before
+    memoizing the ports, addresses, actions, and buckets: it's the reference for checking the cached version."""
+    def get_action(node, succ):
+        port = topology.get_ports_for_nodes(node, succ)[0]
+        if topology.is_host(succ):
+            return topology.build_actions(("set_ipv4_dst", topology.get_ip_address(succ)),
+                                          ("set_eth_dst", "ff:ff:ff:ff:ff:ff"), ("output", port))
+        return topology.build_actions(("output", port))
+
+    successors = OrderedDict()
+    for u, v in nx.bfs_edges(tree, source):
+        successors.setdefault(u, []).append(v)
+    groups = []
+    flows = []
+    for node, succs in successors.items():
+        if node == source:
+            continue
+        if len(succs) != 1:
+            groups.append(topology.build_group(node, [topology.build_bucket(get_action(node, s)) for s in succs],
+                                               group_id, 'ALL'))
+            action = topology.build_actions(("group", group_id))
+        else:
+            action = get_action(node, succs[0])
+        flows.append(topology.build_flow_rule(node, matches, action))
+
+    for leaf in set(n for n in tree.nodes() if topology.is_host(n)) - {source}:
+        path = nx.shortest_path(tree, leaf, source)
+        for src, switch, dst in zip(path[:-2], path[1:-1], path[2:]):
+            matches_params = dict(in_port=topology.get_ports_for_nodes(switch, src)[0],
+                                  ipv4_src=topology.get_ip_address(path[0]), ipv4_dst=topology.get_ip_address(path[-1]))
+            matches_params.update(route_responses)
+            flows.append(topology.build_flow_rule(switch, topology.build_matches(**matches_params),
+                                                  topology.build_actions(("output",
+                                                                          topology.get_ports_for_nodes(switch, dst)[0]))))
+    return groups, flows
+
+
+def sorted_rules(rules):
+    return sorted(rules, key=lambda r: json.dumps(r, sort_keys=True))
+
+
+def is_multicast_rule(rule):
+    return ipaddress.ip_network(unicode(rule['matches']['ipv4_dst'])).is_multicast
+
+
+def get_forwarding(rule, groups):
+    """Returns the set of actions the rule applies to a packet (i.e. those of its group's buckets if it has one).
+    :param groups: dict mapping (switch, group_id) to the groups"""
+    actions = rule['actions']
+    if actions[0][0] == 'group':
+        return frozenset(tuple(b['actions']) for b in groups[rule['switch'], actions[0][1]]['buckets'])
+    return frozenset([tuple(actions)])
+
+
+class TestNetworkxSdnTopology(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.graph = build_campus_graph()
+        self.topo_file = self._write_topology(self.graph, 'topo.json')
+        self.topology = NetworkxSdnTopology(self.topo_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _write_topology(self, topo, name):
+        filename = os.path.join(self.tmp_dir, name)
+        with open(filename, 'w') as f:
+            json.dump(json_graph.node_link_data(topo), f)
+        return filename
+
+    def test_rebuild_clears_hierarchy(self):
+        """Re-building the topology should recompute its hierarchy even if the # nodes/links didn't change."""
+        core, parents, anchors = self.topology.get_topology_hierarchy()
+        self.assertEqual(anchors['h0-b0'], 'b0')
+
+        # move a host to another building
+        moved = nx.Graph(self.graph)
+        moved.remove_edge('h0-b0', 'b0')
+        moved.add_edge('h0-b0', 'b1', weight=1)
+        self.topology.build_topology(self._write_topology(moved, 'moved.json'))
+        core, parents, anchors = self.topology.get_topology_hierarchy()
+        self.assertEqual(anchors['h0-b0'], 'b1')
+
+
+    def _get_trees(self, graph):
+        """Returns a couple of different multicast trees from the server to all hosts."""
+        trees = []
+        for weight in ('weight', None):
+            t = nx.Graph()
+            for p in nx.single_source_dijkstra_path(graph, 's0', weight=weight).values():
+                if p[-1] in get_hosts(graph):
+                    nx.add_path(t, p)
+            trees.append(t)
+        return trees
+
+    def assertSameRules(self, trees, topology):
+        reference = NetworkxSdnTopology(topology.filename)
+        for i, t in enumerate(trees):
+            matches = topology.build_matches(ipv4_dst='224.0.0.%d' % (i + 1), udp_dst=9000 + i)
+            groups, flows = topology.build_flow_rules_from_multicast_tree(t, 's0', matches, group_id=i + 10,
+                                                                          route_responses=dict(udp_dst=9000 + i))
+            expected_groups, expected_flows = build_uncached_multicast_flow_rules(reference, t, 's0', matches, i + 10,
+                                                                                  dict(udp_dst=9000 + i))
+            self.assertEqual(groups, expected_groups)
+            self.assertEqual(sorted_rules(flows), sorted_rules(expected_flows))
+
+    def test_flow_compile_cache(self):
+        """Compiling several trees with the memoized ports/actions should give the same rules as without them,
+        including after the topology is re-built with different ports."""
+        trees = self._get_trees(self.graph)
+        # twice so the second time is all cache hits
+        self.assertSameRules(trees, self.topology)
+        self.assertSameRules(trees, self.topology)
+
+        # adding a link changes some nodes' port numbers and moving the host changes its attachment point
+        moved = nx.Graph(self.graph)
+        moved.remove_edge('h0-b0', 'b0')
+        moved.add_edge('h0-b0', 'b1', weight=1)
+        moved.add_edge('b0', 'b3', weight=4)
+        self.topology.build_topology(self._write_topology(moved, 'moved.json'))
+        self.topology.filename = os.path.join(self.tmp_dir, 'moved.json')
+        self.assertSameRules(self._get_trees(moved), self.topology)
+
+
+    def test_merged_flow_rules(self):
+        """Merged rules' prefixes should cover exactly the addresses of the trees they merge and forward each of
+        those trees' packets as its unmerged rules do, while duplicate response rules should be dropped."""
+        a, b = self._get_trees(self.graph)
+        trees = [a, a, b, a, a]
+        addresses = ['224.0.0.0', '224.0.0.1', '224.0.0.2', '224.0.0.3', '224.0.0.5']
+        server_ip = self.topology.get_ip_address('s0')
+        matches_params = [dict(ipv4_src=server_ip, ipv4_dst=addr, udp_src=9000 + i) for i, addr in enumerate(addresses)]
+        group_ids = [10 + i for i in range(len(trees))]
+        responses = [dict(udp_dst=9000)] * len(trees)
+
+        results = dict()
+        for merge in (True, False):
+            groups, flows, occupancy = self.topology.build_flow_rules_from_multicast_trees(
+                trees, 's0', matches_params, group_ids, route_responses=responses, merge=merge)
+            groups = {(g['switch'], g['group_id']): g for g in groups}
+            results[merge] = groups, flows, occupancy
+        merged_groups, merged_flows, occupancy = results[True]
+        unmerged_groups, unmerged_flows = results[False][:2]
+        self.assertLess(len(merged_flows), len(unmerged_flows))
+        self.assertEqual(sum(o['flows'] for o in occupancy.values()), len(merged_flows))
+        self.assertEqual(sum(o['unmerged_flows'] for o in occupancy.values()), len(unmerged_flows))
+
+        # each tree's packets match exactly one rule at each of its switches, which forwards them the same way
+        for rule in (r for r in unmerged_flows if is_multicast_rule(r)):
+            address = ipaddress.ip_address(unicode(rule['matches']['ipv4_dst']))
+            matching = [r for r in merged_flows if r['switch'] == rule['switch'] and is_multicast_rule(r) and
+                        address in ipaddress.ip_network(unicode(r['matches']['ipv4_dst']))]
+            self.assertEqual(len(matching), 1, "%s matches %d merged rules" % (rule, len(matching)))
+            self.assertEqual(get_forwarding(matching[0], merged_groups), get_forwarding(rule, unmerged_groups))
+            self.assertEqual(matching[0]['matches']['ipv4_src'], server_ip)
+
+        # and the prefixes only cover those trees' addresses
+        for rule in (r for r in merged_flows if is_multicast_rule(r)):
+            covered = [addr for addr in addresses
+                       if ipaddress.ip_address(unicode(addr)) in ipaddress.ip_network(unicode(rule['matches']['ipv4_dst']))]
+            self.assertEqual(ipaddress.ip_network(unicode(rule['matches']['ipv4_dst'])).num_addresses, len(covered))
+            if len(covered) > 1:
+                self.assertNotIn('udp_src', rule['matches'])
+
+        # the response rules are the same, just without duplicates
+        merged_responses = [json.dumps(r, sort_keys=True) for r in merged_flows if not is_multicast_rule(r)]
+        unmerged_responses = [json.dumps(r, sort_keys=True) for r in unmerged_flows if not is_multicast_rule(r)]
+        self.assertEqual(len(merged_responses), len(set(merged_responses)))
+        self.assertEqual(set(merged_responses), set(unmerged_responses))
+        self.assertLess(len(merged_responses), len(unmerged_responses))
+
+
+    def test_ports_and_addresses(self):
+        """Ports and addresses should be synthesized deterministically and uniquely unless the file specifies them."""
+        other = NetworkxSdnTopology(self.topo_file)
+        for n in self.graph.nodes():
+            ports = [self.topology.get_ports_for_nodes(n, neighbor)[0] for neighbor in self.graph.neighbors(n)]
+            self.assertEqual(sorted(ports), range(1, self.graph.degree(n) + 1))
+            for neighbor in self.graph.neighbors(n):
+                self.assertEqual(self.topology.get_ports_for_nodes(n, neighbor),
+                                 other.get_ports_for_nodes(n, neighbor))
+                self.assertEqual(self.topology.get_ports_for_nodes(n, neighbor),
+                                 tuple(reversed(self.topology.get_ports_for_nodes(neighbor, n))))
+        hosts = get_hosts(self.graph)
+        for get_address in (NetworkxSdnTopology.get_ip_address, NetworkxSdnTopology.get_mac_address):
+            self.assertEqual(len(set(get_address(self.topology, h) for h in hosts)), len(hosts))
+            self.assertEqual([get_address(self.topology, h) for h in hosts], [get_address(other, h) for h in hosts])
+        with self.assertRaises(nx.NetworkXError):
+            self.topology.get_ports_for_nodes('h0-b0', 'b1')
+
+        # a failed link doesn't change the other ports while a new one gets the next available ones
+        ports = self.topology.get_ports_for_nodes('b0', 'c1')
+        self.topology.topo.remove_edge('b0', 'c0')
+        self.assertEqual(self.topology.get_ports_for_nodes('b0', 'c1'), ports)
+        self.topology.topo.add_edge('b0', 'c2')
+        self.assertEqual(self.topology.get_ports_for_nodes('b0', 'c2'),
+                         (self.graph.degree('b0') + 1, self.graph.degree('c2') + 1))
+        # but new hosts have no addresses
+        self.topology.topo.add_edge('h9-b0', 'b0')
+        with self.assertRaises(AttributeError):
+            self.topology.get_ip_address('h9-b0')
+
+        # addresses given in the topology file take precedence
+        graph = nx.Graph(self.graph)
+        graph.nodes['h0-b0'].update(ip='192.168.1.1', mac='11:22:33:44:55:66')
+        topology = NetworkxSdnTopology(self._write_topology(graph, 'addresses.json'))
+        self.assertEqual(topology.get_ip_address('h0-b0'), '192.168.1.1')
+        self.assertEqual(topology.get_mac_address('h0-b0'), '11:22:33:44:55:66')
+        self.assertEqual(topology.get_ip_address('h1-b0'), self.topology.get_ip_address('h1-b0'))
+
+    def test_flow_table_stats(self):
+        t = self.topology
+        rule = t.build_flow_rule('b0', t.build_matches(in_port=1, ipv4_dst='10.0.0.1'), t.build_actions(('output', 2)))
+        prefix_rule = t.build_flow_rule('b0', t.build_matches(ipv4_dst='224.0.0.0/30'), t.build_actions(('group', 10)))
+        host_rule = t.build_flow_rule('c0', t.build_matches(in_port=1, ipv4_dst='10.0.0.1'),
+                                      t.build_actions(('set_ipv4_dst', '10.0.0.2'), ('output', 2)))
+        group = t.build_group('b0', [t.build_bucket(t.build_actions(('output', p))) for p in (1, 2)], 10)
+        for r in (rule, prefix_rule, host_rule):
+            t.install_flow_rule(r)
+        t.install_group(group)
+        # re-installing the same rule replaces it
+        t.install_flow_rule(t.build_flow_rule('b0', t.build_matches(in_port=1, ipv4_dst='10.0.0.1'),
+                                              t.build_actions(('output', 2))))
+
+        # flow_mod (48) + padded match (4 + 4 per field + its value, prefixes double the value, and build_matches()
+        # adds eth_type) + instruction (8) + actions (16 per output, 8 per group, padded 4 + 8 per set_field);
+        # group_mod (16) + buckets (16 + actions)
+        rule_size = 48 + 32 + 8 + 16
+        prefix_rule_size = 48 + 24 + 8 + 8
+        host_rule_size = 48 + 32 + 8 + 16 + 16
+        group_size = 16 + 2 * (16 + 16)
+        self.assertEqual(t.get_flow_rule_size(rule), rule_size)
+        self.assertEqual(t.get_flow_rule_size(prefix_rule), prefix_rule_size)
+        self.assertEqual(t.get_flow_rule_size(host_rule), host_rule_size)
+        self.assertEqual(t.get_group_size(group), group_size)
+
+        self.assertEqual(t.get_flow_table_stats(),
+                         {'b0': dict(flows=2, groups=1, bytes=rule_size + prefix_rule_size + group_size),
+                          'c0': dict(flows=1, groups=0, bytes=host_rule_size)})
+        self.assertEqual(t.get_flow_table_stats(flow_rules=[rule], groups=[]),
+                         {'b0': dict(flows=1, groups=0, bytes=rule_size)})
+
+
+if __name__ == '__main__':
+    unittest.main()